@@ -0,0 +1,160 @@
+"""
+Batch generation of synthetic populations for multiple scenarios.
+The survey population, zones and location samplers are prepared once and shared across scenarios,
+    which run concurrently in a pool of worker processes.
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from athenspop import cache, weights
+from athenspop.core import generate_population, get_location_sampler
+from athenspop.population import PopulationStore
+from athenspop.profiling import StageProfiler
+
+# scenario parameters passed to `generate_population`
+SCENARIO_PARAMETERS = [
+    'total_population', 'sample_perc', 'seed', 'shard_size', 'stream', 'compression',
+    'write_plans', 'write_parquet', 'weighted'
+]
+# scenario parameters of the shared inputs
+SCENARIO_INPUTS = ['name', 'path_facilities', 'path_facility_index', 'path_controls']
+
+# shared inputs of the current (worker) process
+_inputs = None
+
+
+def load_scenarios(path: str) -> list:
+    """
+    Load a list of scenario specifications (json), ie:
+        [
+            {"name": "base", "sample_perc": 0.01, "seed": 1},
+            {"name": "landuse", "sample_perc": 0.01, "seed": 1, "path_facilities": "landuse.gpkg"}
+        ]
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def validate_scenarios(scenarios: list) -> None:
+    """
+    Check that all scenarios have a unique name and known parameters
+    """
+    names = [scenario.get('name') for scenario in scenarios]
+    if None in names:
+        raise ValueError('All scenarios must have a name')
+    if len(set(names)) < len(names):
+        raise ValueError(f'Scenario names must be unique: {names}')
+    for scenario in scenarios:
+        unknown = set(scenario) - set(SCENARIO_PARAMETERS + SCENARIO_INPUTS)
+        if unknown:
+            raise ValueError(f"Unknown parameters in scenario {scenario['name']}: {unknown}")
+
+
+def init_inputs(inputs: dict) -> None:
+    """
+    Set the shared inputs of the current (worker) process,
+        so that they are sent to each worker once (rather than with every scenario).
+    """
+    global _inputs
+    _inputs = inputs
+
+
+def run_scenario(scenario: dict, path_outputs: str, profile: bool = False) -> dict:
+    """
+    Generate the population of a scenario, using the shared inputs of the current process.
+        Outputs are written to a directory named after the scenario.
+
+    :return: a summary of the scenario run
+    """
+    path_scenario = os.path.join(path_outputs, scenario['name'])
+    path_controls = scenario.get('path_controls')
+    profiler = StageProfiler()
+    generate_population(
+        _inputs['store'],
+        _inputs['samplers'][scenario.get('path_facilities')],
+        path_scenario,
+        controls=weights.load_controls(path_controls) if path_controls is not None else None,
+        profiler=profiler,
+        **{k: v for k, v in scenario.items() if k in SCENARIO_PARAMETERS}
+    )
+    if profile:
+        profiler.save(path_scenario)
+
+    report = profiler.report()
+    return {
+        'name': scenario['name'],
+        'path_outputs': path_scenario,
+        'persons': int(report.loc['upscale', 'persons']),
+        'wall_time': round(report['wall_time'].sum(), 4),
+    }
+
+
+def create_populations(
+    path_survey: str,
+    scenarios: list,
+    path_outputs: str,
+    n_workers: int = 1,
+    seed: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    wrap_next_day: bool = False,
+    profile: bool = False
+) -> list:
+    """
+    Create the synthetic populations of multiple scenarios from the NTUA travel survey data.
+    The survey is preprocessed and converted once, and a location sampler is built
+        for each facility dataset (or random point-in-zone sampling), shared across scenarios.
+
+    :param path_survey: path to the NTUA travel survey dataset
+    :param scenarios: scenario specifications, each with a (unique) 'name',
+        and optionally any of the parameters 'total_population', 'sample_perc', 'seed',
+        'shard_size', 'stream', 'compression', 'write_plans', 'write_parquet', 'weighted',
+        'path_facilities', 'path_facility_index' and 'path_controls' (see create_population)
+    :param path_outputs: output directory. Each scenario is written to a subdirectory named after it.
+    :param n_workers: number of scenarios run concurrently (in worker processes)
+    :param seed: random seed of the survey preprocessing (infilled return trip durations)
+    :param cache_dir: directory of cached preprocessed survey tables and zones
+    :param wrap_next_day: whether to wrap the next-day diary trips around to the start of the plans
+    :param profile: whether to save a stage profile (profile.json/csv) of each scenario
+    :return: a summary of each scenario run
+    """
+    validate_scenarios(scenarios)
+
+    # shared inputs
+    person_attributes, trips = cache.load_survey_tables(
+        os.path.join(path_survey, 'NEW_diaries_athens_final.csv'),
+        cache_dir=cache_dir,
+        wrap_next_day=wrap_next_day,
+        seed=seed
+    )
+    store = PopulationStore.from_trips(trips, person_attributes)
+    zones = cache.load_zones(
+        os.path.join(path_survey, 'shp_zones', 'zones_attica.shp'),
+        cache_dir=cache_dir
+    )
+    samplers = {}
+    for scenario in scenarios:
+        path_facilities = scenario.get('path_facilities')
+        if path_facilities not in samplers:
+            samplers[path_facilities] = get_location_sampler(
+                zones, path_facilities, scenario.get('path_facility_index')
+            )
+    inputs = {'store': store, 'samplers': samplers}
+
+    if n_workers == 1:
+        init_inputs(inputs)
+        try:
+            return [run_scenario(scenario, path_outputs, profile) for scenario in scenarios]
+        finally:
+            init_inputs(None)
+
+    with ProcessPoolExecutor(
+        max_workers=min(n_workers, len(scenarios)),
+        initializer=init_inputs,
+        initargs=(inputs,)
+    ) as executor:
+        futures = [
+            executor.submit(run_scenario, scenario, path_outputs, profile)
+            for scenario in scenarios
+        ]
+        return [future.result() for future in futures]
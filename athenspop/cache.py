@@ -0,0 +1,160 @@
+"""
+Content-addressed on-disk cache of preprocessed survey artifacts.
+
+Artifacts are keyed by a hash of the input file contents and the preprocessing parameters,
+    so that they are invalidated automatically when either changes.
+"""
+import glob
+import hashlib
+import json
+import os
+from typing import Iterable, Optional, Tuple
+import geopandas as gp
+import pandas as pd
+from athenspop import preprocessing
+
+# increment to invalidate existing caches when the preprocessing logic changes
+CACHE_VERSION = 2
+
+
+def hash_files(paths: Iterable[str], block_size: int = 2**20) -> str:
+    """
+    Get a hash of the contents of a list of files
+    """
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def get_related_files(path: str) -> list:
+    """
+    Get a file and its sidecar files with the same name (ie a shapefile's .dbf, .shx, .prj)
+    """
+    stem = os.path.splitext(path)[0]
+    return [x for x in glob.glob(glob.escape(stem) + '.*') if os.path.isfile(x)]
+
+
+def get_cache_key(paths: Iterable[str], **params) -> str:
+    """
+    Get the cache key of an artifact,
+        from the contents of its input files and its parameters
+    """
+    digest = hashlib.sha256()
+    digest.update(hash_files(paths).encode())
+    digest.update(json.dumps(
+        {'cache_version': CACHE_VERSION, **params}, sort_keys=True, default=str
+    ).encode())
+    return digest.hexdigest()[:24]
+
+
+class ArtifactCache:
+    """
+    A directory of cached (Geo)Parquet tables, grouped by cache key
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def get_path(self, key: str, name: str) -> str:
+        return os.path.join(self.cache_dir, key, f'{name}.parquet')
+
+    def exists(self, key: str, names: Iterable[str]) -> bool:
+        return all(os.path.exists(self.get_path(key, name)) for name in names)
+
+    def save(self, key: str, name: str, df: pd.DataFrame) -> None:
+        """
+        Save a (Geo)DataFrame. Files are written to a temporary path first,
+            so that interrupted writes do not leave partial artifacts.
+        """
+        path = self.get_path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        path_tmp = f'{path}.{os.getpid()}.tmp'
+        df.to_parquet(path_tmp)
+        os.replace(path_tmp, path)
+
+    def load(self, key: str, name: str, geo: bool = False) -> pd.DataFrame:
+        path = self.get_path(key, name)
+        if geo:
+            return gp.read_parquet(path)
+        return pd.read_parquet(path)
+
+
+def load_survey_tables(
+    path: str,
+    cache_dir: Optional[str] = None,
+    fix_day: bool = True,
+    fix_return: bool = True,
+    fix_market: bool = True,
+    filter_next_day: bool = True,
+    wrap_next_day: bool = False,
+    seed: Optional[int] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Read and preprocess the travel survey,
+        returning the person attributes and trips tables.
+    If a cache directory is provided, the tables are loaded from the cache when available.
+        Runs without a random seed are not cached when missing return trips are infilled,
+        as the infilled durations are random.
+
+    :param path: path to the travel survey (csv)
+    :param cache_dir: cache directory
+    :param wrap_next_day: If True, wrap the next-day trips around to the start of the plan
+        (see preprocessing.wrap_next_day_trips)
+    :param seed: Random seed for the infilled return trip durations
+    """
+    params = dict(
+        fix_day=fix_day,
+        fix_return=fix_return,
+        fix_market=fix_market,
+        filter_next_day=filter_next_day,
+        wrap_next_day=wrap_next_day,
+        seed=seed
+    )
+    use_cache = cache_dir is not None and (seed is not None or not fix_return)
+    if cache_dir is not None and not use_cache:
+        print('Survey tables are not cached: a random seed is required to cache the infilled return trips')
+    if use_cache:
+        cache = ArtifactCache(cache_dir)
+        key = get_cache_key([path], artifact='survey', **params)
+        if cache.exists(key, ['persons', 'trips']):
+            print(f'Loading cached survey tables ({key})')
+            return cache.load(key, 'persons'), cache.load(key, 'trips')
+
+    survey_raw = preprocessing.read_survey(
+        path, fix_day=fix_day, fix_return=fix_return, fix_market=fix_market, seed=seed
+    )
+    person_attributes = preprocessing.get_person_attributes(survey_raw)
+    trips = preprocessing.get_trips_table(
+        survey_raw, filter_next_day=filter_next_day, wrap_next_day=wrap_next_day
+    )
+
+    if use_cache:
+        cache.save(key, 'persons', person_attributes)
+        cache.save(key, 'trips', trips)
+
+    return person_attributes, trips
+
+
+def load_zones(path: str, cache_dir: Optional[str] = None) -> gp.GeoDataFrame:
+    """
+    Get the Attica zoning system (see preprocessing.get_zones).
+    If a cache directory is provided, zones are loaded from a cached GeoParquet file when available.
+
+    :param path: path to the zones shapefile
+    :param cache_dir: cache directory
+    """
+    if cache_dir is None:
+        return preprocessing.get_zones(path)
+
+    cache = ArtifactCache(cache_dir)
+    key = get_cache_key(get_related_files(path), artifact='zones')
+    if cache.exists(key, ['zones']):
+        return cache.load(key, 'zones', geo=True)
+
+    zones = preprocessing.get_zones(path)
+    cache.save(key, 'zones', zones)
+    return zones
@@ -2,7 +2,9 @@ import click
 import logging
 from pathlib import Path
 import os
-from athenspop.core import create_population
+
+# the population modules are imported within the commands,
+#   so that the cli starts (ie --help) without importing pandas, geopandas and PAM
 
 logging.basicConfig(
     level=logging.INFO,
@@ -40,10 +42,200 @@ def create():
     default=None,
     help="Path to the facility (land use) dataset (optional)."
 )
-def population(inputs_path, path_outputs, path_facilities):
+@click.option(
+    "--sample_perc",
+    "-s",
+    type=float,
+    default=0.001,
+    show_default=True,
+    help="Population percentage to generate (ie 0.001 for a 0.1% sample)."
+)
+@click.option(
+    "--total_population",
+    "-t",
+    type=float,
+    default=3.8 * 10**6,
+    show_default=True,
+    help="Total population target (before sampling)."
+)
+@click.option(
+    "--path_controls",
+    default=None,
+    help="Path to control totals (csv of attribute, category and total) "
+    "of the zone, age group, gender, income and car ownership marginals. "
+    "Household weights are raked to the controls, instead of scaled to the total population (optional)."
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=None,
+    help="Random seed, for reproducible populations."
+)
+@click.option(
+    "--n_workers",
+    "-w",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of worker processes serializing the outputs (streamed or weighted outputs only)."
+)
+@click.option(
+    "--shard_size",
+    type=int,
+    default=1000,
+    show_default=True,
+    help="Number of households converted and exported together."
+)
+@click.option(
+    "--output_format",
+    type=click.Choice(['pam', 'stream', 'parquet']),
+    multiple=True,
+    default=['pam'],
+    show_default=True,
+    help="Output writer: PAM (plans.xml, csv and geojson tables), "
+    "streamed in shards (plans.xml and csv tables), "
+    "or Parquet datasets (parquet/ directory). Can be repeated, ie to add Parquet tables to the plans."
+)
+@click.option(
+    "--weighted",
+    is_flag=True,
+    help="Keep each survey household once with an expansion count, "
+    "cloning households only at export time, shard by shard (plans are streamed)."
+)
+@click.option(
+    "--compression",
+    type=click.Choice(['gzip']),
+    default=None,
+    help="MATSim plans compression (plans.xml.gz)."
+)
+@click.option(
+    "--wrap_next_day",
+    is_flag=True,
+    help="Wrap diary trips after midnight around to the start of the plans, instead of dropping them."
+)
+@click.option(
+    "--cache_dir",
+    default=None,
+    help="Directory of cached preprocessed survey tables and zones (optional). "
+    "Survey tables are only cached for seeded runs."
+)
+@click.option(
+    "--path_facility_index",
+    default=None,
+    help="Path to a saved facility index (.npz), created if it does not exist (optional)."
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Write a report of the run time, memory and counts of each stage (profile.json/csv)."
+)
+@click.option(
+    "--profile_stage",
+    default=None,
+    help="Name of a stage to profile with cProfile (written to profile_<stage>.prof)."
+)
+def population(
+    inputs_path, path_outputs, path_facilities, sample_perc, total_population, path_controls, seed,
+    n_workers, shard_size, output_format, weighted, compression, wrap_next_day, cache_dir,
+    path_facility_index, profile, profile_stage
+):
+    from athenspop.core import create_population
+    from athenspop.profiling import StageProfiler
+
+    if {'pam', 'stream'}.issubset(output_format):
+        raise click.BadParameter("Choose one of 'pam' or 'stream'", param_hint='--output_format')
+    if n_workers != 1 and not ('stream' in output_format or weighted):
+        raise click.BadParameter(
+            "Worker processes are only used with '--output_format stream' or '--weighted'",
+            param_hint='--n_workers'
+        )
+
     logger.info('Creating population...')
+    profiler = StageProfiler(profile_stage=profile_stage, verbose=profile)
     create_population(
         path_survey=inputs_path,
         path_outputs=path_outputs,
-        path_facilities=path_facilities
-    )
\ No newline at end of file
+        path_facilities=path_facilities,
+        total_population=total_population,
+        sample_perc=sample_perc,
+        seed=seed,
+        n_workers=n_workers,
+        shard_size=shard_size,
+        stream='stream' in output_format,
+        compression=compression,
+        path_facility_index=path_facility_index,
+        cache_dir=cache_dir,
+        write_plans='pam' in output_format or 'stream' in output_format,
+        write_parquet='parquet' in output_format,
+        weighted=weighted,
+        path_controls=path_controls,
+        wrap_next_day=wrap_next_day,
+        profiler=profiler
+    )
+    if profile or profile_stage is not None:
+        profiler.save(path_outputs)
+        logger.info(f'Profile saved to {path_outputs}')
+
+
+@create.command()
+@click.argument("inputs_path", type=click.Path(exists=True))
+@click.argument("scenarios_path", type=click.Path(exists=True))
+@click.option(
+    "--path_outputs",
+    "-o",
+    help="Output directory (each scenario is written to a subdirectory named after it)."
+)
+@click.option(
+    "--n_workers",
+    "-w",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of scenarios generated concurrently."
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=None,
+    help="Random seed of the survey preprocessing (scenario seeds are set in the scenarios file)."
+)
+@click.option(
+    "--wrap_next_day",
+    is_flag=True,
+    help="Wrap diary trips after midnight around to the start of the plans, instead of dropping them."
+)
+@click.option(
+    "--cache_dir",
+    default=None,
+    help="Directory of cached preprocessed survey tables and zones (optional)."
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Write a report of the run time, memory and counts of each stage, for each scenario."
+)
+def populations(
+    inputs_path, scenarios_path, path_outputs, n_workers, seed, wrap_next_day, cache_dir, profile
+):
+    """
+    Build the populations of multiple scenarios (json list of scenario specifications),
+    sharing the survey, zones and facility inputs.
+    """
+    from athenspop.batch import create_populations, load_scenarios
+
+    logger.info('Creating populations...')
+    results = create_populations(
+        path_survey=inputs_path,
+        scenarios=load_scenarios(scenarios_path),
+        path_outputs=path_outputs,
+        n_workers=n_workers,
+        seed=seed,
+        cache_dir=cache_dir,
+        wrap_next_day=wrap_next_day,
+        profile=profile
+    )
+    for result in results:
+        logger.info(
+            f"{result['name']}: {result['persons']} persons in {result['wall_time']:.1f}s "
+            f"({result['path_outputs']})"
+        )
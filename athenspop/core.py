@@ -1,15 +1,129 @@
 # %% Import dependencies
-from athenspop import preprocessing
+from athenspop import cache, mappings, parallel, parquet, preprocessing, spatial, weights
+from athenspop.jitter import jitter_store
+from athenspop.population import PopulationStore, WeightedPopulation
+from athenspop.profiling import StageProfiler
+from athenspop.writer import PopulationWriter
 import os
-from datetime import timedelta
-from typing import Optional
+from typing import TYPE_CHECKING, Optional, Union
 import geopandas as gp
+import numpy as np
 import pandas as pd
-from pam import read, write
-from pam.samplers.spatial import RandomPointSampler
-from pam.samplers.facility import FacilitySampler
-from pam.samplers.population import sample as population_sampler
-from pam.samplers.time import apply_jitter_to_plan
+
+# PAM is imported within the functions that use it, as it is slow to import
+if TYPE_CHECKING:
+    from pam.core import Population
+
+
+def load_facilities(path_facilities: str) -> gp.GeoDataFrame:
+    """
+    Load the facility (land use) dataset.
+
+    :param path_facilities: path to the facility (land use) dataset
+    """
+    facilities = gp.read_file(path_facilities)
+    facilities = facilities.set_crs(epsg=2100, allow_override=True)
+    return facilities
+
+
+def get_facility_index(
+    path_facilities: str,
+    zones: gp.GeoDataFrame,
+    path_index: Optional[str] = None
+) -> spatial.FacilityIndex:
+    """
+    Get the facility location sampler.
+    'other' facilities are also used for 'recreation' and 'service' activities.
+    Activities without facilities in a zone are assigned a random point within the zone.
+
+    :param path_facilities: path to the facility (land use) dataset
+    :param zones: zoning system
+    :param path_index: path to a saved facility index (.npz).
+        If it exists, the index is loaded (skipping the spatial join),
+        otherwise the index is built and saved there.
+    """
+    kwargs = dict(
+        aliases=mappings.facility_activity,
+        fallback=spatial.ZonePointSampler(zones)
+    )
+    if path_index is not None and os.path.exists(path_index):
+        return spatial.FacilityIndex.load(path_index, **kwargs)
+
+    facility_index = spatial.FacilityIndex.from_facilities(
+        load_facilities(path_facilities), zones, **kwargs
+    )
+    if path_index is not None:
+        facility_index.save(path_index)
+    return facility_index
+
+
+def get_location_sampler(
+    zones: gp.GeoDataFrame,
+    path_facilities: Optional[str] = None,
+    path_facility_index: Optional[str] = None
+):
+    """
+    Get the activity location sampler:
+        random points within zones, or land-use facilities (if a facility dataset is provided)
+
+    :param zones: zoning system
+    :param path_facilities: path to the facility (land use) dataset
+    :param path_facility_index: path to a saved facility index (see get_facility_index)
+    """
+    if path_facilities is None:
+        # random point-in-zone sampling
+        return spatial.ZonePointSampler(zones)
+    # land-use facility sampling
+    return get_facility_index(path_facilities, zones, path_index=path_facility_index)
+
+
+def get_sample_counts(
+    population: Union['Population', PopulationStore],
+    scale_factor: float,
+    seed: Optional[int] = None,
+    household_weights: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Get the number of samples of each population household to match a scale factor.
+    Fractional household counts are rounded probabilistically.
+
+    PAM's population sampler re-seeds python's global random state on each draw,
+        so the sampling is done here, with a seeded numpy generator.
+
+    :param population: PAM population (or population store) to sample from
+    :param scale_factor: target/current population ratio
+    :param seed: random seed (or generator), for reproducible samples
+    :param household_weights: expansion weight of each household (ie raked weights),
+        used instead of the household frequencies
+    """
+    rng = np.random.default_rng(seed)
+    if household_weights is not None:
+        freqs = np.asarray(household_weights, dtype=float) * scale_factor
+    elif isinstance(population, PopulationStore):
+        freqs = population.households.freq.values
+        freqs = np.where(freqs > 0, freqs, 1) * scale_factor
+    else:
+        freqs = np.array(
+            [hh.freq or 1 for hh in population.households.values()]
+        ) * scale_factor
+    return freqs.astype(int) + (rng.random(len(freqs)) < freqs % 1)
+
+
+def sample_population(
+    population: 'Population',
+    scale_factor: float,
+    seed: Optional[int] = None
+) -> 'Population':
+    """
+    Up/down-sample the population households to match a scale factor.
+    Sampled households and persons get unique ids, ie f"{hid}-{n}" and f"{pid}-{n}".
+
+    :param population: PAM population to sample from
+    :param scale_factor: target/current population ratio
+    :param seed: random seed, for reproducible samples
+    """
+    counts = get_sample_counts(population, scale_factor, seed=seed)
+    return PopulationStore.from_population(population).repeat(counts).to_pam()
 
 
 def create_population(
@@ -18,6 +132,19 @@ def create_population(
     path_facilities: Optional[str],
     total_population=3.8 * 10**6,  # total population of Attica
     sample_perc=0.001,  # generate a 0.1% synthetic population
+    seed: Optional[int] = None,
+    n_workers: int = 1,
+    shard_size: int = 1000,
+    stream: bool = False,
+    compression: Optional[str] = None,
+    path_facility_index: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+    write_plans: bool = True,
+    write_parquet: bool = False,
+    weighted: bool = False,
+    path_controls: Optional[str] = None,
+    wrap_next_day: bool = False,
+    profiler: Optional[StageProfiler] = None,
 ):
     """
     Create a PAM population from the NTUA travel survey data.
@@ -25,69 +152,298 @@ def create_population(
     :param path_survey: path to the NTUA travel survey dataset
     :param outputs: path to the output population.xml file
     :param path_facilities: path to the facility (land use) dataset
-    :param total_population: population target 
+    :param total_population: population target
     :param sample_perc: population percentage to generate.
         (for example, use sample_perc = 0.001 to create a 0.1% sample synthetic population)
+    :param seed: random seed, for reproducible populations
+    :param n_workers: number of worker processes serializing the streamed outputs
+        (or expanding the weighted shards). Not used otherwise.
+    :param shard_size: number of households converted to PAM objects (and exported) together
+    :param stream: if True, households are converted to PAM objects and written in shards,
+        so that the full PAM population is never held in memory
+        (the upscaled population is still held as a population store, see `weighted`).
+        Streamed outputs are the MATSim plans and csv tables (activity x/y columns instead of geojsons).
+    :param compression: MATSim plans compression (None or 'gzip')
+    :param path_facility_index: path to a saved facility index (see get_facility_index)
+    :param cache_dir: directory of cached preprocessed survey tables and zones.
+        Cached artifacts are reused when the input files and parameters are unchanged.
+    :param write_plans: whether to write the MATSim plans and tabular (csv) outputs
+    :param write_parquet: whether to write the households, persons, activities and legs tables
+        as partitioned Parquet/GeoParquet datasets (under path_outputs/parquet)
+    :param weighted: if True, the survey households are kept once, with an expansion count,
+        and are only cloned into synthetic households at export time, shard by shard
+        (with time jitter and location sampling applied to each shard).
+        Memory then scales with the survey rather than with the synthetic population.
+        Plans are written with the streamed writer.
+    :param path_controls: path to control totals (csv) of the zone, age group, gender,
+        income and car ownership marginals (see weights.load_controls).
+        If provided, the household expansion weights are raked to the control totals
+        (which replace the total_population target) before sampling.
+    :param wrap_next_day: if True, diary trips of the next day (ie a return home after midnight)
+        are wrapped around to the start of the 24-hour plan, instead of being dropped
+    :param profiler: stage profiler, recording the run time, memory and counts of each stage
 
     """
+    if profiler is None:
+        profiler = StageProfiler()
+
     # Ingest travel survey data
-    survey_raw = preprocessing.read_survey(
-        os.path.join(path_survey, 'NEW_diaries_athens_final.csv')
-    )
-    person_attributes = preprocessing.get_person_attributes(survey_raw)
-    trips = preprocessing.get_trips_table(survey_raw)
+    with profiler.stage('read_survey') as record:
+        person_attributes, trips = cache.load_survey_tables(
+            os.path.join(path_survey, 'NEW_diaries_athens_final.csv'),
+            cache_dir=cache_dir,
+            wrap_next_day=wrap_next_day,
+            seed=seed
+        )
+        record.update(persons=len(person_attributes), trips=len(trips))
+
+    # create the survey population
+    #   (plans are built directly from the trips table, without PAM's travel diary reader)
+    with profiler.stage('build_population') as record:
+        store = PopulationStore.from_trips(trips, person_attributes)
+        record.update(persons=len(store), activities=len(store.activities))
+
+    # zoning system
+    with profiler.stage('load_zones') as record:
+        zones = cache.load_zones(
+            os.path.join(path_survey, 'shp_zones', 'zones_attica.shp'),
+            cache_dir=cache_dir
+        )
+        record['zones'] = len(zones)
+    zones.plot()
 
-    # create PAM population
-    population = read.load_travel_diary(
-        trips=trips,
-        persons_attributes=person_attributes
+    with profiler.stage('location_sampler'):
+        location_sampler = get_location_sampler(
+            zones, path_facilities, path_facility_index=path_facility_index
+        )
+
+    generate_population(
+        store,
+        location_sampler,
+        path_outputs,
+        total_population=total_population,
+        sample_perc=sample_perc,
+        seed=seed,
+        n_workers=n_workers,
+        shard_size=shard_size,
+        stream=stream,
+        compression=compression,
+        write_plans=write_plans,
+        write_parquet=write_parquet,
+        weighted=weighted,
+        controls=weights.load_controls(path_controls) if path_controls is not None else None,
+        profiler=profiler
     )
 
+
+def generate_population(
+    store: PopulationStore,
+    location_sampler,
+    path_outputs: str,
+    total_population=3.8 * 10**6,
+    sample_perc=0.001,
+    seed: Optional[int] = None,
+    n_workers: int = 1,
+    shard_size: int = 1000,
+    stream: bool = False,
+    compression: Optional[str] = None,
+    write_plans: bool = True,
+    write_parquet: bool = False,
+    weighted: bool = False,
+    controls: Optional[pd.DataFrame] = None,
+    profiler: Optional[StageProfiler] = None,
+):
+    """
+    Upscale the survey population, apply time jitter, sample the activity locations,
+        and export the synthetic population (see create_population).
+
+    :param store: population store of the survey diaries
+    :param location_sampler: activity location sampler (see get_location_sampler)
+    :param path_outputs: output directory
+    :param total_population: population target
+    :param sample_perc: population percentage to generate
+    :param seed: random seed, for reproducible populations
+    :param n_workers: number of worker processes serializing the streamed outputs
+    :param shard_size: number of households converted to PAM objects (and exported) together
+    :param stream: if True, households are converted and written in shards
+    :param compression: MATSim plans compression (None or 'gzip')
+    :param write_plans: whether to write the MATSim plans and tabular (csv) outputs
+    :param write_parquet: whether to write the population tables as Parquet datasets
+    :param weighted: if True, households are expanded (cloned) at export time, shard by shard
+    :param controls: control totals (see weights.load_controls).
+        If provided, household weights are raked to the controls instead of scaled to total_population.
+        The fitted and target totals are saved to path_outputs/raking.csv.
+    :param profiler: stage profiler
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+
+    # fit the household expansion weights to the control totals
+    household_weights = None
+    if controls is not None:
+        with profiler.stage('raking') as record:
+            raking = weights.rake_store(store, controls)
+            household_weights = raking.weights
+            record.update(iterations=raking.iterations, max_error=float(f'{raking.max_error:.3g}'))
+        os.makedirs(path_outputs, exist_ok=True)
+        raking.report().to_csv(os.path.join(path_outputs, 'raking.csv'), index=False)
+
     # resample to match totals target
-    scale_factor = total_population * sample_perc / len(population)
-    population = population_sampler(population, scale_factor)
-    print(population)
+    with profiler.stage('upscale') as record:
+        if household_weights is None:
+            scale_factor = total_population * sample_perc / len(store)
+        else:
+            scale_factor = sample_perc
+        rng = np.random.default_rng(seed)
+        counts = get_sample_counts(
+            store, scale_factor, seed=rng, household_weights=household_weights
+        )
+        if weighted:
+            population = WeightedPopulation(store, counts)
+            record.update(households=population.n_households, persons=len(population))
+        else:
+            store = store.repeat(counts)
+            record.update(households=store.n_households, persons=len(store))
 
-    # apply some jitter (so that not all activities start at xx:00:00)
-    for hid, pid, person in population.people():
-        apply_jitter_to_plan(
-            person.plan,
-            jitter=timedelta(minutes=30),
-            min_duration=timedelta(minutes=10)
+    if weighted:
+        print(population)
+        export_weighted_population(
+            population,
+            location_sampler,
+            path_outputs,
+            seed=seed,
+            n_workers=n_workers,
+            shard_size=shard_size,
+            compression=compression,
+            write_plans=write_plans,
+            write_parquet=write_parquet,
+            profiler=profiler
         )
-        # crop to 24-hours
-        person.plan.crop()
+        return None
+    print(store)
+
+    # apply some jitter (so that not all activities start at xx:00:00),
+    #   and crop to 24-hours
+    with profiler.stage('jitter') as record:
+        store = jitter_store(store, seed=rng)
+        record.update(activities=len(store.activities), legs=len(store.legs))
+
+    # sample activity locations
+    with profiler.stage('sample_locations') as record:
+        store = spatial.sample_locations(store, location_sampler, seed=rng)
+        record['activities'] = len(store.activities)
 
-    # facility sampling
-    zones = preprocessing.get_zones(
-        path=os.path.join(path_survey, 'shp_zones', 'zones_attica.shp')
+    # export
+    if write_parquet:
+        path_parquet = os.path.join(path_outputs, 'parquet')
+        with profiler.stage('export_parquet') as record:
+            parquet.write_parquet(store, path_parquet)
+            record.update(households=store.n_households, persons=len(store))
+        print(f'Population exported to {path_parquet}')
+
+    if not write_plans:
+        return None
+
+    if stream:
+        with profiler.stage('export') as record:
+            with PopulationWriter(
+                path_outputs,
+                comment='Athens example pop',
+                compression=compression
+            ) as writer:
+                for serialized in parallel.iter_serialized_shards(
+                    store, n_workers=n_workers, shard_size=shard_size
+                ):
+                    writer.add_serialized(*serialized)
+            record.update(households=writer.n_households, persons=writer.n_people)
+        print(f'Population: {writer.n_people} people in {writer.n_households} households.')
+        print(f'Population exported to {writer.plans_path}')
+        return None
+
+    from pam import write
+    from pam.core import Population
+    with profiler.stage('to_pam') as record:
+        population = Population()
+        for households in store.iter_batches(batch_size=shard_size):
+            for household in households:
+                population.add(household)
+        record.update(households=len(population.households), persons=len(population))
+    print(population)
+
+    path_out = os.path.join(
+        path_outputs, 'plans.xml.gz' if compression == 'gzip' else 'plans.xml'
     )
-    zones.plot()
+    with profiler.stage('export') as record:
+        write.write_matsim(
+            population,
+            plans_path=path_out,
+            comment='Athens example pop'
+        )
+        population.to_csv(path_outputs, crs=2100)
+        record.update(households=len(population.households), persons=len(population))
+    print(f'Population exported to {path_out}')
 
-    if path_facilities is not None:
-        # land-use facility sampling
-        facilities = gp.read_file(path_facilities)
-        facilities = facilities.set_crs(epsg=2100, allow_override=True)
-        for act_name in ['recreation', 'service']:
-            facilities = pd.concat([
-                facilities,
-                facilities[facilities.activity == 'other'].assign(
-                    activity=act_name)
-            ], axis=0, ignore_index=True)
-        sampler = FacilitySampler(facilities, zones)
-        population.sample_locs(sampler)
 
-    else:
-        # random point-in-polygon sampling
-        sampler = RandomPointSampler(geoms=zones)
-        population.sample_locs(sampler)
+def export_weighted_population(
+    population: WeightedPopulation,
+    location_sampler,
+    path_outputs: str,
+    seed: Optional[int] = None,
+    n_workers: int = 1,
+    shard_size: int = 1000,
+    compression: Optional[str] = None,
+    write_plans: bool = True,
+    write_parquet: bool = False,
+    profiler: Optional[StageProfiler] = None,
+):
+    """
+    Expand a weighted population into synthetic households shard by shard,
+        applying time jitter and sampling the activity locations of each shard,
+        and export them as streamed MATSim plans (and csv tables) and/or Parquet datasets.
 
-    # export
-    path_out = os.path.join(path_outputs, 'plans.xml')
-    write.write_matsim(
+    :param population: weighted population of the survey households
+    :param location_sampler: activity location sampler (see get_location_sampler)
+    :param path_outputs: output directory
+    :param seed: random seed, used to derive the seed of each shard
+        (so that results do not change with the number of workers)
+    :param n_workers: number of worker processes expanding and exporting the shards
+    :param shard_size: number of (expanded) households processed together
+    :param compression: MATSim plans compression (None or 'gzip')
+    :param write_plans: whether to write the MATSim plans and tabular (csv) outputs
+    :param write_parquet: whether to write the population tables as Parquet datasets
+    :param profiler: stage profiler
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+    path_parquet = os.path.join(path_outputs, 'parquet') if write_parquet else None
+    if path_parquet is not None:
+        parquet.clear_parquet(path_parquet)
+    shards = parallel.iter_weighted_shards(
         population,
-        plans_path=path_out,
-        comment='Athens example pop'
+        location_sampler,
+        n_workers=n_workers,
+        shard_size=shard_size,
+        seed=seed,
+        path_parquet=path_parquet,
+        write_plans=write_plans
     )
-    population.to_csv(path_outputs, crs=2100)
-    print(f'Population exported to {path_out}')
+
+    with profiler.stage('export') as record:
+        if write_plans:
+            with PopulationWriter(
+                path_outputs,
+                comment='Athens example pop',
+                compression=compression
+            ) as writer:
+                for serialized in shards:
+                    writer.add_serialized(*serialized)
+        else:
+            for _ in shards:
+                pass
+        record.update(households=population.n_households, persons=len(population))
+
+    if write_plans:
+        print(f'Population: {writer.n_people} people in {writer.n_households} households.')
+        print(f'Population exported to {writer.plans_path}')
+    if write_parquet:
+        print(f'Population exported to {path_parquet}')
@@ -0,0 +1,402 @@
+"""
+Direct conversion of the survey trips to a population store.
+
+Plans are assembled from the (sorted) trips arrays in one pass,
+    following PAM's tour-based travel diary reader (`pam.read.load_travel_diary`):
+    an activity at the origin of the first trip, then a leg and an activity at the destination
+    of each trip. Activity types are inferred from the trip purposes and the home zone
+    (see `infer_tour_activities`), once for each distinct diary.
+"""
+from typing import Tuple
+import numpy as np
+import pandas as pd
+from athenspop.population import get_offsets
+
+TRIPS_COLUMNS = ['pid', 'seq', 'ozone', 'dzone', 'purp', 'mode', 'tst', 'tet']
+PERSONS_COLUMNS = ['pid', 'hzone']
+END_OF_DAY = 24 * 60  # minutes
+
+
+def validate_trips(trips: pd.DataFrame, persons_attributes: pd.DataFrame) -> None:
+    """
+    Check that the trips and person attributes tables can be converted to plans:
+        required columns without missing values, integer trip times (minutes),
+        unique person ids and trip sequences, trips of known persons,
+        and trips that do not end before they start.
+    """
+    for name, df, columns in [
+        ('trips', trips, TRIPS_COLUMNS),
+        ('persons_attributes', persons_attributes, PERSONS_COLUMNS)
+    ]:
+        missing = [col for col in columns if col not in df.columns]
+        if missing:
+            raise ValueError(f'The {name} table is missing the required columns: {missing}')
+        nulls = [col for col in columns if df[col].isna().any()]
+        if nulls:
+            raise ValueError(f'The {name} table has missing values in columns: {nulls}')
+
+    for col in ['tst', 'tet']:
+        if not pd.api.types.is_integer_dtype(trips[col]):
+            raise ValueError(f'Trip times must be integers (minutes), found {col}: {trips[col].dtype}')
+
+    duplicated = persons_attributes.pid[persons_attributes.pid.duplicated()]
+    if len(duplicated):
+        raise ValueError(f'Duplicated person ids: {duplicated.unique()[:5].tolist()}')
+
+    duplicated = trips.pid[trips.duplicated(['pid', 'seq'])]
+    if len(duplicated):
+        raise ValueError(f'Duplicated trip sequences for persons: {duplicated.unique()[:5].tolist()}')
+
+    unknown = trips.pid[~trips.pid.isin(persons_attributes.pid)]
+    if len(unknown):
+        raise ValueError(f'Trips of persons missing from the person attributes: {unknown.unique()[:5].tolist()}')
+
+    reversed_trips = trips.pid[trips.tet.values < trips.tst.values]
+    if len(reversed_trips):
+        raise ValueError(f'Trips ending before they start, for persons: {reversed_trips.unique()[:5].tolist()}')
+
+
+def to_lower_categorical(values: pd.Series) -> pd.Categorical:
+    """
+    Lower-case labels, as a categorical (sorted categories)
+    """
+    codes, uniques = pd.factorize(values)
+    lowered = np.array([str(x).lower() for x in uniques], dtype=object)
+    categories, lowered_codes = np.unique(lowered, return_inverse=True)
+    return pd.Categorical.from_codes(lowered_codes.reshape(-1)[codes], categories=categories)
+
+
+def get_first_positions(groups: np.ndarray, positions: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Replace each value with the first position of the value within its group,
+        so that groups with the same pattern of equal values get the same labels.
+    """
+    order = np.lexsort((positions, values, groups))
+    new_run = np.ones(len(order), dtype=bool)
+    new_run[1:] = (np.diff(groups[order]) != 0) | (np.diff(values[order]) != 0)
+    run_start = np.maximum.accumulate(np.where(new_run, np.arange(len(order)), 0))
+    first_positions = np.empty(len(order), dtype=np.int64)
+    first_positions[order] = positions[order][run_start]
+    return first_positions
+
+
+def infer_tour_activities(
+    hzone,
+    zones: list,
+    ozones: list,
+    dzones: list,
+    purps: list,
+    durations: list
+) -> Tuple[list, list]:
+    """
+    Infer the activity types of a plan from the trip purposes and the home zone,
+        and set the leg purposes to the type of their destination activity.
+    This is a port of PAM's `Plan.infer_activities_from_tour_purpose` and `Plan.set_leg_purposes`
+        (including their handling of zone types),
+        so that plans are the same as those of the tour-based travel diary reader.
+        Plan components are indexed as in PAM: activity i is component 2*i, and leg i is component 2*i+1.
+
+    :param hzone: home zone
+    :param zones: activity zones
+    :param ozones: leg origin zones
+    :param dzones: leg destination zones
+    :param purps: (lower-case) trip purposes
+    :param durations: activity durations
+    :return: activity types and leg purposes
+    """
+    length = 2 * len(zones) - 1
+    acts = [None] * len(zones)
+
+    def closed():
+        return zones[0] == zones[-1] and acts[0] == acts[-1]
+
+    def closed_duration(idx):
+        if closed() and (idx == 0 or idx == length - 1):
+            return durations[0] + durations[-1]
+        return durations[idx // 2]
+
+    def infer_activity_idxs(target, default=True):
+        candidates = set()
+        exclude = set()
+        for i, (ozone, dzone) in enumerate(zip(ozones, dzones)):
+            prev_act_idx = 2 * i
+            next_act_idx = prev_act_idx + 2
+            if ozone == dzone == target:
+                if closed_duration(prev_act_idx) > closed_duration(next_act_idx):
+                    exclude.add(next_act_idx)
+                else:
+                    exclude.add(prev_act_idx)
+        for i, zone in enumerate(zones):
+            if zone == target and (i * 2) not in exclude:
+                candidates.add(i * 2)
+        if default and not candidates:
+            if closed():
+                return set([0, length - 1])
+            return set([0])
+        return candidates
+
+    # home activities (PAM falls back to the first activity zone without a home zone)
+    home_idxs = infer_activity_idxs(target=hzone if hzone else zones[0])
+    for idx in home_idxs:
+        acts[idx // 2] = 'home'
+
+    area_map = {}
+    remaining = set(range(0, length, 2)) - set(home_idxs)
+
+    # forward traverse from home
+    queue = [idx + 2 for idx in home_idxs if idx + 2 < length]
+    last_act = None
+    while queue:
+        idx = queue.pop()
+        if acts[idx // 2] is None:
+            act = purps[(idx - 1) // 2]
+            location = str(zones[idx // 2])
+            if act == last_act and location in area_map:
+                act = area_map[location]
+            acts[idx // 2] = act
+            remaining -= {idx}
+            last_act = act
+            area_map[location] = act
+            if idx + 2 in remaining:
+                queue.append(idx + 2)
+
+    # activities at previously visited zones
+    queue = []
+    for location, activity in area_map.items():
+        for idx in infer_activity_idxs(target=location, default=False):
+            if idx in remaining:
+                acts[idx // 2] = activity
+                remaining -= {idx}
+                if idx + 2 in remaining:
+                    queue.append(idx + 2)
+
+    while queue:
+        idx = queue.pop()
+        if acts[idx // 2] is None:
+            act = purps[(idx - 1) // 2]
+            location = zones[idx // 2]
+            if act == last_act and location in area_map:
+                act = area_map[location]
+            acts[idx // 2] = act
+            remaining -= {idx}
+            last_act = act
+            area_map[location] = act
+            if idx + 2 < length:
+                queue.append(idx + 2)
+
+    # backward traverse
+    queue = list(remaining)
+    while queue:
+        idx = queue.pop()
+        if acts[idx // 2] is None:
+            act = purps[(idx + 1) // 2]
+            location = zones[idx // 2]
+            if act == last_act and location in area_map:
+                act = area_map[location]
+            acts[idx // 2] = act
+            remaining -= {idx}
+            last_act = act
+            area_map[location] = act
+            if idx - 2 >= 0:
+                queue.append(idx - 2)
+
+    # leg purposes (the last leg keeps its trip purpose)
+    leg_purps = list(purps)
+    for i in range(len(purps)):
+        for j in range(2 * i + 2, length - 1, 2):
+            if not acts[j // 2] == 'pt interaction':
+                leg_purps[i] = acts[j // 2]
+                break
+
+    return acts, leg_purps
+
+
+def build_tables(trips: pd.DataFrame, persons_attributes: pd.DataFrame) -> tuple:
+    """
+    Build the population tables of the survey diaries
+        (see `PopulationStore.from_trips`, which should normally be used instead).
+
+    Households are ordered by id, and persons in the order of the person attributes table.
+        Persons are assigned to the household of the person attributes 'hid' column,
+        or else to the 'hid' of their trips (or a single-person household).
+        As in PAM's reader, persons without a household (no 'hid' and no trips) are dropped,
+        and persons without trips stay at home all day.
+    Trip times are in minutes since the start of the day.
+
+    :param trips: trips table (pid, seq, ozone, dzone, purp, mode, tst, tet)
+    :param persons_attributes: person attributes table (pid, hzone and any attributes)
+    :return: the households, persons, activities and legs tables,
+        and the person, activity and leg offsets
+    """
+    validate_trips(trips, persons_attributes)
+
+    # persons, grouped by household
+    persons = persons_attributes.reset_index(drop=True)
+    if 'hid' not in persons.columns:
+        trips_hid = trips['hid'] if 'hid' in trips.columns else trips['pid']
+        persons = persons.assign(
+            hid=persons.pid.map(trips_hid.groupby(trips.pid.values, sort=False).first())
+        )
+        persons = persons[persons.hid.notna()]
+    persons = persons.sort_values('hid', kind='stable').reset_index(drop=True)
+    hids, hh_index = np.unique(persons.hid.to_numpy(), return_inverse=True)
+    person_offsets = get_offsets(np.bincount(hh_index.reshape(-1), minlength=len(hids)))
+    n_persons = len(persons)
+
+    # trips, ordered by person and sequence
+    trip_person = pd.Index(persons.pid).get_indexer(trips.pid)
+    keep = trip_person >= 0
+    order = np.lexsort((trips.seq.values[keep], trip_person[keep]))
+    trips = trips[keep].iloc[order]
+    trip_person = trip_person[keep][order]
+    n_trips = np.bincount(trip_person, minlength=n_persons)
+    trip_offsets = get_offsets(n_trips)
+    trip_seq = np.arange(len(trips)) - np.repeat(trip_offsets[:-1], n_trips)
+    has_trips = n_trips > 0
+
+    hzone = persons.hzone.to_numpy()
+    ozone = trips.ozone.to_numpy()
+    dzone = trips.dzone.to_numpy()
+    tst = trips.tst.to_numpy().astype(np.int64)
+    tet = trips.tet.to_numpy().astype(np.int64)
+    purp = to_lower_categorical(trips.purp)
+    mode = to_lower_categorical(trips['mode'])
+
+    # activities: one at the origin of the first trip, and one at the destination of each trip
+    #   (a single home activity for persons without trips)
+    n_acts = n_trips + 1
+    act_offsets = get_offsets(n_acts)
+    act_person = np.repeat(np.arange(n_persons), n_acts)
+    act_seq = np.arange(act_offsets[-1]) - act_offsets[act_person]
+    dest_idx = act_offsets[trip_person] + trip_seq + 1
+    first_trip = trip_offsets[:-1][has_trips]
+
+    act_zone = np.empty(act_offsets[-1], dtype=np.result_type(hzone, ozone, dzone))
+    act_zone[act_offsets[:-1]] = hzone
+    act_zone[act_offsets[:-1][has_trips]] = ozone[first_trip]
+    act_zone[dest_idx] = dzone
+    act_start = np.zeros(act_offsets[-1], dtype=np.int64)
+    act_start[dest_idx] = tet
+    act_end = np.full(act_offsets[-1], END_OF_DAY, dtype=np.int64)
+    act_end[dest_idx - 1] = tst
+
+    # activity types: infer once for each distinct diary (number of trips, purposes, zones and,
+    #   if any trip starts and ends in the same zone, activity durations)
+    diary_person = np.flatnonzero(has_trips)
+    diary_row = np.cumsum(has_trips) - 1
+    trip_row = diary_row[trip_person]
+    zones = [hzone[diary_person], ozone, dzone]
+    if all(pd.api.types.is_integer_dtype(x) for x in zones):
+        zone_values = np.concatenate(zones)
+    else:
+        zone_values = np.concatenate([x.astype(object) for x in zones])
+    zone_codes = pd.factorize(zone_values)[0]
+    if pd.api.types.infer_dtype(zone_values) in ['integer', 'string']:
+        # the inference only compares the zones of a diary (of the same type):
+        #   label them by their first position in the diary, ie [home, origin, destination, ...]
+        zone_codes = get_first_positions(
+            np.concatenate([np.arange(len(diary_person)), trip_row, trip_row]),
+            np.concatenate([np.zeros(len(diary_person), dtype=np.int64), 1 + 2 * trip_seq, 2 + 2 * trip_seq]),
+            zone_codes
+        )
+        home_code = hzone[diary_person].astype(bool)
+    else:
+        home_code = zone_codes[:len(diary_person)]
+    ozone_code = zone_codes[len(diary_person):len(diary_person)+len(ozone)]
+    dzone_code = zone_codes[len(diary_person)+len(ozone):]
+    max_trips = n_trips.max() if n_persons else 0
+    loop = np.zeros(n_persons, dtype=bool)
+    np.logical_or.at(loop, trip_person, ozone_code == dzone_code)
+
+    diaries = np.full((len(diary_person), 2 + 4 * max_trips + 1), -1, dtype=np.int32)
+    diaries[:, 0] = home_code
+    diaries[:, 1] = n_trips[diary_person]
+    diaries[trip_row, 2 + trip_seq] = ozone_code
+    diaries[trip_row, 2 + max_trips + trip_seq] = dzone_code
+    diaries[trip_row, 2 + 2 * max_trips + trip_seq] = purp.codes
+    act_has_trips = has_trips[act_person]
+    diaries[diary_row[act_person[act_has_trips]], 2 + 3 * max_trips + act_seq[act_has_trips]] = (
+        (act_end - act_start) * loop[act_person]
+    )[act_has_trips]
+    diary_index = pd.DataFrame(diaries).groupby(
+        list(range(diaries.shape[1])), sort=False
+    ).ngroup().to_numpy()
+    unique_diaries = np.unique(diary_index, return_index=True)[1]
+
+    labels = {'home': 0}
+    act_table = np.zeros((len(unique_diaries), max_trips + 1), dtype=np.int32)
+    purp_table = np.zeros((len(unique_diaries), max(max_trips, 1)), dtype=np.int32)
+    purp_labels = np.asarray(purp.categories, dtype=object)[purp.codes]
+    for i, person in enumerate(diary_person[unique_diaries]):
+        t0, t1 = trip_offsets[person], trip_offsets[person+1]
+        a0, a1 = act_offsets[person], act_offsets[person+1]
+        acts, leg_purps = infer_tour_activities(
+            hzone[[person]].tolist()[0],
+            act_zone[a0:a1].tolist(),
+            ozone[t0:t1].tolist(),
+            dzone[t0:t1].tolist(),
+            purp_labels[t0:t1].tolist(),
+            (act_end[a0:a1] - act_start[a0:a1]).tolist()
+        )
+        act_table[i, :len(acts)] = [labels.setdefault(x, len(labels)) for x in acts]
+        purp_table[i, :len(leg_purps)] = [labels.setdefault(x, len(labels)) for x in leg_purps]
+
+    act_codes = np.zeros(act_offsets[-1], dtype=np.int32)  # persons without trips stay at home
+    act_codes[act_has_trips] = act_table[
+        diary_index[diary_row[act_person[act_has_trips]]], act_seq[act_has_trips]
+    ]
+    leg_codes = purp_table[diary_index[trip_row], trip_seq]
+    categories = pd.Index(list(labels))
+    rank = np.argsort(np.argsort(categories.values))
+    categories = categories.sort_values()
+
+    # frequencies: as in PAM, persons without a frequency take the average of their trips,
+    #   and households the average of their persons
+    freq = persons['freq'] if 'freq' in persons.columns else pd.Series(np.nan, index=persons.index)
+    missing = (freq.isna() | (freq == 0)).to_numpy()
+    if missing.any():
+        trip_freq = np.full(n_persons, np.nan)
+        if 'freq' in trips.columns:
+            trip_freq[has_trips] = trips['freq'].groupby(trip_person).mean().to_numpy()
+        freq = np.where(missing, trip_freq, freq.to_numpy(dtype=float))
+    else:
+        freq = freq.to_numpy()
+    hh_freq = np.add.reduceat(freq.astype(float), person_offsets[:-1]) / np.diff(person_offsets)
+
+    # tables
+    households = pd.DataFrame({
+        'hid': hids,
+        'hzone': hzone[person_offsets[:-1]],
+        'freq': hh_freq,
+        'clone': np.int32(-1)
+    })
+    attributes = [col for col in persons.columns if col not in ['pid', 'hid', 'freq']]
+    persons = pd.concat([
+        pd.DataFrame({
+            'hid': persons.hid.values,
+            'pid': persons.pid.values,
+            'clone': np.int32(-1),
+            'freq': freq,
+        }),
+        persons[attributes]
+    ], axis=1)
+    activities = pd.DataFrame({
+        'act': pd.Categorical.from_codes(rank[act_codes], categories=categories).remove_unused_categories(),
+        'zone': act_zone,
+        'start': act_start * 60,
+        'end': act_end * 60,
+        'x': np.nan,
+        'y': np.nan,
+    })
+    legs = pd.DataFrame({
+        'purp': pd.Categorical.from_codes(rank[leg_codes], categories=categories).remove_unused_categories(),
+        'mode': mode,
+        'ozone': ozone,
+        'dzone': dzone,
+        'start': tst * 60,
+        'end': tet * 60,
+    })
+
+    return households, persons, activities, legs, (
+        person_offsets, act_offsets, get_offsets(n_trips)
+    )
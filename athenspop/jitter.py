@@ -0,0 +1,244 @@
+"""
+Vectorized activity time jitter and 24-hour cropping of population plans.
+
+Mirrors PAM's `apply_jitter_to_plan` and `Plan.crop`, applied to the activity and leg
+    time arrays of a population store, in chunks of persons.
+"""
+from datetime import timedelta
+from typing import Optional
+import numpy as np
+from athenspop.population import PopulationStore, get_offsets, expand_ranges
+
+MICROSECONDS = 10**6
+END_OF_DAY = 24 * 3600 * MICROSECONDS
+
+
+def to_padded(values: np.ndarray, offsets: np.ndarray, width: int, fill=0) -> np.ndarray:
+    """
+    Convert a flat array of grouped values to a padded (n_groups x width) array
+    """
+    lengths = np.diff(offsets)
+    padded = np.full((len(lengths), width), fill, dtype=values.dtype)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(len(values)) - np.repeat(offsets[:-1], lengths)
+    padded[rows, cols] = values
+    return padded
+
+
+def divide_and_round(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Integer division a / b, rounded half to even (as python's timedelta division)
+    """
+    q, r = np.divmod(a, b)
+    r = r * 2
+    return q + ((r > b) | ((r == b) & (q % 2 == 1)))
+
+
+def jitter_plans(
+    act_start: np.ndarray,
+    act_end: np.ndarray,
+    leg_start: np.ndarray,
+    leg_end: np.ndarray,
+    n_acts: np.ndarray,
+    jitter: int,
+    min_duration: int,
+    draws: np.ndarray
+) -> None:
+    """
+    Apply time jitter to activity durations (in place), keeping leg durations the same.
+    Activities are jittered in sequence order, and the durations of the subsequent activities
+        change equally to maintain a 24-hour plan (see pam.samplers.time.jitter_activity).
+    Times are expressed in microseconds since the start of the day.
+
+    :param act_start: activity start times, padded (n_persons x max activities)
+    :param act_end: activity end times, padded (n_persons x max activities)
+    :param leg_start: leg start times, padded (n_persons x max activities - 1)
+    :param leg_end: leg end times, padded (n_persons x max activities - 1)
+    :param n_acts: number of activities of each person
+    :param jitter: maximum jitter (microseconds)
+    :param min_duration: minimum activity duration (microseconds)
+    :param draws: uniform random numbers in [0, 1), padded (n_persons x max activities),
+        used to sample the jitter of each activity
+    """
+    persons = np.arange(len(n_acts))
+    plan_length = 2 * n_acts - 1
+
+    for k in range(act_start.shape[1] - 1):
+        idx = persons[n_acts - 2 >= k]
+        if len(idx) == 0:
+            break
+        start, end = act_start[idx, k], act_end[idx, k]
+        last_end = act_end[idx, n_acts[idx]-1]
+
+        min_end = np.maximum(start + min_duration, end - jitter)
+        max_end = np.minimum(last_end + min_duration, end + jitter)
+        # jitter range, in seconds (timedelta.seconds of the range)
+        jitter_range = np.maximum(((max_end - min_end) // MICROSECONDS) % 86400, 1)
+
+        offset = (draws[idx, k] * jitter_range).astype(np.int64)
+        new_duration = min_end - start + offset * MICROSECONDS
+        change = divide_and_round(
+            2 * (new_duration - (end - start)), plan_length[idx] - 2 * k
+        )
+
+        # shift the activity end, the following legs, and the tail activities
+        time = start + new_duration
+        act_end[idx, k] = time
+        for j in range(k, act_start.shape[1] - 1):
+            is_tail = n_acts[idx] - 2 >= j
+            idx, time, change = idx[is_tail], time[is_tail], change[is_tail]
+            if len(idx) == 0:
+                break
+            leg_duration = leg_end[idx, j] - leg_start[idx, j]
+            leg_start[idx, j] = time
+            leg_end[idx, j] = time = time + leg_duration
+
+            # the final activity ends at the end of the day
+            is_final = n_acts[idx] - 1 == j + 1
+            act_duration = act_end[idx, j+1] - act_start[idx, j+1]
+            act_start[idx, j+1] = time
+            act_end[idx, j+1] = time = np.where(
+                is_final, END_OF_DAY, time + act_duration - change
+            )
+
+
+def crop_plans(
+    act_start: np.ndarray,
+    act_end: np.ndarray,
+    leg_start: np.ndarray,
+    leg_end: np.ndarray,
+    n_acts: np.ndarray
+) -> np.ndarray:
+    """
+    Crop plans to the end of the day (see pam.Plan.crop):
+        components that start after the end of the day are removed,
+        plans are cut at the first component that is out of sequence,
+        and plans ending with a leg drop that leg.
+        The last activity ends at the end of the day.
+    Times are expressed in microseconds since the start of the day.
+
+    :return: the number of activities of each (cropped) plan
+    """
+    n, width = act_start.shape
+    # interleave activities and legs
+    starts = np.zeros((n, 2*width - 1), dtype=act_start.dtype)
+    ends = np.zeros((n, 2*width - 1), dtype=act_start.dtype)
+    starts[:, 0::2], ends[:, 0::2] = act_start, act_end
+    starts[:, 1::2], ends[:, 1::2] = leg_start, leg_end
+    position = np.arange(2*width - 1)
+    plan_length = 2 * n_acts - 1
+
+    # remove trailing components that start after the end of the day
+    valid = (position < plan_length[:, None]) & (starts <= END_OF_DAY)
+    valid[:, 0] = True
+    plan_length = (2*width - 1) - np.argmax(valid[:, ::-1], axis=1)
+
+    # cut at the first component out of sequence
+    starts_before_previous = np.zeros_like(valid)
+    starts_before_previous[:, 1:] = starts[:, 1:] < ends[:, :-1]
+    starts_after_end = starts > ends
+    starts_after_end[:, 0] = False
+    out_of_sequence = (starts_before_previous | starts_after_end) & \
+        (position < plan_length[:, None])
+    has_cut = out_of_sequence.any(axis=1)
+    cut = np.argmax(out_of_sequence, axis=1)
+    cut_length = np.where(starts_before_previous[np.arange(n), cut], cut, cut + 1)
+    plan_length = np.where(has_cut, cut_length, plan_length)
+
+    # drop a trailing leg, and end the last activity at the end of the day
+    n_acts = (plan_length + 1) // 2
+    act_end[np.arange(n), n_acts-1] = END_OF_DAY
+
+    return n_acts
+
+
+def jitter_store(
+    store: PopulationStore,
+    jitter: timedelta = timedelta(minutes=30),
+    min_duration: timedelta = timedelta(minutes=10),
+    crop: bool = True,
+    seed: Optional[int] = None,
+    chunk_size: int = 100000
+) -> PopulationStore:
+    """
+    Apply time jitter (so that not all activities start at xx:00:00)
+        and crop to 24-hours the plans of a population store.
+    Persons are processed in chunks of `chunk_size`, using padded time arrays.
+    Random draws are made once for all activities, so results do not depend on the chunk size.
+
+    :param store: population store
+    :param jitter: maximum activity time jitter
+    :param min_duration: minimum activity duration after jittering
+    :param crop: whether to crop the plans to 24-hours
+    :param seed: random seed (or generator), for reproducible results
+    :param chunk_size: number of persons processed together
+    :return: a new population store, with the jittered (and cropped) plans
+    """
+    rng = np.random.default_rng(seed)
+    jitter = int(jitter.total_seconds() * MICROSECONDS)
+    min_duration = int(min_duration.total_seconds() * MICROSECONDS)
+
+    uniform = rng.random(len(store.activities))
+
+    act_times, leg_times, n_acts_cropped = [], [], []
+    for p0 in range(0, len(store), chunk_size):
+        p1 = min(p0 + chunk_size, len(store))
+        act_offsets = store.act_offsets[p0:p1+1]
+        leg_offsets = store.leg_offsets[p0:p1+1]
+        n_acts = np.diff(act_offsets)
+        width = max(n_acts.max(initial=1), 2)
+        acts = store.activities.iloc[act_offsets[0]:act_offsets[-1]]
+        legs = store.legs.iloc[leg_offsets[0]:leg_offsets[-1]]
+        draws = to_padded(
+            uniform[act_offsets[0]:act_offsets[-1]], act_offsets - act_offsets[0], width
+        )
+
+        times = []
+        for values, offsets, w in [
+            (acts.start, act_offsets, width), (acts.end, act_offsets, width),
+            (legs.start, leg_offsets, width-1), (legs.end, leg_offsets, width-1)
+        ]:
+            times.append(to_padded(
+                values.values.astype(np.int64) * MICROSECONDS,
+                offsets - offsets[0],
+                w
+            ))
+        act_start, act_end, leg_start, leg_end = times
+
+        jitter_plans(
+            act_start, act_end, leg_start, leg_end, n_acts,
+            jitter=jitter, min_duration=min_duration, draws=draws
+        )
+        if crop:
+            n_acts = crop_plans(act_start, act_end, leg_start, leg_end, n_acts)
+
+        # back to flat arrays, as seconds since the start of the day
+        act_mask = np.arange(width) < n_acts[:, None]
+        leg_mask = np.arange(width-1) < (n_acts - 1)[:, None]
+        act_times.append(
+            np.stack([act_start[act_mask], act_end[act_mask]], axis=1) // MICROSECONDS
+        )
+        leg_times.append(
+            np.stack([leg_start[leg_mask], leg_end[leg_mask]], axis=1) // MICROSECONDS
+        )
+        n_acts_cropped.append(n_acts)
+
+    # keep the (cropped) activities and legs
+    n_acts = np.concatenate(n_acts_cropped)
+    n_legs = np.maximum(n_acts - 1, 0)
+    act_index = expand_ranges(store.act_offsets[:-1], store.act_offsets[:-1] + n_acts)
+    leg_index = expand_ranges(store.leg_offsets[:-1], store.leg_offsets[:-1] + n_legs)
+    activities = store.activities.take(act_index).reset_index(drop=True)
+    legs = store.legs.take(leg_index).reset_index(drop=True)
+    activities[['start', 'end']] = np.concatenate(act_times).astype(np.int32)
+    legs[['start', 'end']] = np.concatenate(leg_times).astype(np.int32)
+
+    return PopulationStore(
+        households=store.households,
+        persons=store.persons,
+        activities=activities,
+        legs=legs,
+        person_offsets=store.person_offsets,
+        act_offsets=get_offsets(n_acts),
+        leg_offsets=get_offsets(n_legs)
+    )
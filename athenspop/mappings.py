@@ -47,6 +47,13 @@ purpose = {
     '7: other': 'other',
 }
 
+# facility (land use) activity used for each population activity,
+#   when there is no facility type of the same name
+facility_activity = {
+    'recreation': 'other',
+    'service': 'other',
+}
+
 income = {
     '0: no income': 'zero',
     '1: 750 or less': 'low',
@@ -116,3 +123,21 @@ zones = {
     35: 'Χαλάνδρι - Αγ. Παρασκευή - Γερακας - Παλλήνη',
     36: 'Εκτός Αττικής',
 }
+
+# survey zones missing from the zones shapefile, and the zone used instead:
+#   zone 29 (Papagou-Cholargos) -> zone 35
+#   (Chalandri, Agia Paraskeyi, Gerakas, Cholargos, Papagou, ...)
+zone_remap = {
+    29: 35,
+}
+
+# person attributes derived from the survey: attribute -> (survey column, label mapping)
+person_attributes = {
+    'gender': ('gender', gender),
+    'education': ('education', education),
+    'employment': ('employment', employment),
+    'income_all': ('income', income_all_categories),
+    'income': ('income', income),
+    'car_own': ('car_own', car_own),
+    'age_group': ('age', age_group),
+}
@@ -0,0 +1,182 @@
+"""
+Sharded (multi-process) processing of synthetic populations
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional
+import numpy as np
+from athenspop import parquet, spatial
+from athenspop.jitter import jitter_store
+from athenspop.population import PopulationStore, WeightedPopulation
+from athenspop.writer import serialize_households
+
+# population store of the current (worker) process
+_store = None
+# weighted population and location sampler of the current (worker) process
+_weighted = None
+
+
+def iter_shard_seeds(seed: Optional[int] = None) -> Iterator[int]:
+    """
+    Get a deterministic random seed for each shard.
+    Seeds only depend on the shard position,
+        so results do not change with the number of workers.
+    """
+    seed_sequence = np.random.SeedSequence(seed)
+    while True:
+        yield int(seed_sequence.spawn(1)[0].generate_state(1)[0])
+
+
+def init_store(store: PopulationStore) -> None:
+    """
+    Set the population store of the current (worker) process,
+        so that it is sent to each worker once (rather than with every shard).
+    """
+    global _store
+    _store = store
+
+
+def serialize_store_shard(start: int, stop: int, **kwargs) -> tuple:
+    """
+    Serialize the households of positions [start, stop) of the worker's population store
+        (see athenspop.writer.serialize_households)
+    """
+    return serialize_households(_store.slice_to_pam(start, stop), **kwargs)
+
+
+def iter_serialized_shards(
+    store: PopulationStore,
+    n_workers: int = 1,
+    shard_size: int = 1000,
+    **kwargs
+) -> Iterator[tuple]:
+    """
+    Convert shards of a population store to PAM households and serialize them
+        (MATSim plans and csv records) in a pool of worker processes.
+        Serialized shards are yielded in their input order,
+        with at most 2 * `n_workers` shards held in memory at any time.
+
+    :param store: population store
+    :param n_workers: Number of worker processes.
+        If 1, shards are serialized in the current process.
+    :param shard_size: Number of households in each shard
+    :param kwargs: Keyword arguments passed to `serialize_households`
+    """
+    bounds = [
+        (start, min(start + shard_size, store.n_households))
+        for start in range(0, store.n_households, shard_size)
+    ]
+
+    if n_workers == 1:
+        for start, stop in bounds:
+            yield serialize_households(store.slice_to_pam(start, stop), **kwargs)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=init_store,
+        initargs=(store,)
+    ) as executor:
+        pending = deque()
+        for start, stop in bounds:
+            pending.append(executor.submit(serialize_store_shard, start, stop, **kwargs))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def init_weighted(population: Optional[WeightedPopulation], location_sampler=None) -> None:
+    """
+    Set the weighted population and location sampler of the current (worker) process,
+        so that they are sent to each worker once (rather than with every shard).
+    """
+    global _weighted
+    _weighted = None if population is None else (population, location_sampler)
+
+
+def process_weighted_shard(
+    start: int,
+    stop: int,
+    seed: int,
+    part: int = 0,
+    path_parquet: Optional[str] = None,
+    write_plans: bool = True,
+    **kwargs
+) -> Optional[tuple]:
+    """
+    Expand the survey households of positions [start, stop) of the worker's weighted population,
+        apply time jitter (cropping to 24-hours) and sample the activity locations.
+        The expanded households are written as a Parquet part file (if `path_parquet` is set),
+        and serialized (see athenspop.writer.serialize_households) if `write_plans`.
+
+    :param seed: Random seed of the shard
+    :param part: Parquet part number of the shard
+    :param kwargs: Keyword arguments passed to `serialize_households`
+    """
+    population, location_sampler = _weighted
+    rng = np.random.default_rng(seed)
+    store = population.expand(start, stop)
+    store = jitter_store(store, seed=rng)
+    store = spatial.sample_locations(store, location_sampler, seed=rng)
+
+    if path_parquet is not None:
+        parquet.write_parquet_part(store, path_parquet, part)
+    if write_plans:
+        return serialize_households(store.slice_to_pam(0, store.n_households), **kwargs)
+    return None
+
+
+def iter_weighted_shards(
+    population: WeightedPopulation,
+    location_sampler,
+    n_workers: int = 1,
+    shard_size: int = 1000,
+    seed: Optional[int] = None,
+    **kwargs
+) -> Iterator[Optional[tuple]]:
+    """
+    Expand a weighted population shard by shard, applying time jitter and sampling
+        the activity locations of each shard, in a pool of worker processes
+        (see `process_weighted_shard`).
+        Serialized shards are yielded in their input order,
+        with at most 2 * `n_workers` shards held in memory at any time.
+
+    :param population: weighted population
+    :param location_sampler: activity location sampler (see athenspop.core.get_location_sampler)
+    :param n_workers: Number of worker processes.
+        If 1, shards are processed in the current process.
+    :param shard_size: Number of (expanded) households in each shard
+    :param seed: Random seed, used to derive the seed of each shard
+    :param kwargs: Keyword arguments passed to `process_weighted_shard`
+    """
+    shards = [
+        (start, stop, shard_seed, part)
+        for part, ((start, stop), shard_seed) in enumerate(
+            zip(population.get_shards(shard_size), iter_shard_seeds(seed))
+        )
+    ]
+
+    if n_workers == 1:
+        init_weighted(population, location_sampler)
+        try:
+            for start, stop, shard_seed, part in shards:
+                yield process_weighted_shard(start, stop, shard_seed, part=part, **kwargs)
+        finally:
+            init_weighted(None)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=init_weighted,
+        initargs=(population, location_sampler)
+    ) as executor:
+        pending = deque()
+        for start, stop, shard_seed, part in shards:
+            pending.append(executor.submit(
+                process_weighted_shard, start, stop, shard_seed, part=part, **kwargs
+            ))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
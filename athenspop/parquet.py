@@ -0,0 +1,160 @@
+"""
+Columnar (Parquet/GeoParquet) export of synthetic populations.
+
+The households, persons, activities and legs tables of a population store are written
+    as partitioned Parquet datasets (one directory of part files per table).
+    Labels are dictionary-encoded (categoricals), and activity locations are written
+    as GeoParquet point geometries.
+"""
+import os
+import shutil
+from typing import Optional
+import geopandas as gp
+import numpy as np
+import pandas as pd
+from athenspop.population import PopulationStore, get_ids
+
+TABLES = ['households', 'persons', 'activities', 'legs']
+
+
+def get_sequence(offsets: np.ndarray) -> np.ndarray:
+    """
+    Position of each row within its group (ie the activity sequence of each person)
+    """
+    lengths = np.diff(offsets)
+    return (np.arange(offsets[-1] - offsets[0]) - np.repeat(offsets[:-1] - offsets[0], lengths)).astype(np.int16)
+
+
+def get_group_ids(ids: pd.Series, offsets: np.ndarray) -> pd.Categorical:
+    """
+    Repeat the id of each group for the rows of the group, as a (dictionary-encoded) categorical
+    """
+    codes = np.repeat(np.arange(len(ids), dtype=np.int32), np.diff(offsets))
+    return pd.Categorical.from_codes(codes, categories=pd.Index(ids.values))
+
+
+def store_to_tables(store: PopulationStore, crs=2100) -> dict:
+    """
+    Get the households, persons, activities and legs tables of a population store,
+        with unique household and person ids (f"{id}-{clone}").
+        Times are expressed in seconds since the start of the day.
+
+    :param store: population store
+    :param crs: coordinate reference system of the activity locations
+    :return: a dictionary of (Geo)DataFrames
+    """
+    hids = store.get_hids()
+    pids = store.get_pids()
+    persons_hid = get_group_ids(hids, store.person_offsets)
+
+    households = store.households.drop(columns=['hid', 'clone'])
+    households.insert(0, 'hid', hids.values)
+
+    persons = store.persons.drop(columns=['hid', 'pid', 'clone'])
+    persons.insert(0, 'pid', pids.values)
+    persons.insert(1, 'hid', persons_hid)
+
+    activities = store.activities.copy()
+    activities.insert(0, 'pid', get_group_ids(pids, store.act_offsets))
+    activities.insert(1, 'hid', persons_hid[np.repeat(np.arange(len(pids)), np.diff(store.act_offsets))])
+    activities.insert(2, 'seq', get_sequence(store.act_offsets))
+    missing = activities['x'].isna().values
+    geometry = gp.points_from_xy(activities['x'], activities['y'], crs=crs)
+    geometry[missing] = None
+    activities = gp.GeoDataFrame(activities, geometry=geometry)
+
+    legs = store.legs.copy()
+    legs.insert(0, 'pid', get_group_ids(pids, store.leg_offsets))
+    legs.insert(1, 'hid', persons_hid[np.repeat(np.arange(len(pids)), np.diff(store.leg_offsets))])
+    legs.insert(2, 'seq', get_sequence(store.leg_offsets))
+
+    return {
+        'households': households,
+        'persons': persons,
+        'activities': activities,
+        'legs': legs,
+    }
+
+
+def clear_parquet(path: str) -> None:
+    """
+    Remove the table directories of a previous export to the same path,
+        so that stale part files are not read as part of the new population.
+    """
+    for table in TABLES:
+        shutil.rmtree(os.path.join(path, table), ignore_errors=True)
+
+
+def write_parquet(
+    store: PopulationStore,
+    path: str,
+    households_per_part: int = 100000,
+    crs=2100,
+    compression: str = 'snappy'
+) -> None:
+    """
+    Write a population store as partitioned Parquet datasets:
+        path/households, path/persons, path/activities (GeoParquet) and path/legs,
+        each split in part files of `households_per_part` households.
+
+    :param store: population store
+    :param path: output directory
+    :param households_per_part: number of households in each part file
+    :param crs: coordinate reference system of the activity locations
+    :param compression: parquet compression codec
+    """
+    clear_parquet(path)
+    for part, start in enumerate(range(0, store.n_households, households_per_part)):
+        stop = min(start + households_per_part, store.n_households)
+        write_parquet_part(
+            store.take(np.arange(start, stop)), path, part, crs=crs, compression=compression
+        )
+
+
+def write_parquet_part(
+    store: PopulationStore,
+    path: str,
+    part: int,
+    crs=2100,
+    compression: str = 'snappy'
+) -> None:
+    """
+    Write a population store as one part file of each table (path/<table>/part-<part>.parquet),
+        ie for populations that are generated in shards.
+        Existing table directories should be cleared (see `clear_parquet`) before writing the first part.
+
+    :param store: population store (of the part's households)
+    :param path: output directory
+    :param part: part number
+    :param crs: coordinate reference system of the activity locations
+    :param compression: parquet compression codec
+    """
+    for table, df in store_to_tables(store, crs=crs).items():
+        os.makedirs(os.path.join(path, table), exist_ok=True)
+        df.to_parquet(
+            os.path.join(path, table, f'part-{part:05}.parquet'),
+            index=False,
+            compression=compression
+        )
+
+
+def read_parquet(
+    path: str,
+    table: str,
+    columns: Optional[list] = None
+) -> pd.DataFrame:
+    """
+    Read a population table written by `write_parquet`.
+        Only the selected columns are read from disk.
+
+    :param path: population output directory
+    :param table: one of 'households', 'persons', 'activities' or 'legs'
+    :param columns: columns to read (all if None).
+        Activities are read as a GeoDataFrame if the 'geometry' column is selected.
+    """
+    if table not in TABLES:
+        raise ValueError(f'Unknown table: {table}. Options are: {TABLES}')
+    path_table = os.path.join(path, table)
+    if table == 'activities' and (columns is None or 'geometry' in columns):
+        return gp.read_parquet(path_table, columns=columns)
+    return pd.read_parquet(path_table, columns=columns)
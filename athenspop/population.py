@@ -0,0 +1,446 @@
+"""
+Compact (array-backed) synthetic population representation.
+"""
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Iterator, Optional
+import numpy as np
+import pandas as pd
+from athenspop.preprocessing import downcast_integers
+from shapely.geometry import Point
+
+if TYPE_CHECKING:
+    from pam.core import Household, Population
+
+START_OF_DAY = datetime(1900, 1, 1)
+
+
+def get_offsets(lengths: np.ndarray) -> np.ndarray:
+    """
+    Get the offsets of consecutive groups of rows, from the group lengths
+    """
+    return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+def expand_ranges(starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """
+    Concatenate the ranges [start, stop), ie:
+        np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)])
+    """
+    lengths = stops - starts
+    group_starts = get_offsets(lengths)[:-1]
+    return np.arange(lengths.sum()) + np.repeat(starts - group_starts, lengths)
+
+
+def compact_tables(
+    households: pd.DataFrame,
+    persons: pd.DataFrame,
+    activities: pd.DataFrame,
+    legs: pd.DataFrame
+) -> None:
+    """
+    Store the population tables with compact dtypes (in place):
+        labels as categoricals, zones as the smallest integer type that fits them,
+        and times as 32-bit integers.
+    """
+    for df in [households, persons]:
+        for col in ['hid', 'pid']:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+    for col in persons.columns[3:]:
+        if isinstance(persons[col].dtype, pd.CategoricalDtype):
+            # categories of the used labels only, in sorted order
+            persons[col] = persons[col].astype(object).infer_objects()
+        if persons[col].dtype == object:
+            persons[col] = persons[col].astype('category')
+        elif pd.api.types.is_integer_dtype(persons[col]):
+            downcast_integers(persons, [col])
+    for df, cols in [(activities, ['act']), (legs, ['purp', 'mode'])]:
+        df[cols] = df[cols].astype('category')
+    for df in [activities, legs]:
+        df[['start', 'end']] = df[['start', 'end']].astype(np.int32)
+    downcast_integers(households, ['hzone'])
+    downcast_integers(activities, ['zone'])
+    downcast_integers(legs, ['ozone', 'dzone'])
+
+
+def get_ids(ids: pd.Series, clone: np.ndarray) -> pd.Series:
+    """
+    Get unique ids of (cloned) households or persons, ie f"{id}-{clone}".
+    Records with a negative clone number keep their original id.
+    """
+    ids = ids.astype(str)
+    cloned = clone >= 0
+    ids[cloned] = ids[cloned] + '-' + clone[cloned].astype(str)
+    return ids
+
+
+class PopulationStore:
+    """
+    A synthetic population, stored as a struct of arrays:
+        - households: one row per household (hid, hzone, freq, clone)
+        - persons: one row per person (hid, pid, clone, freq and the person attributes),
+            ordered by household
+        - activities: one row per activity (act, zone, start, end, x, y),
+            ordered by person and sequence
+        - legs: one row per leg (purp, mode, ozone, dzone, start, end),
+            ordered by person and sequence
+
+    The persons of household i are persons[person_offsets[i]:person_offsets[i+1]],
+        and the activities and legs of person j are
+        activities[act_offsets[j]:act_offsets[j+1]] and legs[leg_offsets[j]:leg_offsets[j+1]].
+    Times are stored as seconds since the start of the day.
+
+    Households and persons are identified by their survey id and a clone number,
+        so that upscaling is a replication of row indices.
+        PAM objects are only created when needed (see `iter_households` and `to_pam`).
+    """
+
+    def __init__(
+        self,
+        households: pd.DataFrame,
+        persons: pd.DataFrame,
+        activities: pd.DataFrame,
+        legs: pd.DataFrame,
+        person_offsets: np.ndarray,
+        act_offsets: np.ndarray,
+        leg_offsets: np.ndarray
+    ):
+        self.households = households
+        self.persons = persons
+        self.activities = activities
+        self.legs = legs
+        self.person_offsets = person_offsets
+        self.act_offsets = act_offsets
+        self.leg_offsets = leg_offsets
+
+    @property
+    def n_households(self) -> int:
+        return len(self.households)
+
+    def __len__(self) -> int:
+        return len(self.persons)
+
+    def __repr__(self) -> str:
+        return f'PopulationStore: {len(self)} people in {self.n_households} households.'
+
+    def memory_usage(self) -> int:
+        """
+        Total memory usage (bytes)
+        """
+        tables = [self.households, self.persons, self.activities, self.legs]
+        offsets = [self.person_offsets, self.act_offsets, self.leg_offsets]
+        return int(
+            sum(x.memory_usage(index=True, deep=True).sum() for x in tables) +
+            sum(x.nbytes for x in offsets)
+        )
+
+    @classmethod
+    def from_population(cls, population: 'Population'):
+        """
+        Create a population store from a PAM population.
+
+        :param population: PAM population
+        """
+        from pam.activity import Activity, Leg
+
+        households, persons, activities, legs = [], [], [], []
+        n_persons, n_acts, n_legs = [], [], []
+        for hid, household in population.households.items():
+            households.append({
+                'hid': hid, 'hzone': household.location.area, 'freq': household.freq
+            })
+            n_persons.append(len(household.people))
+            for pid, person in household.people.items():
+                attributes = {
+                    k: v for k, v in person.attributes.items() if k not in ['hid', 'pid']
+                }
+                persons.append({'hid': hid, 'pid': pid, 'freq': person.freq, **attributes})
+                n_acts.append(0)
+                n_legs.append(0)
+                for component in person.plan:
+                    if isinstance(component, Activity):
+                        loc = component.location.loc
+                        activities.append((
+                            component.act,
+                            component.location.area,
+                            (component.start_time - START_OF_DAY).total_seconds(),
+                            (component.end_time - START_OF_DAY).total_seconds(),
+                            loc.x if loc is not None else np.nan,
+                            loc.y if loc is not None else np.nan,
+                        ))
+                        n_acts[-1] += 1
+                    elif isinstance(component, Leg):
+                        legs.append((
+                            component.purp,
+                            component.mode,
+                            component.start_location.area,
+                            component.end_location.area,
+                            (component.start_time - START_OF_DAY).total_seconds(),
+                            (component.end_time - START_OF_DAY).total_seconds(),
+                        ))
+                        n_legs[-1] += 1
+
+        households = pd.DataFrame(households)
+        households['freq'] = households['freq'].astype(float)
+        persons = pd.DataFrame(persons)
+        activities = pd.DataFrame(
+            activities, columns=['act', 'zone', 'start', 'end', 'x', 'y']
+        )
+        legs = pd.DataFrame(
+            legs, columns=['purp', 'mode', 'ozone', 'dzone', 'start', 'end']
+        )
+        households['clone'] = np.int32(-1)
+        persons.insert(2, 'clone', np.int32(-1))
+        compact_tables(households, persons, activities, legs)
+
+        return cls(
+            households=households,
+            persons=persons,
+            activities=activities,
+            legs=legs,
+            person_offsets=get_offsets(n_persons),
+            act_offsets=get_offsets(n_acts),
+            leg_offsets=get_offsets(n_legs)
+        )
+
+    @classmethod
+    def from_trips(cls, trips: pd.DataFrame, persons_attributes: pd.DataFrame):
+        """
+        Create a population store directly from the survey trips and person attributes tables,
+            without building a PAM population (see `athenspop.diary.build_tables`).
+            The result is the same as converting the population of PAM's
+            tour-based travel diary reader (`pam.read.load_travel_diary`).
+
+        :param trips: trips table (pid, seq, ozone, dzone, purp, mode, tst, tet)
+        :param persons_attributes: person attributes table (pid, hzone and any attributes)
+        """
+        from athenspop.diary import build_tables
+
+        households, persons, activities, legs, offsets = build_tables(trips, persons_attributes)
+        compact_tables(households, persons, activities, legs)
+        return cls(households, persons, activities, legs, *offsets)
+
+    def take(self, hh_index: np.ndarray):
+        """
+        Create a new store from a selection of households.
+            Households can be selected multiple times.
+
+        :param hh_index: positional index of the selected households
+        """
+        hh_index = np.asarray(hh_index, dtype=np.int64)
+        person_index = expand_ranges(
+            self.person_offsets[hh_index], self.person_offsets[hh_index+1]
+        )
+        act_index = expand_ranges(
+            self.act_offsets[person_index], self.act_offsets[person_index+1]
+        )
+        leg_index = expand_ranges(
+            self.leg_offsets[person_index], self.leg_offsets[person_index+1]
+        )
+
+        return PopulationStore(
+            households=self.households.take(hh_index).reset_index(drop=True),
+            persons=self.persons.take(person_index).reset_index(drop=True),
+            activities=self.activities.take(act_index).reset_index(drop=True),
+            legs=self.legs.take(leg_index).reset_index(drop=True),
+            person_offsets=get_offsets(np.diff(self.person_offsets)[hh_index]),
+            act_offsets=get_offsets(np.diff(self.act_offsets)[person_index]),
+            leg_offsets=get_offsets(np.diff(self.leg_offsets)[person_index])
+        )
+
+    def repeat(self, counts: np.ndarray):
+        """
+        Upscale the population, by replicating each household `counts` times.
+            Replicated households and persons are numbered,
+            so that their ids become f"{hid}-{n}" and f"{pid}-{n}".
+
+        :param counts: number of replications of each household
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        hh_index = np.repeat(np.arange(self.n_households), counts)
+        store = self.take(hh_index)
+
+        clone = (
+            np.arange(len(hh_index)) - np.repeat(get_offsets(counts)[:-1], counts)
+        ).astype(np.int32)
+        store.households['clone'] = clone
+        store.persons['clone'] = np.repeat(clone, np.diff(store.person_offsets))
+
+        return store
+
+    def get_hids(self) -> pd.Series:
+        """
+        Household ids
+        """
+        return get_ids(self.households.hid, self.households.clone.values)
+
+    def get_pids(self) -> pd.Series:
+        """
+        Person ids
+        """
+        return get_ids(self.persons.pid, self.persons.clone.values)
+
+    def iter_batches(self, batch_size: int = 1000) -> Iterator[list]:
+        """
+        Lazily create PAM households, yielding lists of (up to) `batch_size` households.
+        """
+        for start in range(0, self.n_households, batch_size):
+            yield self.slice_to_pam(start, min(start + batch_size, self.n_households))
+
+    def iter_households(self, batch_size: int = 1000) -> Iterator['Household']:
+        """
+        Lazily create PAM households, converting `batch_size` households at a time.
+        """
+        for households in self.iter_batches(batch_size):
+            yield from households
+
+    def slice_to_pam(self, start: int, stop: int) -> list:
+        """
+        Create the PAM households of positions [start, stop)
+        """
+        from pam.activity import Activity, Leg
+        from pam.core import Household, Person
+
+        p0, p1 = self.person_offsets[start], self.person_offsets[stop]
+        a0, a1 = self.act_offsets[p0], self.act_offsets[p1]
+        l0, l1 = self.leg_offsets[p0], self.leg_offsets[p1]
+
+        households = self.households.iloc[start:stop]
+        hids = get_ids(households.hid, households.clone.values).tolist()
+        hzones = households.hzone.tolist()
+
+        persons = self.persons.iloc[p0:p1]
+        pids = get_ids(persons.pid, persons.clone.values).tolist()
+        freqs = persons.freq.tolist()
+        attribute_names = list(persons.columns[4:])
+        attributes = list(zip(*[persons[col].tolist() for col in attribute_names]))
+
+        acts = self.activities.iloc[a0:a1]
+        acts = list(zip(
+            acts.act.tolist(), acts.zone.tolist(),
+            acts.start.tolist(), acts.end.tolist(),
+            acts.x.tolist(), acts.y.tolist()
+        ))
+        legs = self.legs.iloc[l0:l1]
+        legs = list(zip(
+            legs['purp'].tolist(), legs['mode'].tolist(),
+            legs.ozone.tolist(), legs.dzone.tolist(),
+            legs.start.tolist(), legs.end.tolist()
+        ))
+
+        output = []
+        for i, (hid, hzone) in enumerate(zip(hids, hzones)):
+            household = Household(hid, area=hzone)
+            for j in range(self.person_offsets[start+i] - p0, self.person_offsets[start+i+1] - p0):
+                person_attributes = {**dict(zip(attribute_names, attributes[j])), 'hid': hid}
+                person = Person(
+                    pids[j],
+                    attributes=person_attributes,
+                    home_area=hzone,
+                    freq=freqs[j]
+                )
+                person_acts = acts[self.act_offsets[p0+j]-a0:self.act_offsets[p0+j+1]-a0]
+                person_legs = legs[self.leg_offsets[p0+j]-l0:self.leg_offsets[p0+j+1]-l0]
+                for seq, (act, zone, tst, tet, x, y) in enumerate(person_acts):
+                    if seq > 0:
+                        purp, mode, ozone, dzone, leg_tst, leg_tet = person_legs[seq-1]
+                        person.add(Leg(
+                            seq=seq-1,
+                            purp=purp,
+                            mode=mode,
+                            start_area=ozone,
+                            end_area=dzone,
+                            start_loc=person.plan[-1].location.loc,
+                            end_loc=to_point(x, y),
+                            start_time=START_OF_DAY + timedelta(seconds=leg_tst),
+                            end_time=START_OF_DAY + timedelta(seconds=leg_tet),
+                            freq=freqs[j]
+                        ))
+                    person.add(Activity(
+                        seq=seq,
+                        act=act,
+                        area=zone,
+                        loc=to_point(x, y),
+                        start_time=START_OF_DAY + timedelta(seconds=tst),
+                        end_time=START_OF_DAY + timedelta(seconds=tet)
+                    ))
+                household.add(person)
+            output.append(household)
+
+        return output
+
+    def to_pam(self) -> 'Population':
+        """
+        Convert to a PAM population
+        """
+        from pam.core import Population
+
+        population = Population()
+        for household in self.iter_households():
+            population.add(household)
+        return population
+
+
+class WeightedPopulation:
+    """
+    A synthetic population, stored as the survey households with an expansion count:
+        survey household i stands for counts[i] synthetic households with the same plan.
+
+    Synthetic households are only created (cloned) when needed,
+        for a range of survey households at a time (see `expand` and `get_shards`),
+        so that memory scales with the survey rather than with the synthetic population.
+        Expanded households and persons get the same ids as `PopulationStore.repeat`.
+    """
+
+    def __init__(self, store: PopulationStore, counts: np.ndarray):
+        """
+        :param store: population store of the survey households
+        :param counts: expansion count of each survey household
+        """
+        self.store = store
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    @property
+    def n_households(self) -> int:
+        return int(self.counts.sum())
+
+    def __len__(self) -> int:
+        return int((self.counts * np.diff(self.store.person_offsets)).sum())
+
+    def __repr__(self) -> str:
+        return (
+            f'WeightedPopulation: {len(self)} people in {self.n_households} households '
+            f'(expanded from {self.store.n_households} survey households).'
+        )
+
+    def expand(self, start: int = 0, stop: Optional[int] = None) -> PopulationStore:
+        """
+        Clone the survey households of positions [start, stop) into synthetic households
+
+        :param start: position of the first survey household
+        :param stop: position after the last survey household (defaults to the last household)
+        """
+        if stop is None:
+            stop = self.store.n_households
+        return self.store.take(np.arange(start, stop)).repeat(self.counts[start:stop])
+
+    def get_shards(self, shard_size: int = 1000) -> list:
+        """
+        Split the survey households in ranges [start, stop)
+            that expand to about `shard_size` synthetic households each.
+        """
+        if self.store.n_households == 0:
+            return []
+        shard = (np.cumsum(self.counts) - self.counts) // shard_size
+        starts = np.flatnonzero(np.diff(shard, prepend=-1))
+        stops = np.append(starts[1:], self.store.n_households)
+        return list(zip(starts.tolist(), stops.tolist()))
+
+
+def to_point(x: float, y: float):
+    """
+    Get a shapely point, or None if the coordinates are missing
+    """
+    if np.isnan(x):
+        return None
+    return Point(x, y)
@@ -1,41 +1,317 @@
+import os
 import pandas as pd
 from athenspop import mappings
 import numpy as np
 import geopandas as gp
 from shapely.geometry import box
 from . import mappings
-import random
+from typing import Optional
 
 person_attribute_cols = [
     'gender', 'age', 'education', 'employment', 'income',
     'car_own', 'home', 'infilled']
 
+# known labels of the survey label columns
+survey_labels = {
+    'gender': list(mappings.gender),
+    'education': list(mappings.education),
+    'employment': list(mappings.employment),
+    'income': list(mappings.income),
+    'car_own': list(mappings.car_own),
+    **{f'purp{i}': list(mappings.purpose) for i in range(1, 6)},
+    **{f'mode{i}': list(mappings.modes) for i in range(1, 6)},
+}
+
+# explicit column types of the (wide) travel diary file:
+#   survey labels are read as categoricals (see `set_survey_categories`),
+#   zones and times as floats (as they include missing values)
+survey_dtypes = {
+    **{col: 'category' for col in survey_labels},
+    'age': 'float32',
+    'home': 'float32',
+    **{f'dest{i}': 'float32' for i in range(1, 6)},
+    **{f'time{i}': 'float32' for i in range(1, 6)},
+}
+
+
+def recode(series: pd.Series, mapping: dict) -> pd.Series:
+    """
+    Map the labels of a series through a dictionary,
+        by recoding its categories (instead of looking up every element).
+    Labels missing from the mapping become NaN.
+
+    :param mapping: label mapping, for example `mappings.purpose`
+    """
+    series = series.astype('category')
+    categories = pd.Index(pd.unique(np.array(list(mapping.values()), dtype=object)))
+    lookup = categories.get_indexer(series.cat.categories.map(mapping))
+    # missing values (code -1) stay missing
+    lookup = np.append(lookup, -1)
+    return pd.Series(
+        pd.Categorical.from_codes(lookup[series.cat.codes], categories=categories),
+        index=series.index,
+        name=series.name
+    )
+
+
+def compile_lookup(mapping: dict) -> tuple:
+    """
+    Compile a label mapping into an integer-indexed lookup array of target category codes.
+    Integer labels (ie ages) index the lookup array directly,
+        other labels by their position in the mapping (ie the codes of the survey categoricals).
+        The last element of the lookup array maps missing values (code -1) to missing values.
+
+    :param mapping: label mapping, for example `mappings.age_group`
+    :return: the lookup array, the source labels (None for integer labels),
+        and the target categories
+    """
+    categories = pd.Index(pd.unique(np.array(list(mapping.values()), dtype=object)))
+    targets = categories.get_indexer(list(mapping.values()))
+    labels = list(mapping.keys())
+    if all(isinstance(x, (int, np.integer)) for x in labels):
+        lookup = np.full(max(labels) + 2, -1, dtype=np.int64)
+        lookup[labels] = targets
+        return lookup, None, categories
+    return np.append(targets, -1), pd.Index(labels), categories
+
+
+# compiled person attribute lookups: attribute -> (survey column, lookup, source labels, categories)
+person_attribute_lookups = {
+    attribute: (col, *compile_lookup(mapping))
+    for attribute, (col, mapping) in mappings.person_attributes.items()
+}
+
+# survey zone -> shapefile zone
+zone_remap = np.arange(max(mappings.zones) + 1)
+zone_remap[list(mappings.zone_remap)] = list(mappings.zone_remap.values())
+
+
+def get_source_codes(values: pd.Series, labels: Optional[pd.Index], size: int) -> np.ndarray:
+    """
+    Get the lookup array positions of a column's values (-1 for missing or unknown values):
+        the values themselves for integer labels, or else their codes among the source labels.
+
+    :param labels: source labels (None for integer labels)
+    :param size: number of integer labels
+    """
+    if labels is None:
+        values = pd.to_numeric(values).to_numpy(dtype=float, na_value=np.nan)
+        valid = (values >= 0) & (values < size)
+        return np.where(valid, np.nan_to_num(values), -1).astype(np.int64)
+    if isinstance(values.dtype, pd.CategoricalDtype) and values.cat.categories.equals(labels):
+        return values.cat.codes.to_numpy()
+    return pd.Categorical(values, categories=labels).codes
+
+
+def derive_attributes(df: pd.DataFrame, attributes: Optional[list] = None) -> dict:
+    """
+    Derive person attributes from their source columns, in a single pass of array lookups
+        (see `mappings.person_attributes`).
+    Works on any table with the source columns (survey labels or ages),
+        ie the survey diaries, or the persons of an upscaled population for the age groups:
+        `derive_attributes(store.persons, ['age_group'])`.
+
+    :param attributes: attributes to derive (defaults to all)
+    :return: the derived attributes (categoricals)
+    """
+    if attributes is None:
+        attributes = list(person_attribute_lookups)
+    derived = {}
+    for attribute in attributes:
+        col, lookup, labels, categories = person_attribute_lookups[attribute]
+        codes = lookup[get_source_codes(df[col], labels, len(lookup) - 1)]
+        derived[attribute] = pd.Categorical.from_codes(codes, categories=categories)
+    return derived
+
+
+def remap_zones(zones) -> np.ndarray:
+    """
+    Replace the survey zones that are missing from the zones shapefile (see `mappings.zone_remap`).
+    Zones outside the lookup range are kept.
+    """
+    zones = np.asarray(zones)
+    known = (zones >= 0) & (zones < len(zone_remap))
+    return np.where(known, zone_remap[np.where(known, zones, 0)], zones)
+
+
+def set_survey_categories(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Set the categories of the survey label columns to the known labels (see `mappings`),
+        so that all tables (and chunks) share the same categories.
+    Labels missing from the mappings raise an error,
+        rather than silently becoming missing values (which would drop their trips).
+    """
+    unknown = {}
+    for col, labels in survey_labels.items():
+        if col not in df.columns:
+            continue
+        values = df[col].astype('category')
+        missing = [x for x in values.cat.categories if x not in labels]
+        if missing:
+            unknown[col] = missing
+        else:
+            df[col] = values.cat.set_categories(labels)
+    if unknown:
+        raise ValueError(f'Survey labels missing from the mappings: {unknown}')
+    return df
+
+
+def downcast_integers(df: pd.DataFrame, columns: list) -> pd.DataFrame:
+    """
+    Store integer columns with the smallest integer type that fits their values
+    """
+    for col in columns:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+    return df
+
+
 def read_survey(
     path: str, 
     fix_day: bool = True,
     fix_return: bool = True,
     fix_market: bool = True,
+    seed: Optional[int] = None,
     ) -> pd.DataFrame:
     """
     Read the raw travel survey data
 
     :param cleanup: Whether to remove some errors such as missing return trips
+    :param seed: Random seed for the infilled return trip durations
     """
-    survey_raw = pd.read_csv(path)
+    survey_raw = set_survey_categories(pd.read_csv(path, dtype=survey_dtypes))
+    print(len(survey_raw))
+    survey_raw = clean_survey(
+        survey_raw,
+        fix_day=fix_day,
+        fix_return=fix_return,
+        fix_market=fix_market,
+        seed=seed
+    )
     print(len(survey_raw))
-    survey_raw = survey_raw.dropna(subset=['home', 'age'])
-    survey_raw['home'] = survey_raw['home'].map(int)
-    survey_raw['age'] = survey_raw['age'].map(int)
+
+    return survey_raw
+
+
+def clean_survey(
+    survey_raw: pd.DataFrame,
+    fix_day: bool = True,
+    fix_return: bool = True,
+    fix_market: bool = True,
+    seed: Optional[int] = None,
+    duration_sampler=None,
+    ) -> pd.DataFrame:
+    """
+    Drop incomplete diaries and fix some errors of the raw travel survey data
+
+    :param seed: Random seed (or generator) for the infilled return trip durations
+    :param duration_sampler: Sampler of the infilled activity durations.
+        If None, it is fitted on the given survey data.
+    """
+    survey_raw = survey_raw.dropna(subset=['home', 'age']).copy()
+    survey_raw['home'] = survey_raw['home'].astype(int)
+    survey_raw['age'] = survey_raw['age'].astype(int)
+    survey_raw = downcast_integers(survey_raw, ['home', 'age'])
 
     if fix_day: survey_raw = step_day(survey_raw)
-    if fix_return: survey_raw = fix_nobackhome(survey_raw, duration_distribution='empirical')
+    if fix_return: survey_raw = fix_nobackhome(
+        survey_raw,
+        duration_distribution='empirical',
+        seed=seed,
+        duration_sampler=duration_sampler
+    )
     if fix_market: survey_raw = fix_market_window(survey_raw)
-    
-    print(len(survey_raw))
 
     return survey_raw
 
 
+def fit_duration_sampler(
+    path: str,
+    duration_distribution: str = 'empirical',
+    chunksize: int = 100000,
+    fix_day: bool = True,
+    ):
+    """
+    Fit the activity duration sampler over the whole travel survey file,
+        reading only the purpose and time columns, in chunks.
+
+    :param duration_distribution: Type of the duration sampler ('empirical' or 'gaussian')
+    :param chunksize: Number of diaries read at a time
+    :param fix_day: Whether the durations are fitted after applying `step_day`
+    """
+    usecols = ['home', 'age'] + \
+        [f'{x}{i}' for i in range(1, 6) for x in ['purp', 'time']]
+    chunks = []
+    for chunk in pd.read_csv(
+            path, usecols=usecols, dtype=survey_dtypes, chunksize=chunksize):
+        chunk = set_survey_categories(chunk.dropna(subset=['home', 'age']).copy())
+        if fix_day: chunk = step_day(chunk)
+        chunks.append(chunk)
+    durations = pd.concat(chunks, axis=0, ignore_index=True)
+
+    return create_duration_sampler(durations, duration_distribution)
+
+
+def read_survey_chunks(
+    path: str,
+    chunksize: int = 100000,
+    fix_day: bool = True,
+    fix_return: bool = True,
+    fix_market: bool = True,
+    seed: Optional[int] = None,
+    ):
+    """
+    Read the raw travel survey data in chunks, applying the fixes to each chunk.
+    Each row of the (wide) survey file holds a full diary,
+        so chunks are always aligned to whole persons.
+
+    The duration distributions of the missing return trips
+        are fitted in a first pass over the whole file.
+
+    :param chunksize: Number of diaries read at a time
+    :param seed: Random seed for the infilled return trip durations
+    """
+    duration_sampler = None
+    if fix_return:
+        duration_sampler = fit_duration_sampler(
+            path, chunksize=chunksize, fix_day=fix_day)
+    rng = np.random.default_rng(seed)
+
+    for chunk in pd.read_csv(path, dtype=survey_dtypes, chunksize=chunksize):
+        yield clean_survey(
+            set_survey_categories(chunk),
+            fix_day=fix_day,
+            fix_return=fix_return,
+            fix_market=fix_market,
+            seed=rng,
+            duration_sampler=duration_sampler
+        )
+
+
+def iter_survey_tables(
+    path: str,
+    chunksize: int = 100000,
+    filter_next_day: bool = True,
+    wrap_next_day: bool = False,
+    **kwargs
+    ):
+    """
+    Stream the person attributes and trips tables from the travel survey,
+        one chunk of diaries at a time.
+
+    :param chunksize: Number of diaries read at a time
+    :param filter_next_day: If True, drop any trips happening after the first day.
+    :param wrap_next_day: If True, wrap the next-day trips around to the start of the plan.
+    :param kwargs: Keyword arguments passed to `read_survey_chunks`
+    """
+    for survey_raw in read_survey_chunks(path, chunksize=chunksize, **kwargs):
+        yield (
+            get_person_attributes(survey_raw),
+            get_trips_table(
+                survey_raw, filter_next_day=filter_next_day, wrap_next_day=wrap_next_day
+            )
+        )
+
+
 def step_day(df: pd.DataFrame) -> pd.DataFrame:
     """
     This function adds extra 24 (one day), if time i < time i + 1 - next activity
@@ -82,14 +358,90 @@ def prpdur_stat(df: pd.DataFrame) -> pd.DataFrame:
     return statdf
 
 
-def create_duration_sampler_gaussian(df: pd.DataFrame, **kwargs):
+class GaussianDurationSampler:
+    """
+    Normal sampler of activity durations, by trip purpose.
+
+    Purpose means and standard deviations are held as aligned arrays,
+    so a whole batch of durations is drawn with a single call.
+
+    :param statdf: Duration mean and standard deviation by purpose (see `prpdur_stat`)
+    :param min_duration: If provided, truncate the distributions at this minimum duration (in hours)
+    :param seed: Random seed of the sampler's default generator
+    """
+    def __init__(
+            self,
+            statdf: pd.DataFrame,
+            min_duration: Optional[float] = None,
+            seed: Optional[int] = None,
+            max_iterations: int = 100
+        ):
+        self.purposes = list(statdf.index)
+        self.dur_mean = statdf['dur_mean'].to_numpy(dtype=float)
+        self.dur_sd = statdf['dur_sd'].to_numpy(dtype=float)
+        self.min_duration = min_duration
+        self.max_iterations = max_iterations
+        self.rng = np.random.default_rng(seed)
+
+    def get_codes(self, purps) -> np.ndarray:
+        """
+        Get the position of each purpose in the parameter arrays.
+        """
+        codes = pd.Categorical(
+            np.asarray(purps).ravel(), categories=self.purposes
+        ).codes.reshape(np.shape(purps))
+        if (codes == -1).any():
+            unknown = set(np.asarray(purps)[codes == -1])
+            raise KeyError(f'No duration distribution for purpose(s): {unknown}')
+        return codes
+
+    def sample(
+            self,
+            purps,
+            hours=None,
+            n: Optional[int] = None,
+            rng: Optional[np.random.Generator] = None
+        ) -> np.ndarray:
+        """
+        Sample activity durations (in hours), rounded to the nearest hour.
+
+        :param purps: Trip purpose(s), as reported in the survey
+        :param hours: Activity start hour(s). Not used, kept for consistency across samplers.
+        :param n: Number of draws (when sampling a single purpose)
+        :param rng: Random generator, defaults to the sampler's generator
+        """
+        rng = self.rng if rng is None else rng
+        purps = np.asarray(purps)
+        if n is not None:
+            purps = np.broadcast_to(purps, n)
+        codes = self.get_codes(purps)
+        dur_mean = self.dur_mean[codes]
+        dur_sd = self.dur_sd[codes]
+        durations = rng.normal(dur_mean, dur_sd)
+
+        if self.min_duration is not None:
+            # truncate by redrawing any durations below the minimum
+            for _ in range(self.max_iterations):
+                redraw = durations < self.min_duration
+                if not redraw.any():
+                    break
+                durations[redraw] = rng.normal(dur_mean[redraw], dur_sd[redraw])
+            durations = np.maximum(durations, self.min_duration)
+
+        return np.round(durations)
+
+    def __call__(self, purp, *args, rng: Optional[np.random.Generator] = None, **kwargs) -> int:
+        return int(self.sample(purp, rng=rng))
+
+
+def create_duration_sampler_gaussian(
+        df: pd.DataFrame,
+        min_duration: Optional[float] = None,
+        seed: Optional[int] = None,
+        **kwargs
+    ) -> GaussianDurationSampler:
     statdf = prpdur_stat(df)
-    def sample(purp, *args, **kwargs):
-        dur_mean = statdf.loc[purp, 'dur_mean']
-        dur_sd = statdf.loc[purp, 'dur_sd']
-        x = int(np.round(np.random.normal(dur_mean, dur_sd)))
-        return x
-    return sample
+    return GaussianDurationSampler(statdf, min_duration=min_duration, seed=seed)
 
 
 def get_durations_ecdf(df, time_period_hours=6) -> pd.Series:
@@ -114,61 +466,181 @@ def get_durations_ecdf(df, time_period_hours=6) -> pd.Series:
 
     return ecdf
 
-def create_duration_sampler_empirical(df: pd.DataFrame, time_period_hours=6):
-    ecdf = get_durations_ecdf(df, time_period_hours=time_period_hours)
-
-    def interpolate(x, ecdf, purp, start_period, min_duration=1):
-        if (purp, start_period) not in ecdf.index:
-            start_period = 'total'
-
-        ys = [0] + list(ecdf.loc[purp, start_period].index)
-        xs = [0] + list(ecdf.loc[purp, start_period].values)
-        duration = np.interp(x, xs, ys)
-        duration = max(duration, min_duration)
-        return duration
+class EmpiricalDurationSampler:
+    """
+    Inverse-CDF sampler of activity durations, compiled from the empirical
+    duration distributions (see `get_durations_ecdf`).
 
-    def sample_duration(purp, hour):
-        time_period = hour // time_period_hours
-        return interpolate(random.random(), ecdf, purp, time_period)
+    The ECDF of every (purpose, start period) is stored once in contiguous
+    arrays, with the 'total' fallback resolved ahead of time,
+    so sampling a batch costs a single `np.searchsorted` pass.
 
-    return sample_duration
+    :param ecdf: Cumulative duration frequencies, by purpose and start period
+    :param time_period_hours: how many hours in each time period
+    :param min_duration: Minimum sampled duration (in hours)
+    :param seed: Random seed of the sampler's default generator
+    """
+    def __init__(
+            self,
+            ecdf: pd.Series,
+            time_period_hours: int = 6,
+            min_duration: float = 1,
+            seed: Optional[int] = None
+        ):
+        self.time_period_hours = time_period_hours
+        self.min_duration = min_duration
+        self.rng = np.random.default_rng(seed)
+
+        # flatten all distributions into a single sorted array:
+        #   the cumulative frequencies of the k-th distribution are offset by k,
+        #   so a quantile u of distribution k is found at position k + u
+        xs, ys, keys = [], [], {}
+        for k, ((purp, period), cdf) in enumerate(
+                ecdf.groupby(level=[0, 1], sort=False)):
+            cum = cdf.to_numpy(dtype=float)
+            cum[-1] = 1
+            xs.append(np.concatenate([[0], cum]) + k)
+            ys.append(np.concatenate([[0], cdf.index.get_level_values(-1)]))
+            keys[(purp, period)] = k
+        self.xs = np.concatenate(xs)
+        self.ys = np.concatenate(ys).astype(float)
+        self.ends = np.cumsum([len(x) for x in xs]) - 1
+
+        # (purpose, period) -> distribution lookup table
+        #   the last column holds the 'total' distribution of each purpose
+        self.purposes = list(dict.fromkeys(purp for purp, _ in keys))
+        periods = [period for _, period in keys if period != 'total']
+        self.n_periods = int(max(periods)) + 1 if len(periods) else 0
+        self.lookup = np.empty((len(self.purposes), self.n_periods + 1), dtype=int)
+        for i, purp in enumerate(self.purposes):
+            total = keys[(purp, 'total')]
+            self.lookup[i] = [
+                keys.get((purp, period), total) for period in range(self.n_periods)
+            ] + [total]
+
+    def get_keys(self, purps, hours) -> np.ndarray:
+        """
+        Get the distribution index of each (purpose, start hour) pair.
+        """
+        purp_codes = pd.Categorical(
+            np.asarray(purps).ravel(), categories=self.purposes
+        ).codes.reshape(np.shape(purps))
+        if (purp_codes == -1).any():
+            unknown = set(np.asarray(purps)[purp_codes == -1])
+            raise KeyError(f'No duration distribution for purpose(s): {unknown}')
+
+        periods = np.floor_divide(np.asarray(hours, dtype=float), self.time_period_hours)
+        valid = np.isfinite(periods) & (periods >= 0) & (periods < self.n_periods)
+        periods = np.where(valid, periods, self.n_periods).astype(int)
+
+        return self.lookup[purp_codes, periods]
+
+    def sample(
+            self,
+            purps,
+            hours,
+            n: Optional[int] = None,
+            rng: Optional[np.random.Generator] = None
+        ) -> np.ndarray:
+        """
+        Sample activity durations (in hours).
+
+        :param purps: Trip purpose(s), as reported in the survey
+        :param hours: Activity start hour(s)
+        :param n: Number of draws (when sampling a single purpose and hour)
+        :param rng: Random generator, defaults to the sampler's generator
+        """
+        rng = self.rng if rng is None else rng
+        purps, hours = np.broadcast_arrays(purps, hours)
+        if n is not None:
+            purps, hours = np.broadcast_to(purps, n), np.broadcast_to(hours, n)
+        keys = self.get_keys(purps, hours)
+
+        # inverse-cdf, interpolating between the ECDF points
+        x = keys + rng.random(keys.shape)
+        j = np.minimum(np.searchsorted(self.xs, x, side='right'), self.ends[keys])
+        x0, x1 = self.xs[j-1], self.xs[j]
+        y0, y1 = self.ys[j-1], self.ys[j]
+        durations = y0 + (x - x0) * (y1 - y0) / (x1 - x0)
+
+        return np.maximum(durations, self.min_duration)
+
+    def __call__(self, purp, hour, rng: Optional[np.random.Generator] = None):
+        durations = self.sample(purp, hour, rng=rng)
+        return durations if durations.ndim else durations.item()
+
+
+def create_duration_sampler_empirical(
+        df: pd.DataFrame,
+        time_period_hours=6,
+        seed: Optional[int] = None
+    ) -> EmpiricalDurationSampler:
+    ecdf = get_durations_ecdf(df, time_period_hours=time_period_hours)
+    return EmpiricalDurationSampler(
+        ecdf, time_period_hours=time_period_hours, seed=seed)
 
-def create_duration_sampler(df, distribution='gaussian'):
+def create_duration_sampler(df, distribution='gaussian', seed: Optional[int] = None):
     if distribution == 'gaussian':
-        return create_duration_sampler_gaussian(df)
+        return create_duration_sampler_gaussian(df, seed=seed)
     elif distribution == 'empirical':
-        return create_duration_sampler_empirical(df)
+        return create_duration_sampler_empirical(df, seed=seed)
     else:
         raise ValueError('Please provide a valid sampler type')
 
-def timeupd(df, duration_sampler, i: int, infill: pd.Series, min_duration: int=1) -> None:
+def timeupd(
+        df,
+        duration_sampler,
+        i: int,
+        infill: pd.Series,
+        min_duration: int=1,
+        rng: Optional[np.random.Generator] = None
+    ) -> None:
     """
     Fills missing times from the missing trip.
+    All durations for the trip sequence are sampled in a single batch.
 
+    :param duration_sampler: Duration sampler with a batch `sample(purps, hours)` method
     :param i: the trip sequence to update (1-5)
     :param infill: boolean series indicating the trips that need infilling
     :param min_duration: Minimun sampled duration (in hours)
+    :param rng: Random generator used for the duration draws
     """    
-    for idx, values in df.loc[infill].iterrows():
-        prp = values[f'purp{i}']
-        start_time = values[f'time{i}']
+    if not infill.any():
+        return None
+
+    start_time = df.loc[infill, f'time{i}']
 
-        # sample new duration
-        duration = duration_sampler(prp, start_time)
-        duration = max(duration, min_duration)
+    # sample new durations
+    duration = duration_sampler.sample(
+        df.loc[infill, f'purp{i}'].to_numpy(),
+        start_time.to_numpy(),
+        rng=rng
+    )
+    duration = np.maximum(duration, min_duration)
 
-        df.loc[idx, f'time{i+1}']  = start_time + duration
+    df.loc[infill, f'time{i+1}'] = (start_time + duration).astype(df[f'time{i+1}'].dtype)
 
-def fix_nobackhome(df: pd.DataFrame, duration_distribution='empirical') -> pd.DataFrame:
+def fix_nobackhome(
+        df: pd.DataFrame,
+        duration_distribution='empirical',
+        seed: Optional[int] = None,
+        duration_sampler=None
+    ) -> pd.DataFrame:
     """
     Add a return trip home (where it is missing).
+
+    :param seed: Random seed (or generator) for the sampled activity durations
+    :param duration_sampler: Sampler of the activity durations.
+        If None, it is fitted on the given data.
     """
-    duration_sampler = create_duration_sampler(df, duration_distribution)    
+    if duration_sampler is None:
+        duration_sampler = create_duration_sampler(df, duration_distribution)
+    rng = np.random.default_rng(seed)
     n_trips = np.select([df[f'dest{i}']>0 for i in range(5, 0, -1)], range(5, 0, -1))
-    df['purp6'] = np.nan
-    df['mode6'] = np.nan
-    df['dest6'] = np.nan
-    df['time6'] = np.nan
+    df['purp6'] = pd.Series(np.nan, index=df.index, dtype=df['purp5'].dtype)
+    df['mode6'] = pd.Series(np.nan, index=df.index, dtype=df['mode5'].dtype)
+    df['dest6'] = pd.Series(np.nan, index=df.index, dtype=df['dest5'].dtype)
+    df['time6'] = pd.Series(np.nan, index=df.index, dtype=df['time5'].dtype)
     df['infilled'] = False
     for i in range(2, 6):
         j = i + 1
@@ -177,9 +649,9 @@ def fix_nobackhome(df: pd.DataFrame, duration_distribution='empirical') -> pd.Da
         df['infilled'] = (df['infilled'] | infill)
         # update next trip's destination, purpose, mode and time
         df[f'dest{j}'] = np.where(infill, df.home, df[f'dest{j}']) # home location to the destinatio
-        df[f'purp{j}'] = np.where(infill, '2: return home', df[f'purp{j}'])
-        df[f'mode{j}'] = np.where(infill, df[f'mode{i}'], df[f'mode{j}']) # with the same mode he/she returned back
-        timeupd(df, duration_sampler, i, infill)
+        df[f'purp{j}'] = df[f'purp{j}'].mask(infill, '2: return home')
+        df[f'mode{j}'] = df[f'mode{j}'].mask(infill, df[f'mode{i}']) # with the same mode he/she returned back
+        timeupd(df, duration_sampler, i, infill, rng=rng)
 
     return df
 
@@ -188,7 +660,7 @@ def fix_market_window(df: pd.DataFrame) -> pd.DataFrame:
     Rename market activities starting after 21:00 as "other" 
     """
     for i in range(1, 6):
-        df[f'purp{i}'] = np.where((df[f'time{i}']>21) & (df[f'purp{i}'] =='4: market'), '7: other', df[f'purp{i}'])
+        df[f'purp{i}'] = df[f'purp{i}'].mask((df[f'time{i}']>21) & (df[f'purp{i}'] =='4: market'), '7: other')
 
     return df
 
@@ -199,20 +671,8 @@ def get_person_attributes(survey_raw: pd.DataFrame) -> pd.DataFrame:
     person_attributes = survey_raw[['pid']+person_attribute_cols].copy()
 
     # mappings
-    person_attributes['gender'] = person_attributes['gender'].map(
-        mappings.gender)
-    person_attributes['education'] = person_attributes['education'].map(
-        mappings.education)
-    person_attributes['employment'] = person_attributes['employment'].map(
-        mappings.employment)
-    person_attributes['income_all'] = person_attributes['income'].map(
-        mappings.income_all_categories)
-    person_attributes['income'] = person_attributes['income'].map(
-        mappings.income)
-    person_attributes['car_own'] = person_attributes['car_own'].map(
-        mappings.car_own)
-    person_attributes['age_group'] = person_attributes['age'].map(
-        mappings.age_group)
+    for attribute, values in derive_attributes(survey_raw).items():
+        person_attributes[attribute] = pd.Series(values, index=person_attributes.index)
     person_attributes['freq'] = 1
 
     # rename
@@ -223,70 +683,84 @@ def get_person_attributes(survey_raw: pd.DataFrame) -> pd.DataFrame:
         inplace=True
     )
 
-    # zone 29 (Papagou-Cholargos) is missing from the shapefile
-    # -> use zone 35 instead
-    #    (Chalandri, Agia Paraskeyi, Gerakas, Cholargos, Papagou, ...)
-    person_attributes['hzone'] = np.where(
-        person_attributes['hzone'] == 29, 35,
-        person_attributes['hzone']
-    )
+    # zones missing from the shapefile
+    person_attributes['hzone'] = remap_zones(person_attributes['hzone'])
+    person_attributes = downcast_integers(
+        person_attributes, ['age', 'hzone', 'freq'])
 
     return person_attributes
 
 
 def get_trips_table(
     survey_raw: pd.DataFrame,
-    filter_next_day: bool = True
+    filter_next_day: bool = True,
+    wrap_next_day: bool = False
     ) -> pd.DataFrame:
     """
-    Create the trips table from the raw survey data
+    Create the trips table from the raw survey data.
+    Trips after the first day have start times of 24 hours or more.
 
     :param filter_next_day: If True, drop any trips happening after the first day.
+    :param wrap_next_day: If True, trips of the next day are wrapped around
+        to the start of the plan (see `wrap_next_day_trips`), rather than dropped.
     """
-    trips = survey_raw[
-        [x for x in survey_raw if x not in person_attribute_cols]
-    ].set_index('pid')
-
-    trips.columns = pd.MultiIndex.from_tuples([
-        (int(x[-1]), x[:-1]) for x in trips.columns
-    ], names=['seq', ''])
-    trips = trips.stack(level=0).reset_index().sort_values(['pid', 'seq']).dropna(subset='mode')
+    # wide to long: one block of trip fields per trip sequence
+    #   (concatenating the blocks keeps any categorical types)
+    trip_cols = {}
+    for x in survey_raw:
+        if x not in ['pid'] + person_attribute_cols:
+            trip_cols.setdefault(int(x[-1]), {})[x[:-1]] = x
+    fields = sorted(set(f for cols in trip_cols.values() for f in cols))
+    trips = pd.concat([
+        pd.DataFrame({
+            'pid': survey_raw['pid'],
+            'seq': seq,
+            **{field: survey_raw[col] for field, col in cols.items()}
+        }) for seq, cols in sorted(trip_cols.items())
+    ], axis=0, ignore_index=True)[['pid', 'seq'] + fields]
+    trips = trips.sort_values(['pid', 'seq']).dropna(subset='mode').reset_index(drop=True)
     trips['hid'] = trips['pid']
     trips['hzone'] = trips.pid.map(survey_raw.set_index('pid')['home'])
-    trips['dest'] = trips['dest'].apply(int)
-    trips['time'] = trips['time'].apply(int)
+    trips['dest'] = trips['dest'].astype(int)
+    trips['time'] = trips['time'].astype(int)
     trips['tst'] = trips['time'] * 60
     trips['seq'] = trips['seq'] - 1
     trips['freq'] = 1
 
-    # zone 29 (Papagou-Cholargos) is missing from the shapefile
-    # -> use zone 35 instead
-    #    (Chalandri, Agia Paraskeyi, Gerakas, Cholargos, Papagou, ...)
-    trips['dest'] = np.where(trips['dest'] == 29, 35, trips['dest'])
-    trips['hzone'] = np.where(trips['hzone'] == 29, 35, trips['hzone'])
+    # zones missing from the shapefile
+    trips['dest'] = remap_zones(trips['dest'])
+    trips['hzone'] = remap_zones(trips['hzone'])
 
     # mappings
-    trips['mode'] = trips['mode'].map(mappings.modes)
-    trips['purp'] = trips['purp'].map(mappings.purpose)
+    trips['mode'] = recode(trips['mode'], mappings.modes)
+    trips['purp'] = recode(trips['purp'], mappings.purpose)
 
-    # some sequences happen during the next day
-    trips['day'] = trips.groupby('pid', group_keys=False)['tst'].apply(
-        lambda x: (x < x.shift(1)).cumsum()
-    )
-    trips['day'] += np.floor(trips['tst']/24/60).round(0).apply(int)
+    # trips are sorted by (pid, seq):
+    #   flag the first trip of each person, so that any shifted values
+    #   are not carried over between persons
+    first_trip = (trips['pid'] != trips['pid'].shift(1)).to_numpy()
+
+    # some sequences happen during the next day:
+    #   times earlier than the previous trip (without `step_day`), or times of 24 hours or more
+    rollover = ((trips['tst'] < trips['tst'].shift(1)).to_numpy() & ~first_trip).cumsum()
+    rollover_days = rollover - np.maximum.accumulate(np.where(first_trip, rollover, 0))
+    trips['day'] = rollover_days + trips['time'] // 24
 
     # if activities happen during the same hour,
     #   distribute them equally
     # TODO: if two activities happen during the same hour, apply some offset
-    trips['same_hour'] = trips.groupby('pid', group_keys=False)['time'].apply(
-        lambda x: (x == x.shift(1))
-    )
-    offset = lambda x: (60/len(x)*x.cumsum()).round().map(int)
-    trips['offset'] = trips.groupby(['pid','time','day']).same_hour.transform(offset)
+    trips['same_hour'] = (trips['time'] == trips['time'].shift(1)).to_numpy() & ~first_trip
+    # consecutive same-hour trips form a run; spread each run across the hour
+    run_start = np.flatnonzero(~trips['same_hour'].to_numpy())
+    run = np.cumsum(~trips['same_hour'].to_numpy()) - 1
+    run_size = np.diff(np.append(run_start, len(trips)))[run]
+    run_position = np.arange(len(trips)) - run_start[run]
+    trips['offset'] = np.round(60 / run_size * run_position).astype(int)
     trips['tst'] = trips['tst'] + trips['offset']
 
     # next day activities
-    trips['tst'] = trips['tst'] + trips['day'] * 24 * 60
+    #   (times of 24 hours or more already include their day)
+    trips['tst'] = trips['tst'] + rollover_days * 24 * 60
 
     # rename fields
     trips.rename(
@@ -297,20 +771,59 @@ def get_trips_table(
     )
 
     # add origin zone
-    trips['ozone'] = trips.groupby('pid').apply(
-        lambda x: x['dzone'].shift(1)
-    ).values
-    trips['ozone'] = trips.ozone.fillna(trips.hzone).apply(int)
+    trips['ozone'] = trips['dzone'].shift(1).where(~first_trip, trips['hzone']).astype(int)
 
     # trip start time
     # arbitrarily assume 10-minute trips
     # TODO: improve this assumption
     trips['tet'] = trips['tst'] + 10
 
+    if wrap_next_day:
+        trips = wrap_next_day_trips(trips)
+
     # crop any trips that start on the second day
     if filter_next_day:
         trips = trips[trips['day']==0]
 
+    trips = downcast_integers(trips, [
+        'seq', 'dzone', 'time', 'hzone', 'tst', 'freq',
+        'day', 'offset', 'ozone', 'tet'
+    ])
+
+    return trips
+
+
+def wrap_next_day_trips(trips: pd.DataFrame) -> pd.DataFrame:
+    """
+    Wrap the trips of the next day around to the start of the day,
+        so that 24-hour plans keep the whole diary:
+        ie a return home at 01:00 of the next day becomes the first trip of the plan, at 01:00,
+        and the plan starts at the last activity of the day.
+    Next-day trips are wrapped if they end before the first trip of the day starts.
+        Wrapped trips are moved to the first day (day 0) and trip sequences are renumbered,
+        any other trips after the first day are left unchanged.
+
+    :param trips: trips table, sorted by person and sequence (see `get_trips_table`)
+    """
+    day = trips['day'].to_numpy()
+    tst = trips['tst'].to_numpy()
+    position = np.arange(len(trips))
+    first_trip = (trips['pid'] != trips['pid'].shift(1)).to_numpy()
+    first_position = np.maximum.accumulate(np.where(first_trip, position, 0))
+
+    # start of the plan: the first trip of the day
+    first_start = np.where(day[first_position] == 0, tst[first_position], np.inf)
+    wrap = (day == 1) & (trips['tet'].to_numpy() - 24 * 60 <= first_start)
+
+    trips = trips.assign(
+        tst=tst - wrap * 24 * 60,
+        tet=trips['tet'] - wrap * 24 * 60,
+        day=np.where(wrap, 0, day)
+    )
+    # wrapped trips first, keeping the order of the persons
+    order = np.lexsort((trips['seq'].to_numpy(), ~wrap, np.cumsum(first_trip)))
+    trips = trips.iloc[order].reset_index(drop=True)
+    trips['seq'] = position - first_position
     return trips
 
 
@@ -330,18 +843,65 @@ def create_external_zone() -> gp.GeoDataFrame:
     return external_zone
 
 
-def get_zones(path: str) -> gp.GeoDataFrame:
+def read_zones_file(path: str) -> gp.GeoDataFrame:
     """
-    Get the Attica zoning shapefile
+    Read a zones file: GeoParquet (.parquet),
+        or any format supported by geopandas, using pyogrio (with Arrow) when available.
     """
-    zones = gp.read_file(path)
-    zones[['id', 'name']] = zones['zone_name'].str.split(':', expand=True)
-    zones['id'] = zones['id'].map(int)
-    zones.set_index('id', inplace=True)
-    zones.sort_index(inplace=True)
+    if path.endswith('.parquet'):
+        return gp.read_parquet(path)
+
+    try:
+        import pyogrio  # noqa: F401
+    except ImportError:
+        return gp.read_file(path)
+    try:
+        import pyarrow  # noqa: F401
+        use_arrow = True
+    except ImportError:
+        use_arrow = False
+    return gp.read_file(path, engine='pyogrio', use_arrow=use_arrow)
+
+
+# zoning systems loaded by the current process,
+#   keyed by (path, modification time, add_bounds)
+_zones_memo = {}
+
+
+def get_zones(
+    path: str,
+    add_bounds: bool = False,
+    memoize: bool = True
+) -> gp.GeoDataFrame:
+    """
+    Get the Attica zoning shapefile
 
-    # append an external zone
-    external_zone = create_external_zone()
-    zones = pd.concat([zones, external_zone], axis=0)
+    :param path: path to the zones file (shapefile, GeoParquet, or any format supported by geopandas).
+        GeoParquet files can hold either the raw or the processed zoning system.
+    :param add_bounds: whether to add the bounds (minx, miny, maxx, maxy) and area of each zone
+    :param memoize: whether to reuse zones already loaded by this process
+        (unless the file has been modified since)
+    """
+    key = (os.path.abspath(path), os.path.getmtime(path), add_bounds)
+    if memoize and key in _zones_memo:
+        return _zones_memo[key].copy()
+
+    zones = read_zones_file(path)
+    if 'name' not in zones.columns:
+        zones[['id', 'name']] = zones['zone_name'].str.split(':', expand=True)
+        zones['id'] = zones['id'].astype(int)
+        zones.set_index('id', inplace=True)
+        zones.sort_index(inplace=True)
+
+        # append an external zone
+        external_zone = create_external_zone()
+        zones = pd.concat([zones, external_zone], axis=0)
+
+    if add_bounds:
+        zones[['minx', 'miny', 'maxx', 'maxy']] = zones.bounds
+        zones['area'] = zones.area
+
+    if memoize:
+        _zones_memo[key] = zones.copy()
 
     return zones
@@ -0,0 +1,148 @@
+"""
+Stage-level instrumentation of the population pipeline:
+    wall time, CPU time, peak memory (RSS) and row/agent counts of each stage.
+"""
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+METRICS = ['wall_time', 'cpu_time', 'peak_rss', 'children_peak_rss', 'max_rss']
+
+
+def get_peak_rss(children: bool = False) -> Optional[float]:
+    """
+    Peak resident set size (MB) of the process so far, or None if not available.
+        This is a high-water mark: it never decreases during the run.
+
+    :param children: if True, get the peak of the largest terminated child process
+        (ie pool workers) instead
+    """
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return round(peak / 2**20 if sys.platform == 'darwin' else peak / 2**10, 1)
+
+
+def get_increase(start: Optional[float], end: Optional[float]) -> Optional[float]:
+    """
+    Increase of a peak RSS measurement (MB) over a stage
+    """
+    if start is None or end is None:
+        return None
+    return round(end - start, 1)
+
+
+class StageProfiler:
+    """
+    Record the wall time, CPU time, peak RSS and counts of pipeline stages.
+
+    As the peak RSS is a process-wide high-water mark, each stage records:
+        peak_rss: increase of the process peak RSS during the stage (MB),
+            ie 0 for stages that stay below the peak of an earlier stage
+        children_peak_rss: increase of the peak RSS of the worker processes
+            that terminated during the stage (ie pooled stages)
+        max_rss: peak RSS of the process so far
+
+    Example:
+        profiler = StageProfiler(profile_stage='load_travel_diary')
+        with profiler.stage('load_travel_diary') as record:
+            population = read.load_travel_diary(...)
+            record['count'] = len(population)
+        profiler.save(path_outputs)
+    """
+
+    def __init__(
+        self,
+        profile_stage: Optional[str] = None,
+        verbose: bool = False
+    ):
+        """
+        :param profile_stage: name of a stage to run under cProfile (optional)
+        :param verbose: whether to print each stage's measurements when it finishes
+        """
+        self.profile_stage = profile_stage
+        self.verbose = verbose
+        self.records = []
+        self.stats = None
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[dict]:
+        """
+        Measure a pipeline stage.
+            The yielded record can be updated with counts, ie record['count'] = len(trips)
+        """
+        record = {'stage': name}
+        profile = cProfile.Profile() if name == self.profile_stage else None
+        peak_rss, children_peak_rss = get_peak_rss(), get_peak_rss(children=True)
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.stats = profile
+            record['wall_time'] = round(time.perf_counter() - wall, 4)
+            record['cpu_time'] = round(time.process_time() - cpu, 4)
+            max_rss = get_peak_rss()
+            record['peak_rss'] = get_increase(peak_rss, max_rss)
+            record['children_peak_rss'] = get_increase(
+                children_peak_rss, get_peak_rss(children=True)
+            )
+            record['max_rss'] = max_rss
+            self.records.append(record)
+            if self.verbose:
+                print(self.format_record(record))
+
+    @staticmethod
+    def format_record(record: dict) -> str:
+        counts = ', '.join(
+            f'{k}={v}' for k, v in record.items() if k not in ['stage'] + METRICS
+        )
+        if record['peak_rss'] is None:
+            peak_rss = 'n/a'
+        else:
+            peak_rss = f"+{record['peak_rss']:.0f}MB (max {record['max_rss']:.0f}MB"
+            if record['children_peak_rss']:
+                peak_rss += f", workers +{record['children_peak_rss']:.0f}MB"
+            peak_rss += ')'
+        return (
+            f"{record['stage']}: {record['wall_time']:.2f}s wall, "
+            f"{record['cpu_time']:.2f}s cpu, peak RSS {peak_rss}"
+            + (f' ({counts})' if counts else '')
+        )
+
+    def report(self) -> pd.DataFrame:
+        """
+        Stage measurements table
+        """
+        report = pd.DataFrame(self.records).set_index('stage')
+        return report[METRICS + [x for x in report.columns if x not in METRICS]]
+
+    def save(self, path: str, name: str = 'profile') -> None:
+        """
+        Save the stage measurements (json and csv),
+            and the cProfile statistics of the profiled stage (.prof, if any)
+
+        :param path: output directory
+        :param name: output file name (without extension)
+        """
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, f'{name}.json'), 'w') as f:
+            json.dump(self.records, f, indent=2)
+        self.report().to_csv(os.path.join(path, f'{name}.csv'))
+        if self.stats is not None:
+            self.stats.dump_stats(os.path.join(path, f'{name}_{self.profile_stage}.prof'))
@@ -0,0 +1,326 @@
+"""
+Batched (vectorized) sampling of activity locations within zones.
+"""
+from typing import Optional, Tuple
+import geopandas as gp
+import numpy as np
+import pandas as pd
+import shapely
+from athenspop.population import PopulationStore
+
+LONG_TERM_ACTIVITIES = ['work', 'school', 'education', 'home']
+
+
+class ZonePointSampler:
+    """
+    Sample random points within zones.
+    Points are drawn in batches within each zone's bounding box,
+        and rejected if they fall outside the (prepared) zone geometry.
+    """
+
+    def __init__(
+        self,
+        zones: gp.GeoDataFrame,
+        seed: Optional[int] = None,
+        patience: int = 100
+    ):
+        """
+        :param zones: zoning system, indexed by zone id
+        :param seed: random seed of the sampler's default generator
+        :param patience: maximum number of rejection rounds.
+            Points that are still missing are sampled within the zone's bounding box.
+        """
+        self.zone_index = pd.Index(zones.index)
+        self.geoms = np.asarray(zones.geometry.values, dtype=object)
+        shapely.prepare(self.geoms)
+        self.bounds = shapely.bounds(self.geoms)
+        box_area = (self.bounds[:, 2] - self.bounds[:, 0]) * \
+            (self.bounds[:, 3] - self.bounds[:, 1])
+        self.acceptance = np.clip(
+            shapely.area(self.geoms) / np.where(box_area > 0, box_area, 1), 0.01, 1
+        )
+        self.patience = patience
+        self.rng = np.random.default_rng(seed)
+
+    def __setstate__(self, state: dict):
+        # geometries are not pickled as prepared
+        self.__dict__.update(state)
+        shapely.prepare(self.geoms)
+
+    def sample_zone(self, i: int, n: int, rng: np.random.Generator) -> np.ndarray:
+        """
+        Sample n points within the zone at position i
+
+        :return: a (n x 2) array of coordinates
+        """
+        xmin, ymin, xmax, ymax = self.bounds[i]
+        points = np.empty((0, 2))
+        for _ in range(self.patience):
+            n_missing = n - len(points)
+            if n_missing <= 0:
+                return points[:n]
+            n_draws = int(np.ceil(n_missing / self.acceptance[i] * 1.1)) + 8
+            x = rng.uniform(xmin, xmax, n_draws)
+            y = rng.uniform(ymin, ymax, n_draws)
+            accepted = shapely.contains_xy(self.geoms[i], x, y)
+            points = np.concatenate([points, np.stack([x[accepted], y[accepted]], axis=1)])
+
+        n_missing = max(n - len(points), 0)
+        points = np.concatenate([points, np.stack([
+            rng.uniform(xmin, xmax, n_missing), rng.uniform(ymin, ymax, n_missing)
+        ], axis=1)])
+        return points[:n]
+
+    def sample(
+        self,
+        zones: np.ndarray,
+        acts=None,
+        rng: Optional[np.random.Generator] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sample a point within each of the given zones.
+            Points are sampled in one batch per zone.
+            Unknown zones get missing (NaN) coordinates.
+
+        :param zones: zone ids
+        :param acts: activity types (not used, points are sampled regardless of the activity)
+        :param rng: random number generator. Defaults to the sampler's generator.
+        :return: x and y coordinate arrays
+        """
+        rng = self.rng if rng is None else rng
+        codes = self.zone_index.get_indexer(np.asarray(zones))
+        x = np.full(len(codes), np.nan)
+        y = np.full(len(codes), np.nan)
+
+        order = np.argsort(codes, kind='stable')
+        unique_codes, starts, counts = np.unique(
+            codes[order], return_index=True, return_counts=True
+        )
+        for code, start, count in zip(unique_codes, starts, counts):
+            if code < 0:
+                continue
+            idx = order[start:start+count]
+            points = self.sample_zone(code, count, rng)
+            x[idx], y[idx] = points[:, 0], points[:, 1]
+
+        return x, y
+
+
+class FacilityIndex:
+    """
+    Facility locations, indexed by zone and activity.
+    Facility coordinates are stored in a contiguous array, sorted by (zone, activity),
+        so that facilities of zone i and activity j are
+        coords[offsets[i * n_activities + j]:offsets[i * n_activities + j + 1]].
+    """
+
+    def __init__(
+        self,
+        zone_ids: np.ndarray,
+        activities: np.ndarray,
+        offsets: np.ndarray,
+        coords: np.ndarray,
+        aliases: Optional[dict] = None,
+        fallback: Optional[ZonePointSampler] = None,
+        seed: Optional[int] = None
+    ):
+        """
+        :param zone_ids: zone ids
+        :param activities: facility activity types
+        :param offsets: start position of each (zone, activity) group of facilities
+        :param coords: facility coordinates, sorted by zone and activity
+        :param aliases: facility activity to sample for population activities without
+            facilities of the same name, ie {'recreation': 'other'}
+        :param fallback: sampler used for (zone, activity) combinations without facilities.
+            If None, their locations are missing (NaN)
+        :param seed: random seed of the sampler's default generator
+        """
+        self.zone_index = pd.Index(zone_ids)
+        self.activity_index = pd.Index(activities)
+        self.offsets = offsets
+        self.coords = coords
+        self.aliases = {} if aliases is None else aliases
+        self.fallback = fallback
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def from_facilities(
+        cls,
+        facilities: gp.GeoDataFrame,
+        zones: gp.GeoDataFrame,
+        **kwargs
+    ):
+        """
+        Build a facility index, by spatially joining the facilities to the zones.
+            Facilities that intersect multiple zones are indexed in all of them.
+
+        :param facilities: facilities, with an 'activity' column
+        :param zones: zoning system, indexed by zone id
+        :param kwargs: keyword arguments passed to the FacilityIndex constructor
+        """
+        zones = gp.GeoDataFrame(
+            {'zone': zones.index.values}, geometry=zones.geometry.values, crs=zones.crs
+        )
+        joined = gp.sjoin(
+            facilities[['activity', 'geometry']], zones, how='inner', predicate='intersects'
+        )
+        zone_codes, zone_ids = pd.factorize(joined['zone'], sort=True)
+        act_codes, activities = pd.factorize(joined['activity'], sort=True)
+        group = zone_codes * len(activities) + act_codes
+        order = np.argsort(group, kind='stable')
+
+        points = joined.geometry.representative_point().values
+        coords = np.stack([points.x, points.y], axis=1)[order]
+        counts = np.bincount(group, minlength=len(zone_ids) * len(activities))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        return cls(
+            zone_ids=np.asarray(zone_ids),
+            activities=np.asarray(activities, dtype=str),
+            offsets=offsets,
+            coords=coords,
+            **kwargs
+        )
+
+    def save(self, path: str) -> None:
+        """
+        Save the facility index (.npz), so that the spatial join can be skipped in later runs
+        """
+        np.savez(
+            path,
+            zone_ids=self.zone_index.values,
+            activities=self.activity_index.values.astype(str),
+            offsets=self.offsets,
+            coords=self.coords
+        )
+
+    @classmethod
+    def load(cls, path: str, **kwargs):
+        """
+        Load a saved facility index
+
+        :param path: path to the saved (.npz) index
+        :param kwargs: keyword arguments passed to the FacilityIndex constructor
+        """
+        with np.load(path) as data:
+            return cls(
+                zone_ids=data['zone_ids'],
+                activities=data['activities'],
+                offsets=data['offsets'],
+                coords=data['coords'],
+                **kwargs
+            )
+
+    def get_activity_codes(self, acts) -> np.ndarray:
+        """
+        Get the facility activity position of each activity (-1 if missing),
+            resolving the aliases of activities without facilities.
+        """
+        codes, labels = pd.factorize(acts)
+        labels = [x if x in self.activity_index else self.aliases.get(x, x) for x in labels]
+        lookup = np.append(self.activity_index.get_indexer(labels), -1)
+        return lookup[codes]
+
+    def sample(
+        self,
+        zones: np.ndarray,
+        acts,
+        rng: Optional[np.random.Generator] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sample a facility location for each (zone, activity),
+            with a batched random draw among the facilities of each combination.
+
+        :param zones: zone ids
+        :param acts: activity types
+        :param rng: random number generator. Defaults to the sampler's generator.
+        :return: x and y coordinate arrays
+        """
+        rng = self.rng if rng is None else rng
+        zone_codes = self.zone_index.get_indexer(np.asarray(zones))
+        act_codes = self.get_activity_codes(acts)
+        found = (zone_codes >= 0) & (act_codes >= 0)
+        group = np.where(found, zone_codes * len(self.activity_index) + act_codes, 0)
+
+        start = self.offsets[group]
+        count = np.where(found, self.offsets[group + 1] - start, 0)
+        found &= count > 0
+        idx = start + (rng.random(len(group)) * count).astype(np.int64)
+
+        x = np.full(len(group), np.nan)
+        y = np.full(len(group), np.nan)
+        x[found], y[found] = self.coords[idx[found], 0], self.coords[idx[found], 1]
+
+        # default to random points within the zone
+        if self.fallback is not None and not found.all():
+            x[~found], y[~found] = self.fallback.sample(np.asarray(zones)[~found], rng=rng)
+
+        return x, y
+
+
+def sample_locations(
+    store: PopulationStore,
+    sampler: ZonePointSampler,
+    long_term_activities: Optional[list] = None,
+    joint_trips_prefix: str = 'escort_',
+    seed: Optional[int] = None
+) -> PopulationStore:
+    """
+    Sample the activity locations of a population store
+        (following pam.core.Population.sample_locs).
+    Household members share a single location for each zone and long-term activity
+        (ie home, work, and education), while other activities are sampled independently.
+        Escort activities are treated as the escorted activity.
+
+    :param store: population store
+    :param sampler: location sampler (ZonePointSampler or FacilityIndex)
+    :param long_term_activities: activities that are assigned one location per household and zone
+    :param joint_trips_prefix: activity prefix of escort/joint trips
+    :param seed: random seed (or generator), for reproducible results
+    :return: a new population store, with the activity x/y coordinates
+    """
+    if long_term_activities is None:
+        long_term_activities = LONG_TERM_ACTIVITIES
+    rng = np.random.default_rng(seed)
+    activities = store.activities
+
+    # target activity (without escort prefix)
+    act_codes, act_labels = pd.factorize(
+        activities.act.cat.categories.str.replace(f'^{joint_trips_prefix}', '', regex=True)
+    )
+    act_codes = act_codes[activities.act.cat.codes.values]
+    long_term = np.isin(act_labels, long_term_activities)[act_codes]
+
+    # one location per (household, zone, activity) for long-term activities
+    n_persons = np.diff(store.person_offsets)
+    person_hh = np.repeat(np.arange(store.n_households), n_persons)
+    act_hh = np.repeat(person_hh, np.diff(store.act_offsets))
+    shared_keys, shared = pd.MultiIndex.from_arrays([
+        act_hh[long_term], activities.zone.values[long_term], act_codes[long_term]
+    ]).factorize()
+    n_shared, n_other = len(shared), (~long_term).sum()
+    keys = np.empty(len(activities), dtype=np.int64)
+    keys[long_term] = shared_keys
+    keys[~long_term] = n_shared + np.arange(n_other)
+
+    key_zones = np.empty(n_shared + n_other, dtype=activities.zone.dtype)
+    key_zones[keys] = activities.zone.values
+    key_acts = np.empty(n_shared + n_other, dtype=act_codes.dtype)
+    key_acts[keys] = act_codes
+    x, y = sampler.sample(
+        key_zones, pd.Categorical.from_codes(key_acts, act_labels), rng=rng
+    )
+
+    activities = activities.copy()
+    activities['x'] = x[keys]
+    activities['y'] = y[keys]
+
+    return PopulationStore(
+        households=store.households,
+        persons=store.persons,
+        activities=activities,
+        legs=store.legs,
+        person_offsets=store.person_offsets,
+        act_offsets=store.act_offsets,
+        leg_offsets=store.leg_offsets
+    )
@@ -0,0 +1,348 @@
+"""
+Raking (iterative proportional fitting) of the survey expansion weights to control totals,
+    ie zonal population totals and age group, gender, income and car ownership marginals.
+
+Constraints are stored as a sparse (coordinate) respondent x category matrix:
+    every row has (at most) one category code per controlled attribute,
+    so that the weighted marginals of an attribute are a single `np.bincount`.
+    Respondents with the same categories are fitted together (see `Constraints`).
+"""
+from typing import Optional
+import numpy as np
+import pandas as pd
+
+# person attributes that can be controlled
+CONTROL_ATTRIBUTES = ['hzone', 'age_group', 'gender', 'income', 'car_own']
+CONTROLS_COLUMNS = ['attribute', 'category', 'total']
+
+
+def load_controls(path: str) -> pd.DataFrame:
+    """
+    Load the control totals (csv), in long format, ie:
+        attribute,category,total
+        hzone,1,120000
+        hzone,2,95000
+        gender,female,1950000
+        ...
+    Categories are read as strings.
+    """
+    controls = pd.read_csv(path, dtype={'attribute': str, 'category': str, 'total': float})
+    validate_controls(controls)
+    return controls
+
+
+def validate_controls(controls: pd.DataFrame) -> None:
+    """
+    Check the columns, attributes and totals of a control totals table
+    """
+    missing = set(CONTROLS_COLUMNS) - set(controls.columns)
+    if missing:
+        raise ValueError(f'Missing control totals columns: {missing}')
+    unknown = set(controls['attribute']) - set(CONTROL_ATTRIBUTES)
+    if unknown:
+        raise ValueError(f'Unknown control attributes: {unknown}. Use any of {CONTROL_ATTRIBUTES}')
+    if controls[['attribute', 'category']].duplicated().any():
+        raise ValueError('Control totals must have one row per attribute category')
+    if controls['total'].isna().any() or (controls['total'] < 0).any():
+        raise ValueError('Control totals must be non-negative numbers')
+
+
+def get_category_codes(values: pd.Series, categories: pd.Index) -> np.ndarray:
+    """
+    Get the position of each value in a list of (string) categories,
+        looking up the unique values only. Missing or unknown values get code -1.
+    """
+    codes, uniques = pd.factorize(values)
+    lookup = categories.get_indexer(pd.Index(uniques).astype(str))
+    return np.where(codes >= 0, lookup[codes], -1)
+
+
+def get_marginals(
+    persons: pd.DataFrame,
+    weights: np.ndarray,
+    attributes: Optional[list] = None
+) -> pd.DataFrame:
+    """
+    Get the weighted person totals of each attribute category,
+        in the format of the control totals (attribute, category, total).
+
+    :param persons: person attributes table
+    :param weights: weight of each person
+    :param attributes: attributes to summarise (defaults to all controllable attributes)
+    """
+    if attributes is None:
+        attributes = CONTROL_ATTRIBUTES
+    marginals = []
+    for attribute in attributes:
+        totals = pd.Series(weights).groupby(persons[attribute].astype(str).values).sum()
+        marginals.append(pd.DataFrame({
+            'attribute': attribute,
+            'category': totals.index,
+            'total': totals.values
+        }))
+    return pd.concat(marginals, ignore_index=True)
+
+
+class Constraints:
+    """
+    Person-level control totals, fitted through household weights.
+
+    The constraint matrix is stored by cell: households whose persons have the same
+        controlled categories always get the same raking factor, so that single-person households
+        are grouped by their combination of categories (multi-person households are cells of their own).
+        The IPF then runs over cells rather than respondents, and its cost does not grow with the survey size.
+
+    Each cell has rows of (cell, category codes, multiplicity):
+        for each controlled attribute, `codes[attribute]` is the category (column) of each row
+        in the constraint matrix, or -1 for persons without a controlled category
+        (ie missing values), which are not constrained by that attribute.
+        The multiplicity of a row is its number of persons in each household of the cell.
+    """
+
+    def __init__(
+        self,
+        persons: pd.DataFrame,
+        controls: pd.DataFrame,
+        person_households: Optional[np.ndarray] = None
+    ):
+        """
+        :param persons: person attributes table
+        :param controls: control totals (see `load_controls`)
+        :param person_households: household index of each person
+            (defaults to one household per person)
+        """
+        validate_controls(controls)
+        if person_households is None:
+            person_households = np.arange(len(persons))
+        person_households = np.asarray(person_households)
+        n_households = int(person_households.max()) + 1 if len(persons) else 0
+        household_size = np.bincount(person_households, minlength=n_households)
+
+        self.attributes = list(pd.unique(controls['attribute']))
+        self.categories = {}
+        self.targets = {}
+        person_codes = {}
+        for attribute, group in controls.groupby('attribute', sort=False):
+            self.categories[attribute] = pd.Index(group['category'].astype(str))
+            self.targets[attribute] = group['total'].values.astype(float)
+            person_codes[attribute] = get_category_codes(
+                persons[attribute], self.categories[attribute]
+            )
+
+        # cells: single-person households by category codes, other households by themselves
+        person_codes = pd.DataFrame(person_codes)
+        key = np.where(household_size > 1, np.arange(n_households), -1)
+        first_person = np.unique(person_households, return_index=True)[1]
+        household_cells = person_codes.iloc[first_person].assign(key=key).groupby(
+            ['key'] + self.attributes, sort=False
+        ).ngroup().values
+        self.household_cells = household_cells
+        self.n_cells = int(household_cells.max()) + 1 if n_households else 0
+        cell_households = np.bincount(household_cells, minlength=self.n_cells)
+
+        # rows of the constraint matrix
+        rows = person_codes.assign(cell=household_cells[person_households]).groupby(
+            ['cell'] + self.attributes, sort=False
+        ).size().reset_index(name='count')
+        self.row_cells = rows['cell'].values
+        self.multiplicity = rows['count'].values / cell_households[self.row_cells]
+        self.codes = {attribute: rows[attribute].values for attribute in self.attributes}
+        self.cell_size = np.bincount(
+            self.row_cells, weights=self.multiplicity, minlength=self.n_cells
+        )
+
+    def get_cell_weights(self, weights: np.ndarray) -> np.ndarray:
+        """
+        Total household weight of each cell
+        """
+        return np.bincount(self.household_cells, weights=weights, minlength=self.n_cells)
+
+    def get_totals(self, attribute: str, cell_weights: np.ndarray) -> np.ndarray:
+        """
+        Weighted person totals of the categories of an attribute,
+            ie the product of the constraint matrix and the cell weights.
+        """
+        codes = self.codes[attribute]
+        controlled = codes >= 0
+        return np.bincount(
+            codes[controlled],
+            weights=(cell_weights[self.row_cells] * self.multiplicity)[controlled],
+            minlength=len(self.categories[attribute])
+        )
+
+    def get_unmatched(self) -> dict:
+        """
+        Control categories without any survey respondent, which cannot be fitted
+        """
+        return {
+            attribute: list(self.categories[attribute][
+                np.bincount(codes[codes >= 0], minlength=len(self.categories[attribute])) == 0
+            ]) for attribute, codes in self.codes.items()
+        }
+
+    def get_errors(self, weights: np.ndarray) -> pd.DataFrame:
+        """
+        Fitted totals and relative errors of each control category
+
+        :param weights: household weights
+        """
+        cell_weights = self.get_cell_weights(weights)
+        errors = []
+        for attribute in self.attributes:
+            totals = self.get_totals(attribute, cell_weights)
+            targets = self.targets[attribute]
+            errors.append(pd.DataFrame({
+                'attribute': attribute,
+                'category': self.categories[attribute],
+                'target': targets,
+                'fitted': totals,
+                'error': get_relative_errors(totals, targets)
+            }))
+        return pd.concat(errors, ignore_index=True)
+
+    def rake(
+        self,
+        weights: np.ndarray,
+        max_iter: int = 100,
+        tol: float = 1e-6
+    ) -> 'RakingResult':
+        """
+        Fit household weights to the control totals by iterative proportional fitting.
+        Each iteration scales the weights to match the totals of every attribute in turn:
+            the weight of a household is multiplied by the mean target/fitted ratio
+            of the categories of its persons (the exact IPF update for single-person households).
+        Control categories without respondents cannot be matched, and are excluded from the
+            convergence check.
+
+        :param weights: initial household weights (ie survey frequencies)
+        :param max_iter: maximum number of iterations
+        :param tol: convergence tolerance of the maximum relative error of the controlled totals
+        """
+        initial = np.asarray(weights, dtype=float)
+        initial_cells = self.get_cell_weights(initial)
+        cell_weights = initial_cells.copy()
+        matched = {
+            attribute: ~np.isin(self.categories[attribute], unmatched)
+            for attribute, unmatched in self.get_unmatched().items()
+        }
+        errors = []
+        for _ in range(max_iter):
+            for attribute in self.attributes:
+                totals = self.get_totals(attribute, cell_weights)
+                ratios = np.divide(
+                    self.targets[attribute], totals,
+                    out=np.ones_like(totals), where=totals > 0
+                )
+                # unconstrained persons keep their weight (ratio of 1)
+                row_ratios = np.append(ratios, 1)[self.codes[attribute]]
+                cell_weights *= np.bincount(
+                    self.row_cells, weights=row_ratios * self.multiplicity, minlength=self.n_cells
+                ) / np.maximum(self.cell_size, 1)
+
+            errors.append(max([
+                get_relative_errors(
+                    self.get_totals(attribute, cell_weights)[matched[attribute]],
+                    self.targets[attribute][matched[attribute]]
+                ).max(initial=0) for attribute in self.attributes
+            ], default=0))
+            if errors[-1] < tol:
+                break
+
+        # households of a cell share its raking factor
+        factors = np.divide(
+            cell_weights, initial_cells, out=np.ones_like(cell_weights), where=initial_cells > 0
+        )
+        return RakingResult(self, initial, initial * factors[self.household_cells], errors, tol)
+
+
+def get_relative_errors(totals: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    Absolute relative error of fitted totals (absolute error for zero targets)
+    """
+    return np.abs(totals - targets) / np.where(targets > 0, targets, 1)
+
+
+class RakingResult:
+    """
+    Raked household weights, with convergence diagnostics:
+        the maximum relative error of the controlled totals after each iteration.
+    """
+
+    def __init__(
+        self,
+        constraints: Constraints,
+        initial: np.ndarray,
+        weights: np.ndarray,
+        errors: list,
+        tol: float
+    ):
+        self.constraints = constraints
+        self.initial = initial
+        self.weights = weights
+        self.errors = errors
+        self.tol = tol
+
+    @property
+    def iterations(self) -> int:
+        return len(self.errors)
+
+    @property
+    def max_error(self) -> float:
+        return self.errors[-1] if self.errors else 0.0
+
+    @property
+    def converged(self) -> bool:
+        return self.max_error < self.tol
+
+    def __repr__(self) -> str:
+        status = 'converged' if self.converged else 'did not converge'
+        return (
+            f'RakingResult: {status} in {self.iterations} iterations '
+            f'(max relative error {self.max_error:.2e}).'
+        )
+
+    def report(self) -> pd.DataFrame:
+        """
+        Target, initial and fitted totals of each control category,
+            with the relative error of the fitted totals
+        """
+        report = self.constraints.get_errors(self.weights)
+        initial = self.constraints.get_errors(self.initial)
+        report.insert(3, 'initial', initial['fitted'])
+        return report
+
+
+def rake_store(
+    store,
+    controls: pd.DataFrame,
+    weights: Optional[np.ndarray] = None,
+    max_iter: int = 100,
+    tol: float = 1e-6
+) -> RakingResult:
+    """
+    Fit the household weights of a population store to control totals.
+
+    :param store: population store of the survey households
+    :param controls: control totals (see `load_controls`)
+    :param weights: initial household weights. Defaults to the household frequencies,
+        scaled to the mean control total of the attributes.
+    :param max_iter: maximum number of iterations
+    :param tol: convergence tolerance of the maximum relative error of the controlled totals
+    """
+    person_households = np.repeat(
+        np.arange(store.n_households), np.diff(store.person_offsets)
+    )
+    constraints = Constraints(store.persons, controls, person_households=person_households)
+    for attribute, unmatched in constraints.get_unmatched().items():
+        if unmatched:
+            print(f'Control categories without respondents ({attribute}): {unmatched}')
+
+    if weights is None:
+        freqs = store.households.freq.values
+        weights = np.where(freqs > 0, freqs, 1).astype(float)
+        total = controls.groupby('attribute')['total'].sum().mean()
+        weights *= total / (weights * np.diff(store.person_offsets)).sum()
+
+    result = constraints.rake(weights, max_iter=max_iter, tol=tol)
+    print(result)
+    return result
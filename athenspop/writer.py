@@ -0,0 +1,291 @@
+"""
+Streaming export of synthetic populations:
+    MATSim plans (v6) and tabular (csv) outputs are written household by household,
+    so that the full population never needs to be held in memory.
+"""
+import gzip
+import os
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+from xml.sax.saxutils import escape, quoteattr
+import numpy as np
+import pandas as pd
+
+START_OF_DAY = datetime(1900, 1, 1)
+CSV_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def matsim_time(td: timedelta) -> str:
+    """
+    Convert a timedelta to the MATSim time format (hh:mm:ss).
+    Times beyond 24 hours are expressed in hours, ie 25:00:00 for 1am the next day.
+    """
+    hours, remainder = divmod(int(td.total_seconds()), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f'{hours:02}:{minutes:02}:{seconds:02}'
+
+
+def attribute_class(value) -> str:
+    """
+    Get the java class of a MATSim attribute
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return 'java.lang.Boolean'
+    if isinstance(value, (int, np.integer)):
+        return 'java.lang.Integer'
+    if isinstance(value, (float, np.floating)):
+        return 'java.lang.Double'
+    return 'java.lang.String'
+
+
+def person_to_xml(pid: str, person, household_key: Optional[str] = None, hid: Optional[str] = None) -> str:
+    """
+    Get the MATSim (population v6) xml element of a person.
+
+    :param pid: person id
+    :param person: PAM person
+    :param household_key: if provided, the household id is added as an attribute with that name
+    :param hid: household id
+    """
+    from pam.activity import Activity, Leg
+
+    attributes = dict(person.attributes)
+    if household_key is not None:
+        attributes[household_key] = hid
+
+    lines = [f'<person id={quoteattr(str(pid))}>', '  <attributes>']
+    for k, v in attributes.items():
+        lines.append(
+            f'    <attribute class="{attribute_class(v)}" name={quoteattr(str(k))}>'
+            f'{escape(str(v))}</attribute>'
+        )
+    lines += ['  </attributes>', '  <plan selected="yes">']
+
+    for component in person.plan:
+        if isinstance(component, Activity):
+            act = f'    <activity type={quoteattr(str(component.act))}'
+            if component.start_time is not None:
+                act += f' start_time="{matsim_time(component.start_time - START_OF_DAY)}"'
+            if component.end_time is not None:
+                act += f' end_time="{matsim_time(component.end_time - START_OF_DAY)}"'
+            if component.location.loc is not None:
+                act += f' x="{component.location.loc.x}" y="{component.location.loc.y}"'
+            lines.append(act + '/>')
+        elif isinstance(component, Leg):
+            lines.append(
+                f'    <leg mode={quoteattr(str(component.mode))} '
+                f'trav_time="{matsim_time(component.duration)}"/>'
+            )
+
+    lines += ['  </plan>', '</person>', '']
+    return '\n'.join(lines)
+
+
+def household_to_records(hid: str, household) -> tuple:
+    """
+    Get the household, person, leg and activity records of a household,
+        following the PAM tabular (csv) output format.
+        Activity locations are stored as x/y columns.
+    """
+    from pam.activity import Activity, Leg
+
+    hzone = household.location.area
+    hh_data = {'hid': hid, 'freq': household.freq, 'hzone': hzone}
+    if isinstance(household.attributes, dict):
+        hh_data.update(household.attributes)
+    hhs, people, legs, acts = [hh_data], [], [], []
+
+    for pid, person in household.people.items():
+        people_data = {'pid': pid, 'hid': hid, 'freq': person.freq, 'hzone': hzone}
+        if isinstance(person.attributes, dict):
+            people_data.update(person.attributes)
+        people.append(people_data)
+
+        plan = list(person.plan)
+        for seq, component in enumerate(plan):
+            if isinstance(component, Leg):
+                legs.append({
+                    'pid': pid,
+                    'hid': hid,
+                    'freq': component.freq,
+                    'ozone': component.start_location.area,
+                    'dzone': component.end_location.area,
+                    'purp': component.purp,
+                    'origin activity': plan[seq-1].act,
+                    'destination activity': plan[seq+1].act,
+                    'mode': component.mode,
+                    'seq': component.seq,
+                    'tst': component.start_time,
+                    'tet': component.end_time,
+                    'duration': str(component.duration),
+                })
+            elif isinstance(component, Activity):
+                loc = component.location.loc
+                acts.append({
+                    'pid': pid,
+                    'hid': hid,
+                    'freq': component.freq,
+                    'activity': component.act,
+                    'seq': component.seq,
+                    'start time': component.start_time,
+                    'end time': component.end_time,
+                    'duration': str(component.duration),
+                    'zone': component.location.area,
+                    'x': loc.x if loc is not None else None,
+                    'y': loc.y if loc is not None else None,
+                })
+
+    return hhs, people, legs, acts
+
+
+def serialize_households(
+    households: Iterable,
+    household_key: Optional[str] = 'hid',
+    write_csv: bool = True
+) -> tuple:
+    """
+    Serialize a batch of PAM households,
+        so that batches can be prepared in parallel and written in order.
+
+    :param households: PAM households
+    :param household_key: if provided, household ids are added as a person attribute with that name
+    :param write_csv: whether to get the tabular (csv) records
+    :return: the MATSim plans xml, the csv records (a DataFrame of each table),
+        and the number of households and people of the batch
+    """
+    plans, n_households, n_people = [], 0, 0
+    records = {table: [] for table in PopulationWriter.tables}
+    for household in households:
+        hid = household.hid
+        for pid, person in household.people.items():
+            plans.append(person_to_xml(pid, person, household_key, hid))
+            n_people += 1
+        n_households += 1
+
+        if write_csv:
+            for table, rows in zip(PopulationWriter.tables, household_to_records(hid, household)):
+                records[table] += rows
+
+    records = {table: pd.DataFrame(rows) for table, rows in records.items()}
+    return ''.join(plans), records, n_households, n_people
+
+
+class PopulationWriter:
+    """
+    Write a population to disk in batches of households.
+        Outputs are a MATSim plans file (plans.xml, or plans.xml.gz if gzip-compressed),
+        and the households, people, legs and activities csv tables.
+
+    Example:
+        with PopulationWriter(path_outputs, comment='Athens example pop') as writer:
+            for households in batches:
+                writer.add_households(households)
+    """
+
+    tables = ['households', 'people', 'legs', 'activities']
+    table_index = {'households': 'hid', 'people': 'pid'}
+
+    def __init__(
+        self,
+        path_outputs: str,
+        comment: Optional[str] = None,
+        compression: Optional[str] = None,
+        household_key: Optional[str] = 'hid',
+        write_csv: bool = True
+    ):
+        """
+        :param path_outputs: output directory
+        :param comment: optional comment added to the plans file
+        :param compression: plans file compression (None or 'gzip')
+        :param household_key: if provided, household ids are added as a person attribute with that name
+        :param write_csv: whether to write the tabular (csv) outputs
+        """
+        if compression not in [None, 'gzip']:
+            raise ValueError(f'Unsupported compression: {compression}')
+        self.path_outputs = path_outputs
+        self.comment = comment
+        self.compression = compression
+        self.household_key = household_key
+        self.write_csv = write_csv
+        self.plans_path = os.path.join(
+            path_outputs, 'plans.xml.gz' if compression == 'gzip' else 'plans.xml'
+        )
+        self.plans_file = None
+        self.csv_columns = {}
+        self.csv_rows = {}
+        self.n_households = 0
+        self.n_people = 0
+
+    def __enter__(self):
+        os.makedirs(self.path_outputs, exist_ok=True)
+        if self.compression == 'gzip':
+            self.plans_file = gzip.open(self.plans_path, 'wt', encoding='utf-8', compresslevel=6)
+        else:
+            self.plans_file = open(self.plans_path, 'w', encoding='utf-8')
+
+        self.plans_file.write(
+            "<?xml version='1.0' encoding='utf-8'?>\n"
+            '<!DOCTYPE population SYSTEM "http://matsim.org/files/dtd/population_v6.dtd">\n'
+        )
+        if self.comment:
+            self.plans_file.write(f'<!--{self.comment}-->\n')
+        self.plans_file.write(f'<!--Created {datetime.today()}-->\n')
+        self.plans_file.write('<population>\n')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.plans_file.write('</population>\n')
+        self.plans_file.close()
+
+    def add_households(self, households: Iterable) -> None:
+        """
+        Write a batch of PAM households
+        """
+        self.add_serialized(
+            *serialize_households(households, self.household_key, self.write_csv)
+        )
+
+    def add_serialized(
+        self,
+        plans: str,
+        records: dict,
+        n_households: int,
+        n_people: int
+    ) -> None:
+        """
+        Write a batch of serialized households (see serialize_households)
+        """
+        self.plans_file.write(plans)
+        self.n_households += n_households
+        self.n_people += n_people
+
+        if self.write_csv:
+            for table, rows in records.items():
+                self.append_csv(table, rows)
+
+    def append_csv(self, table: str, rows) -> None:
+        """
+        Append records (a list of dicts or a DataFrame) to a csv table.
+            The table columns are set by the first batch of records.
+        """
+        if len(rows) == 0:
+            return None
+        df = pd.DataFrame(rows)
+        header = table not in self.csv_columns
+        if header:
+            self.csv_columns[table] = list(df.columns)
+            self.csv_rows[table] = 0
+        df = df.reindex(columns=self.csv_columns[table])
+
+        if table in self.table_index:
+            df = df.set_index(self.table_index[table])
+        else:
+            df.index = pd.RangeIndex(self.csv_rows[table], self.csv_rows[table] + len(df))
+        self.csv_rows[table] += len(df)
+
+        df.to_csv(
+            os.path.join(self.path_outputs, f'{table}.csv'),
+            mode='w' if header else 'a',
+            header=header,
+            date_format=CSV_TIME_FORMAT
+        )
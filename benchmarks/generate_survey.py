@@ -0,0 +1,90 @@
+"""
+Generate synthetic travel diaries, following the schema of the NTUA travel survey
+    (NEW_diaries_athens_final.csv), for benchmarking the population pipeline.
+
+Example:
+    python benchmarks/generate_survey.py 100000 -o benchmarks/data/100k
+"""
+import argparse
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from athenspop import mappings
+
+SURVEY_FILE = 'NEW_diaries_athens_final.csv'
+PATH_ZONES = os.path.join(
+    os.path.dirname(__file__), '..', 'tests', 'example_data', 'shp_zones'
+)
+N_TRIPS = 5
+N_ZONES = 35
+
+
+def generate_survey(n: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Generate n synthetic travel diaries (one row per respondent).
+    Respondents make 1-5 trips in non-decreasing hours, some of them rolling over to the next day,
+        and most (but not all) diaries end with a return trip home.
+
+    :param n: number of respondents
+    :param seed: random seed
+    """
+    rng = np.random.default_rng(seed)
+    purposes = [x for x in mappings.purpose if x != '2: return home']
+
+    def choice(labels, size, p_missing=0):
+        values = np.asarray(list(labels), dtype=object)[rng.integers(0, len(labels), size)]
+        values[rng.random(size) < p_missing] = np.nan
+        return values
+
+    survey = pd.DataFrame({
+        'pid': np.char.add('synthetic_', np.arange(n).astype(str)),
+        'gender': choice(mappings.gender, n),
+        'age': np.where(rng.random(n) < 0.02, np.nan, rng.integers(15, 90, n)),
+        'education': choice(mappings.education, n),
+        'employment': choice(mappings.employment, n),
+        'income': choice(mappings.income, n, p_missing=0.1),
+        'car_own': choice(mappings.car_own, n),
+        'home': rng.integers(1, N_ZONES + 1, n),
+    })
+
+    n_trips = rng.integers(1, N_TRIPS + 1, n)
+    returns_home = rng.random(n) > 0.3
+    hour = rng.integers(5, 12, n)
+    for i in range(1, N_TRIPS + 1):
+        has_trip = i <= n_trips
+        is_return = (i == n_trips) & returns_home
+        dest = np.where(is_return, survey['home'], rng.integers(1, N_ZONES + 2, n))
+        purp = np.where(is_return, '2: return home', choice(purposes, n))
+        survey[f'dest{i}'] = np.where(has_trip, dest, np.nan)
+        survey[f'purp{i}'] = np.where(has_trip, purp, np.nan)
+        survey[f'mode{i}'] = np.where(has_trip, choice(mappings.modes, n), np.nan)
+        survey[f'time{i}'] = np.where(has_trip, hour % 24, np.nan)
+        hour = hour + rng.integers(0, 5, n)
+
+    return survey
+
+
+def write_survey(n: int, path: str, seed: int = 0) -> str:
+    """
+    Write a synthetic survey input directory (diaries and zones shapefile)
+
+    :return: path to the diaries file
+    """
+    os.makedirs(path, exist_ok=True)
+    shutil.copytree(PATH_ZONES, os.path.join(path, 'shp_zones'), dirs_exist_ok=True)
+    # the diaries are written last, through a temporary file,
+    #   so that an existing diaries file marks a complete directory
+    path_survey = os.path.join(path, SURVEY_FILE)
+    generate_survey(n, seed=seed).to_csv(f'{path_survey}.tmp', index=False)
+    os.replace(f'{path_survey}.tmp', path_survey)
+    return path_survey
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('n', type=int, help='Number of respondents')
+    parser.add_argument('-o', '--path_outputs', required=True, help='Output directory')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+    print(f'Survey written to {write_survey(args.n, args.path_outputs, args.seed)}')
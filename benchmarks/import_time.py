@@ -0,0 +1,85 @@
+"""
+Check the start-up time of the athenspop CLI against an import-time budget.
+
+Each check runs in a fresh interpreter (the minimum of several runs is kept).
+    The run fails if any check exceeds its budget,
+    or if the CLI imports heavy modules before a command is run.
+
+Example:
+    python benchmarks/import_time.py --repeat 5
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+# time budgets (s), including the interpreter start-up
+BUDGETS = {
+    'athenspop --help': 0.3,
+    'import athenspop.core': 1.5,
+}
+COMMANDS = {
+    'athenspop --help': 'from athenspop.cli import cli; cli(["--help"])',
+    'import athenspop.core': 'import athenspop.core',
+}
+# modules that should not be imported by the cli before a command runs
+HEAVY_MODULES = ['pandas', 'geopandas', 'shapely', 'pam', 'matplotlib']
+
+
+def time_command(code: str, repeat: int = 5) -> float:
+    """
+    Minimum wall time (s) of running python code in a fresh interpreter
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', code], check=True, stdout=subprocess.DEVNULL
+        )
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def get_cli_imports() -> list:
+    """
+    Heavy modules imported with the cli
+    """
+    output = subprocess.run(
+        [sys.executable, '-c', (
+            'import sys; import athenspop.cli; '
+            f'print(",".join(m for m in {HEAVY_MODULES} if m in sys.modules))'
+        )],
+        check=True, capture_output=True, text=True
+    ).stdout.strip()
+    return [x for x in output.split(',') if x]
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs of each check')
+    parser.add_argument('--scale', type=float, default=1,
+                        help='Budget multiplier (ie for slower machines)')
+    args = parser.parse_args(args)
+
+    failures = []
+    for name, code in COMMANDS.items():
+        elapsed = time_command(code, repeat=args.repeat)
+        budget = BUDGETS[name] * args.scale
+        print(f'{name}: {elapsed:.3f}s (budget {budget:.3f}s)')
+        if elapsed > budget:
+            failures.append(f'{name}: {elapsed:.3f}s > {budget:.3f}s')
+
+    heavy_imports = get_cli_imports()
+    print(f"Heavy modules imported by the cli: {heavy_imports or 'none'}")
+    if heavy_imports:
+        failures.append(f'the cli imports {heavy_imports}')
+
+    if failures:
+        print('\nImport-time budget exceeded:\n  ' + '\n  '.join(failures))
+        return 1
+    print('\nWithin the import-time budget.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
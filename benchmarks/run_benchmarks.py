@@ -0,0 +1,333 @@
+"""
+Benchmark the stages of the population pipeline on synthetic travel diaries,
+    recording the run time and peak (traced) memory of each stage.
+
+Results are compared against stored baselines (benchmarks/baselines.json),
+    and the run fails if any stage regresses beyond the given tolerances.
+    Baselines are machine-specific: use --save to (re)create them on the benchmarking machine.
+
+Example:
+    python benchmarks/run_benchmarks.py --sizes 10k 100k
+    python benchmarks/run_benchmarks.py --sizes 10k 100k 1m --save
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Optional
+import numpy as np
+import pandas as pd
+from pam import write
+from athenspop import preprocessing, spatial, weights
+from athenspop.core import get_sample_counts
+from athenspop.jitter import jitter_store
+from athenspop.population import PopulationStore
+from athenspop.writer import PopulationWriter
+sys.path.insert(0, os.path.dirname(__file__))
+from generate_survey import SURVEY_FILE, write_survey  # noqa: E402
+
+SIZES = {'10k': 10**4, '100k': 10**5, '1m': 10**6}
+PATH_BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+PATH_DATA = os.path.join(os.path.dirname(__file__), 'data')
+MB = 2**20
+
+
+def stage_read_survey(state: dict) -> int:
+    state['survey'] = preprocessing.read_survey(
+        state['path_survey'], fix_return=False, fix_market=False
+    )
+    return len(state['survey'])
+
+
+def stage_fix_nobackhome(state: dict) -> int:
+    state['survey'] = preprocessing.fix_nobackhome(state['survey'], seed=state['seed'])
+    return int(state['survey']['infilled'].sum())
+
+
+def stage_fix_market_window(state: dict) -> int:
+    state['survey'] = preprocessing.fix_market_window(state['survey'])
+    return len(state['survey'])
+
+
+def stage_get_person_attributes(state: dict) -> int:
+    state['person_attributes'] = preprocessing.get_person_attributes(state['survey'])
+    return len(state['person_attributes'])
+
+
+def stage_get_trips_table(state: dict) -> int:
+    state['trips'] = preprocessing.get_trips_table(state['survey'])
+    return len(state['trips'])
+
+
+def stage_build_population(state: dict) -> int:
+    state['store'] = PopulationStore.from_trips(state['trips'], state['person_attributes'])
+    return len(state['store'])
+
+
+def stage_raking(state: dict) -> int:
+    # controls: survey marginals of a randomly reweighted population
+    rng = np.random.default_rng(state['seed'])
+    controls = weights.get_marginals(
+        state['store'].persons, rng.lognormal(0, 0.5, len(state['store']))
+    )
+    controls = controls[controls['category'] != 'nan']
+    return weights.rake_store(state['store'], controls).iterations
+
+
+def stage_upscale(state: dict) -> int:
+    counts = get_sample_counts(state['store'], state['scale_factor'], seed=state['seed'])
+    state['store'] = state['store'].repeat(counts)
+    return len(state['store'])
+
+
+def stage_jitter(state: dict) -> int:
+    state['store'] = jitter_store(state['store'], seed=state['seed'])
+    return len(state['store'].activities)
+
+
+def stage_get_zones(state: dict) -> int:
+    state['zones'] = preprocessing.get_zones(state['path_zones'], memoize=False)
+    return len(state['zones'])
+
+
+def stage_sample_locations(state: dict) -> int:
+    sampler = spatial.ZonePointSampler(state['zones'])
+    state['store'] = spatial.sample_locations(state['store'], sampler, seed=state['seed'])
+    return len(state['store'].activities)
+
+
+def stage_write_matsim(state: dict) -> int:
+    population = state['store'].to_pam()
+    write.write_matsim(
+        population, plans_path=os.path.join(state['path_outputs'], 'plans.xml')
+    )
+    return len(population)
+
+
+def stage_write_stream(state: dict) -> int:
+    with PopulationWriter(
+        os.path.join(state['path_outputs'], 'stream'), write_csv=False
+    ) as writer:
+        for households in state['store'].iter_batches():
+            writer.add_households(households)
+    return writer.n_people
+
+
+STAGES = {
+    'read_survey': stage_read_survey,
+    'fix_nobackhome': stage_fix_nobackhome,
+    'fix_market_window': stage_fix_market_window,
+    'get_person_attributes': stage_get_person_attributes,
+    'get_trips_table': stage_get_trips_table,
+    'build_population': stage_build_population,
+    'raking': stage_raking,
+    'upscale': stage_upscale,
+    'jitter': stage_jitter,
+    'get_zones': stage_get_zones,
+    'sample_locations': stage_sample_locations,
+    'write_matsim': stage_write_matsim,
+    'write_stream': stage_write_stream,
+}
+# output stages, which no later stage depends on
+OUTPUT_STAGES = ['write_matsim', 'write_stream']
+
+
+def measure(stage: Callable, state: dict, trace_memory: bool = False) -> dict:
+    """
+    Run a pipeline stage, measuring its run time (s),
+        and (optionally) its peak traced memory allocation (MB)
+    """
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    count = stage(state)
+    elapsed = time.perf_counter() - t0
+    result = {'time': round(elapsed, 4), 'count': count}
+    if trace_memory:
+        result['peak_memory'] = round(tracemalloc.get_traced_memory()[1] / MB, 2)
+        tracemalloc.stop()
+    return result
+
+
+def run_pipeline(
+    path_data: str,
+    scale_factor: float = 1,
+    seed: int = 0,
+    trace_memory: bool = False,
+    stages: Optional[list] = None
+) -> dict:
+    """
+    Run the pipeline stages in sequence on a synthetic survey directory
+
+    :return: the measurements of each stage
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as path_outputs:
+        state = {
+            'path_survey': os.path.join(path_data, SURVEY_FILE),
+            'path_zones': os.path.join(path_data, 'shp_zones', 'zones_attica.shp'),
+            'path_outputs': path_outputs,
+            'scale_factor': scale_factor,
+            'seed': seed,
+        }
+        for name, stage in STAGES.items():
+            if stages is not None and name not in stages:
+                # stages are sequential: skipped stages still run, unmeasured
+                #   (except for the output stages)
+                if name not in OUTPUT_STAGES:
+                    stage(state)
+                continue
+            results[name] = measure(stage, state, trace_memory=trace_memory)
+    return results
+
+
+def benchmark(
+    n: int,
+    path_data: str,
+    repeat: int = 1,
+    trace_memory: bool = True,
+    **kwargs
+) -> dict:
+    """
+    Benchmark the pipeline on n synthetic respondents.
+        Run times are the minimum of `repeat` runs.
+        Memory is traced in a separate run, as tracing slows down execution.
+    """
+    if not os.path.exists(os.path.join(path_data, SURVEY_FILE)):
+        write_survey(n, path_data)
+
+    runs = [run_pipeline(path_data, **kwargs) for _ in range(repeat)]
+    results = {
+        name: {
+            'time': min(run[name]['time'] for run in runs),
+            'count': runs[0][name]['count']
+        } for name in runs[0]
+    }
+    if trace_memory:
+        for name, result in run_pipeline(path_data, trace_memory=True, **kwargs).items():
+            results[name]['peak_memory'] = result['peak_memory']
+    return results
+
+
+def compare(
+    results: dict,
+    baseline: dict,
+    time_tolerance: float = 0.3,
+    memory_tolerance: float = 0.1,
+    min_time: float = 0.05,
+    min_memory: float = 1
+) -> list:
+    """
+    Compare stage measurements against a baseline.
+        Differences below `min_time` (s) or `min_memory` (MB) are treated as noise.
+        Measurements without a baseline are reported as failures,
+        so that a missing baseline cannot pass as "no regressions".
+
+    :return: a list of regression (and missing baseline) messages
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            regressions.append(f'{name}: no baseline')
+            continue
+        for metric, tolerance, noise in [
+            ('time', time_tolerance, min_time),
+            ('peak_memory', memory_tolerance, min_memory)
+        ]:
+            if metric not in result:
+                continue
+            if metric not in baseline[name]:
+                regressions.append(f'{name}: no {metric} baseline')
+                continue
+            value, reference = result[metric], baseline[name][metric]
+            if value > reference * (1 + tolerance) and value - reference > noise:
+                regressions.append(
+                    f'{name}: {metric} {value} > {reference} (+{value / reference - 1:.0%})'
+                )
+    return regressions
+
+
+def print_results(label: str, results: dict, baseline: dict) -> None:
+    df = pd.DataFrame(results).T
+    for metric in ['time', 'peak_memory']:
+        if metric in df:
+            df[f'{metric}_baseline'] = [
+                baseline.get(name, {}).get(metric, np.nan) for name in df.index
+            ]
+    print(f'\n{label}')
+    print(df.to_string())
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', nargs='+', default=['10k'], choices=list(SIZES))
+    parser.add_argument('--stages', nargs='+', default=None, choices=list(STAGES),
+                        help='Stages to measure (default: all)')
+    parser.add_argument('--baselines', default=PATH_BASELINES, help='Path to the baselines file')
+    parser.add_argument('--path_data', default=PATH_DATA, help='Synthetic survey directory')
+    parser.add_argument('--save', action='store_true', help='Save the results as the new baselines')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of timed runs')
+    parser.add_argument('--no_memory', action='store_true', help='Skip the memory tracing run')
+    parser.add_argument('--scale_factor', type=float, default=1,
+                        help='Synthetic/survey population ratio of the upscaling stage')
+    parser.add_argument('--time_tolerance', type=float, default=0.3)
+    parser.add_argument('--memory_tolerance', type=float, default=0.1)
+    args = parser.parse_args(args)
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+
+    regressions = []
+    for label in args.sizes:
+        results = benchmark(
+            SIZES[label],
+            os.path.join(args.path_data, label),
+            repeat=args.repeat,
+            trace_memory=not args.no_memory,
+            scale_factor=args.scale_factor,
+            stages=args.stages
+        )
+        baseline = baselines.get(label, {}).get('stages', {})
+        print_results(label, results, baseline)
+        if not args.save and label not in baselines:
+            regressions.append(f'{label}: no baseline (use --save to create it)')
+            continue
+        if not args.save and baselines[label].get('scale_factor') != args.scale_factor:
+            regressions.append(
+                f"{label}: baseline scale factor {baselines[label].get('scale_factor')} "
+                f"!= {args.scale_factor}"
+            )
+            continue
+        if args.save:
+            baselines[label] = {
+                'n': SIZES[label],
+                'scale_factor': args.scale_factor,
+                'stages': {**baseline, **results}
+            }
+        else:
+            regressions += [f'{label} {x}' for x in compare(
+                results, baseline, args.time_tolerance, args.memory_tolerance
+            )]
+
+    if args.save:
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        print(f'\nBaselines saved to {args.baselines}')
+        return 0
+
+    if regressions:
+        print('\nRegressions (or missing baselines):\n  ' + '\n  '.join(regressions))
+        return 1
+    print('\nNo regressions.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,23 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+from generate_survey import write_survey  # noqa: E402
+
+PATH_EXAMPLE_DATA = os.path.join(os.path.dirname(__file__), 'example_data')
+
+
+@pytest.fixture(scope='session')
+def path_example_survey():
+    return os.path.join(PATH_EXAMPLE_DATA, 'NEW_diaries_athens_final.csv')
+
+
+@pytest.fixture(scope='session')
+def path_synthetic_survey(tmp_path_factory):
+    """
+    Synthetic survey with missing return trips and next-day trips
+    """
+    return write_survey(2000, str(tmp_path_factory.mktemp('synthetic')), seed=0)
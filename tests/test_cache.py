@@ -0,0 +1,20 @@
+from athenspop import cache
+
+
+def test_survey_cache(path_example_survey, tmp_path, capsys):
+    persons, trips = cache.load_survey_tables(path_example_survey, cache_dir=tmp_path, seed=0)
+    capsys.readouterr()
+    cached_persons, cached_trips = cache.load_survey_tables(
+        path_example_survey, cache_dir=tmp_path, seed=0
+    )
+
+    assert 'Loading cached survey tables' in capsys.readouterr().out
+    assert cached_persons.equals(persons)
+    assert cached_trips.equals(trips)
+
+
+def test_survey_cache_without_seed(path_example_survey, tmp_path, capsys):
+    cache.load_survey_tables(path_example_survey, cache_dir=tmp_path)
+
+    assert 'not cached' in capsys.readouterr().out
+    assert not any(tmp_path.iterdir())
@@ -0,0 +1,55 @@
+from datetime import timedelta
+import numpy as np
+import pytest
+from athenspop import preprocessing
+from athenspop.jitter import jitter_store
+from athenspop.population import PopulationStore
+
+time_samplers = pytest.importorskip('pam.samplers.time')
+
+
+@pytest.fixture(scope='module')
+def store(path_synthetic_survey):
+    survey = preprocessing.read_survey(path_synthetic_survey, seed=1)
+    store = PopulationStore.from_trips(
+        preprocessing.get_trips_table(survey, wrap_next_day=True),
+        preprocessing.get_person_attributes(survey)
+    )
+    counts = np.random.default_rng(5).integers(0, 3, store.n_households)
+    return store.repeat(counts)
+
+
+@pytest.mark.parametrize('crop', [True, False])
+def test_jitter_matches_pam(store, monkeypatch, crop):
+    jittered = jitter_store(store, crop=crop, seed=11, chunk_size=500)
+
+    # replay the same uniform draws through PAM's jitter
+    uniform = np.random.default_rng(11).random(len(store.activities))
+    draws = []
+    monkeypatch.setattr(time_samplers, 'randrange', lambda n: int(draws.pop(0) * n))
+    population = store.to_pam()
+    for k, (hid, pid, person) in enumerate(population.people()):
+        draws[:] = list(uniform[store.act_offsets[k]:store.act_offsets[k+1]])
+        time_samplers.apply_jitter_to_plan(
+            person.plan, jitter=timedelta(minutes=30), min_duration=timedelta(minutes=10)
+        )
+        if crop:
+            person.plan.crop()
+    expected = PopulationStore.from_population(population)
+
+    np.testing.assert_array_equal(jittered.act_offsets, expected.act_offsets)
+    np.testing.assert_array_equal(jittered.leg_offsets, expected.leg_offsets)
+    for table in ['activities', 'legs']:
+        for col in ['start', 'end']:
+            np.testing.assert_array_equal(
+                getattr(jittered, table)[col].values, getattr(expected, table)[col].values
+            )
+
+
+def test_jitter_chunk_size(store):
+    a = jitter_store(store, seed=3, chunk_size=100)
+    b = jitter_store(store, seed=3, chunk_size=100000)
+    for table in ['activities', 'legs']:
+        np.testing.assert_array_equal(
+            getattr(a, table)[['start', 'end']].values, getattr(b, table)[['start', 'end']].values
+        )
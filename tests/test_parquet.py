@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from athenspop import parquet, preprocessing
+from athenspop.population import PopulationStore
+
+
+@pytest.fixture(scope='module')
+def store(path_example_survey):
+    survey = preprocessing.read_survey(path_example_survey, seed=0)
+    store = PopulationStore.from_trips(
+        preprocessing.get_trips_table(survey), preprocessing.get_person_attributes(survey)
+    )
+    return store.repeat(np.full(store.n_households, 4))
+
+
+def test_parquet_round_trip(store, tmp_path):
+    parquet.write_parquet(store, tmp_path, households_per_part=5)
+
+    assert len(list((tmp_path / 'persons').iterdir())) == 3
+    assert len(parquet.read_parquet(tmp_path, 'households')) == store.n_households
+    assert len(parquet.read_parquet(tmp_path, 'persons')) == len(store)
+    activities = parquet.read_parquet(tmp_path, 'activities', columns=['pid', 'seq', 'act'])
+    assert len(activities) == len(store.activities)
+
+
+def test_parquet_overwrite(store, tmp_path):
+    parquet.write_parquet(store, tmp_path, households_per_part=2)
+    smaller = store.take(np.arange(3))
+    parquet.write_parquet(smaller, tmp_path, households_per_part=2)
+
+    for table in parquet.TABLES:
+        assert len(list((tmp_path / table).iterdir())) == 2
+    assert len(parquet.read_parquet(tmp_path, 'persons')) == len(smaller)
@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+import pytest
+from athenspop import mappings
+from athenspop import preprocessing
+
+
+@pytest.fixture(scope='module')
+def survey(path_synthetic_survey):
+    """
+    Synthetic survey, before infilling the missing return trips
+    """
+    survey = pd.read_csv(path_synthetic_survey, dtype=preprocessing.survey_dtypes)
+    survey = preprocessing.set_survey_categories(survey.dropna(subset=['home', 'age']).copy())
+    return preprocessing.step_day(survey)
+
+
+class DeterministicSampler:
+    """
+    Duration sampler with fixed durations by purpose and start hour
+    """
+    def get_durations(self, purps, hours):
+        lengths = np.array([len(purp) for purp in np.asarray(purps).ravel()])
+        return (lengths % 4 + np.asarray(hours) % 3).astype(float)
+
+    def sample(self, purps, hours, n=None, rng=None):
+        return self.get_durations(purps, hours)
+
+    def __call__(self, purp, hour):
+        return self.get_durations([purp], [hour])[0]
+
+
+def fix_nobackhome_loop(df: pd.DataFrame, duration_sampler) -> pd.DataFrame:
+    """
+    Previous (row by row) implementation of the return trip infilling
+    """
+    n_trips = np.select([df[f'dest{i}'] > 0 for i in range(5, 0, -1)], range(5, 0, -1))
+    for col in ['purp6', 'mode6', 'dest6', 'time6']:
+        df[col] = np.nan
+    df['infilled'] = False
+    for i in range(2, 6):
+        j = i + 1
+        infill = (n_trips == i) & (df[f'purp{i}'] != '2: return home') & \
+            (df[f'purp{i}'] != '5: recreation')
+        df['infilled'] = (df['infilled'] | infill)
+        df[f'dest{j}'] = np.where(infill, df.home, df[f'dest{j}'])
+        df[f'purp{j}'] = np.where(infill, '2: return home', df[f'purp{j}'])
+        df[f'mode{j}'] = np.where(infill, df[f'mode{i}'], df[f'mode{j}'])
+        for idx, values in df.loc[infill].iterrows():
+            start_time = values[f'time{i}']
+            duration = max(duration_sampler(values[f'purp{i}'], start_time), 1)
+            df.loc[idx, f'time{i+1}'] = start_time + duration
+    return df
+
+
+def get_labels(series: pd.Series) -> pd.Series:
+    return series.astype(object).where(series.notna(), 'nan').astype(str)
+
+
+def test_infill_matches_row_by_row_implementation(survey):
+    sampler = DeterministicSampler()
+    fixed = preprocessing.fix_nobackhome(survey.copy(), duration_sampler=sampler)
+    expected = fix_nobackhome_loop(survey.copy(), sampler)
+
+    assert fixed['infilled'].sum() > 0
+    assert (fixed['infilled'] == expected['infilled']).all()
+    for i in range(1, 7):
+        for col in ['purp', 'mode']:
+            pd.testing.assert_series_equal(
+                get_labels(fixed[f'{col}{i}']), get_labels(expected[f'{col}{i}'])
+            )
+        for col in ['dest', 'time']:
+            np.testing.assert_array_equal(
+                fixed[f'{col}{i}'].to_numpy(dtype=float), expected[f'{col}{i}'].to_numpy(dtype=float)
+            )
+
+
+def test_infill_seeded_reproducibility(survey):
+    sampler = preprocessing.create_duration_sampler(survey, 'empirical')
+    a = preprocessing.fix_nobackhome(survey.copy(), duration_sampler=sampler, seed=3)
+    b = preprocessing.fix_nobackhome(survey.copy(), duration_sampler=sampler, seed=3)
+    c = preprocessing.fix_nobackhome(survey.copy(), duration_sampler=sampler, seed=4)
+
+    pd.testing.assert_frame_equal(a, b)
+    times = [f'time{i}' for i in range(2, 7)]
+    assert not a[times].fillna(-1).equals(c[times].fillna(-1))
+
+
+def test_read_survey_seeded_reproducibility(path_synthetic_survey):
+    a = preprocessing.read_survey(path_synthetic_survey, seed=1)
+    b = preprocessing.read_survey(path_synthetic_survey, seed=1)
+    pd.testing.assert_frame_equal(a, b)
+
+
+class FixedUniform:
+    """
+    Random generator drawing a fixed uniform number
+    """
+    def __init__(self, u: float):
+        self.u = u
+
+    def random(self, shape):
+        return np.full(shape, self.u)
+
+
+def interpolate_ecdf(x, ecdf, purp, hour, time_period_hours=6, min_duration=1):
+    """
+    Previous inverse-cdf duration lookup (by purpose and start period)
+    """
+    start_period = hour // time_period_hours
+    if (purp, start_period) not in ecdf.index:
+        start_period = 'total'
+    ys = [0] + list(ecdf.loc[purp, start_period].index)
+    xs = [0] + list(ecdf.loc[purp, start_period].values)
+    return max(np.interp(x, xs, ys), min_duration)
+
+
+def test_empirical_sampler_matches_interpolation(survey):
+    ecdf = preprocessing.get_durations_ecdf(survey)
+    sampler = preprocessing.EmpiricalDurationSampler(ecdf)
+    purposes = list(ecdf.index.get_level_values(0).unique())
+    for purp in purposes:
+        for hour in range(0, 40, 3):
+            for u in np.linspace(0, 0.999999, 23):
+                np.testing.assert_allclose(
+                    sampler.sample(purp, hour, rng=FixedUniform(u)).item(),
+                    interpolate_ecdf(u, ecdf, purp, hour)
+                )
+
+
+def test_empirical_sampler_batch(survey):
+    sampler = preprocessing.create_duration_sampler(survey, 'empirical')
+    purps = np.array(['1: work', '3: education', '1: work'])
+    hours = np.array([8, 9, 30])
+    a = sampler.sample(purps, hours, rng=np.random.default_rng(0))
+    b = sampler.sample(purps, hours, rng=np.random.default_rng(0))
+
+    assert a.shape == (3,)
+    np.testing.assert_array_equal(a, b)
+    assert (a >= sampler.min_duration).all()
+    with pytest.raises(KeyError):
+        sampler.sample(['9: unknown'], [8])
+
+
+def test_gaussian_sampler(survey):
+    statdf = preprocessing.prpdur_stat(survey)
+    sampler = preprocessing.GaussianDurationSampler(statdf, min_duration=1, seed=0)
+    purp = statdf.index[0]
+    durations = sampler.sample(purp, n=20000)
+    np.testing.assert_array_equal(
+        durations,
+        preprocessing.GaussianDurationSampler(statdf, min_duration=1, seed=0).sample(purp, n=20000)
+    )
+    assert (durations >= 1).all()
+    assert (durations == np.round(durations)).all()
+
+    unbounded = preprocessing.GaussianDurationSampler(statdf, seed=0).sample(purp, n=20000)
+    assert abs(unbounded.mean() - statdf.loc[purp, 'dur_mean']) < 0.1 * statdf.loc[purp, 'dur_sd']
+
+
+def test_read_example_survey(path_example_survey):
+    survey = preprocessing.read_survey(path_example_survey, seed=0)
+    trips = preprocessing.get_trips_table(survey)
+    persons = preprocessing.get_person_attributes(survey)
+
+    assert len(persons) == 3
+    assert set(trips['pid']) <= set(persons['pid'])
+    assert len(trips) == 9
+    assert set(trips['purp']) <= set(mappings.purpose.values())
+
+
+def test_unknown_survey_labels(path_example_survey, tmp_path):
+    survey = pd.read_csv(path_example_survey)
+    survey.loc[0, 'mode2'] = '9: tram'
+    path = tmp_path / 'survey.csv'
+    survey.to_csv(path, index=False)
+
+    with pytest.raises(ValueError, match='9: tram'):
+        preprocessing.read_survey(path)
+    with pytest.raises(ValueError, match='9: tram'):
+        next(preprocessing.read_survey_chunks(path, chunksize=2))
+
+
+def test_chunked_reader_matches_full_read(path_synthetic_survey):
+    survey = preprocessing.read_survey(path_synthetic_survey, fix_return=False)
+    chunks = list(preprocessing.read_survey_chunks(
+        path_synthetic_survey, chunksize=300, fix_return=False
+    ))
+
+    assert len(chunks) > 1
+    pd.testing.assert_frame_equal(survey, pd.concat(chunks), check_dtype=False)
+    trips = preprocessing.get_trips_table(survey)
+    trips_chunked = pd.concat([preprocessing.get_trips_table(chunk) for chunk in chunks])
+    pd.testing.assert_frame_equal(
+        trips.sort_values(['pid', 'seq'], ignore_index=True),
+        trips_chunked.sort_values(['pid', 'seq'], ignore_index=True)
+    )
+
+
+@pytest.mark.filterwarnings('error::pandas.errors.SettingWithCopyWarning')
+def test_no_chained_assignment(path_synthetic_survey):
+    preprocessing.read_survey(path_synthetic_survey, seed=0)
+    list(preprocessing.read_survey_chunks(path_synthetic_survey, chunksize=300, seed=0))
+
+
+def test_chunked_reader_infill(path_synthetic_survey):
+    survey = preprocessing.read_survey(path_synthetic_survey, seed=2)
+    chunks = list(preprocessing.read_survey_chunks(path_synthetic_survey, chunksize=300, seed=2))
+    again = list(preprocessing.read_survey_chunks(path_synthetic_survey, chunksize=300, seed=2))
+
+    assert sum(chunk['infilled'].sum() for chunk in chunks) == survey['infilled'].sum()
+    for a, b in zip(chunks, again):
+        pd.testing.assert_frame_equal(a, b)
@@ -0,0 +1,29 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pytest
+from athenspop import profiling
+
+pytestmark = pytest.mark.skipif(profiling.resource is None, reason='resource is not available')
+
+
+def allocate(mb: int) -> int:
+    return int(np.ones(mb * 2**20 // 8).sum())
+
+
+def test_stage_peak_rss():
+    profiler = profiling.StageProfiler()
+    with profiler.stage('allocate') as record:
+        record['count'] = allocate(200)
+    with profiler.stage('idle'):
+        pass
+    with profiler.stage('pool'):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            executor.submit(allocate, 200).result()
+
+    report = profiler.report()
+    assert list(report.columns[:5]) == profiling.METRICS
+    assert report.loc['allocate', 'peak_rss'] > 150
+    assert report.loc['idle', 'peak_rss'] == 0
+    assert report.loc['idle', 'max_rss'] >= report.loc['allocate', 'peak_rss']
+    assert report.loc['pool', 'children_peak_rss'] > 150
+    assert 'workers' in profiler.format_record(profiler.records[-1])
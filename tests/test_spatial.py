@@ -0,0 +1,23 @@
+import numpy as np
+from athenspop.spatial import FacilityIndex
+
+
+def get_index(activities, aliases):
+    # one zone, one facility per activity
+    return FacilityIndex(
+        zone_ids=np.array([1]),
+        activities=np.array(activities),
+        offsets=np.arange(len(activities) + 1),
+        coords=np.arange(2 * len(activities), dtype=float).reshape(-1, 2),
+        aliases=aliases
+    )
+
+
+def test_activity_aliases():
+    index = get_index(['other', 'recreation', 'work'], {'recreation': 'other', 'visit': 'other'})
+    np.testing.assert_array_equal(
+        index.get_activity_codes(['recreation', 'visit', 'work', 'education']), [1, 0, 2, -1]
+    )
+
+    index = get_index(['other', 'work'], {'recreation': 'other'})
+    np.testing.assert_array_equal(index.get_activity_codes(['recreation', 'work']), [0, 1])
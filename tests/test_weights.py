@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+from athenspop import weights
+
+
+@pytest.fixture(scope='module')
+def households():
+    rng = np.random.default_rng(0)
+    sizes = rng.integers(1, 4, 3000)
+    person_households = np.repeat(np.arange(len(sizes)), sizes)
+    n = len(person_households)
+    persons = pd.DataFrame({
+        'hzone': rng.integers(1, 6, n),
+        'gender': rng.choice(['male', 'female'], n),
+        'income': rng.choice(['low', 'high', None], n),
+    })
+    controls = weights.get_marginals(
+        persons, rng.lognormal(0, 0.3, n) * 100, ['hzone', 'gender', 'income']
+    )
+    controls = controls[controls['category'] != 'None']
+    return persons, person_households, controls, rng.random(len(sizes)) + 0.5
+
+
+def rake_persons(persons, person_households, controls, initial, n_iter):
+    """
+    Person-level IPF: each household is scaled by the mean factor of its persons
+    """
+    sizes = np.bincount(person_households)
+    w = initial.copy()
+    for _ in range(n_iter):
+        for attribute, group in controls.groupby('attribute', sort=False):
+            codes = weights.get_category_codes(persons[attribute], pd.Index(group['category']))
+            controlled = codes >= 0
+            totals = np.bincount(
+                codes[controlled], w[person_households[controlled]], len(group)
+            )
+            ratios = np.append(group['total'].values / totals, 1)[codes]
+            w *= np.bincount(person_households, ratios) / sizes
+    return w
+
+
+def test_rake_matches_person_level_ipf(households):
+    persons, person_households, controls, initial = households
+    result = weights.Constraints(persons, controls, person_households).rake(
+        initial, max_iter=30, tol=0
+    )
+    expected = rake_persons(persons, person_households, controls, initial, 30)
+
+    assert result.iterations == 30
+    np.testing.assert_allclose(result.weights, expected, rtol=1e-9)
+
+
+def test_rake_single_person_households_converge(households):
+    persons, _, controls, _ = households
+    initial = np.ones(len(persons))
+    result = weights.Constraints(persons, controls).rake(initial, tol=1e-8)
+
+    assert result.converged
+    report = result.report()
+    assert report['error'].max() < 1e-8
+    assert report.loc[report['attribute'] == 'hzone', 'initial'].sum() == len(persons)
+
+
+def test_rake_unmatched_categories(households):
+    persons, person_households, controls, initial = households
+    extra = pd.DataFrame({'attribute': ['hzone'], 'category': ['99'], 'total': [1000.0]})
+    constraints = weights.Constraints(
+        persons, pd.concat([controls, extra], ignore_index=True), person_households
+    )
+
+    assert constraints.get_unmatched() == {'gender': [], 'hzone': ['99'], 'income': []}
+    assert np.isfinite(constraints.rake(initial).weights).all()
+
+
+def test_invalid_controls(households):
+    persons, _, controls, _ = households
+    with pytest.raises(ValueError):
+        weights.Constraints(persons, controls.assign(attribute='unknown'))
+    with pytest.raises(ValueError):
+        weights.validate_controls(controls.assign(total=-1.0))